@@ -32,7 +32,13 @@ from pydicom.uid import (
     UID
 )
 
+from node_dcm.metrics import (
+    metrics,
+    start_metrics
+)
+from node_dcm.pool import AssociationPool
 from node_dcm.status import testing
+from node_dcm.transfer import get_result
 import threading
 from node_dcm.validate import validate_port
 
@@ -52,11 +58,15 @@ class BaseServiceClass(threading.Thread):
         if self.ae.port is not None:
             validate_port(self.ae.port)
 
-        self.ae.on_c_echo = self.on_c_echo
-        self.ae.on_c_store = self.on_c_store
-        self.ae.on_c_find = self.on_c_find
-        self.ae.on_c_get = self.on_c_get
-        self.ae.on_c_move = self.on_c_move
+        # Each operation is counted and timed (see node_dcm.metrics)
+        title = self.ae.ae_title
+        self.ae.on_c_echo = metrics.timed('C-ECHO', 'scp', title, self.on_c_echo, get_result)
+        self.ae.on_c_store = metrics.timed('C-STORE', 'scp', title, self.on_c_store, get_result)
+        self.ae.on_c_find = metrics.timed('C-FIND', 'scp', title, self.on_c_find, get_result)
+        self.ae.on_c_get = metrics.timed('C-GET', 'scp', title, self.on_c_get, get_result)
+        self.ae.on_c_move = metrics.timed('C-MOVE', 'scp', title, self.on_c_move, get_result)
+        metrics.register(self.ae)
+        start_metrics()
         threading.Thread.__init__(self)
         self.daemon = True
         self.delay = 0
@@ -151,11 +161,15 @@ class BaseSCU(BaseServiceClass):
 
     information_models = ['W','P','S','O']
 
-    def __init__(self,ae=None):
+    def __init__(self,ae=None,idle_timeout=30):
 
         self.assoc = None
+        self.assoc_key = None
         self.pdu_max = 16384
 
+        # Released associations are kept (for idle_timeout seconds) to be reused
+        self.pool = AssociationPool(idle_timeout=idle_timeout)
+
         self.to_name = "ANY-SCP"
         self.to_address = None
         self.to_port = 11112
@@ -187,25 +201,40 @@ class BaseSCU(BaseServiceClass):
             bot.error("You must supply a peer address to make an association.")
             sys.exit(1)
         self.to_address = address
-        bot.debug("Peer[%s] %s:%s" %(self.to_name,
-                                     self.to_address,
-                                     self.to_port))
+        bot.debug("Peer[%s] %s:%s", self.to_name,
+                                   self.to_address,
+                                   self.to_port)
 
 
     # Associations
 
     def release_assoc(self):
         '''release assoc will release any associations that are open,
-        in preparation for a new one.
+        in preparation for a new one. An established association is returned
+        to the pool, to be reused by the next request to the same peer.
         '''
         if self.assoc is not None:
             if self.assoc.is_established:
-                bot.debug("Found established association, releasing.")
-                self.assoc.release()
+                if self.assoc_key is not None:
+                    bot.debug("Found established association, keeping it for reuse.")
+                    self.pool.put(self.assoc_key, self.assoc)
+                else:
+                    bot.debug("Found established association, releasing.")
+                    self.assoc.release()
+            self.assoc = None
+            self.assoc_key = None
+
+
+    def close_assocs(self):
+        '''release the current association, and all associations kept for reuse'''
+        self.release_assoc()
+        self.pool.clear()
 
 
     def make_assoc(self,address=None,port=None,name=None,pdu_max=None,ext_neg=None):
-        '''make an association with a peer at address, and port
+        '''make an association with a peer at address, and port. An idle association
+        with the same peer and presentation contexts is reused, if there is one.
+        Associations with extended negotiation are always made new.
         :param address: the address of the peer
         :param port: the port of the peer
         :param to_name: the name of the peer
@@ -219,11 +248,25 @@ class BaseSCU(BaseServiceClass):
                          name=name)
 
         self.release_assoc()
-        self.assoc = self.ae.associate(self.to_address,
-                                       self.to_port,
-                                       self.to_name,
-                                       max_pdu=self.pdu_max,
-                                       ext_neg=ext_neg)
+
+        def connect():
+            return self.ae.associate(self.to_address,
+                                     self.to_port,
+                                     self.to_name,
+                                     max_pdu=self.pdu_max,
+                                     ext_neg=ext_neg)
+
+        if ext_neg is not None:
+            self.assoc = connect()
+            return
+
+        key = self.pool.get_key(self.to_address,
+                                self.to_port,
+                                self.to_name,
+                                self.ae,
+                                pdu_max=self.pdu_max)
+        self.assoc = self.pool.acquire(key, connect)
+        self.assoc_key = key
 
     # Information Models
     def model_help(self):
@@ -0,0 +1,220 @@
+'''
+
+cache.py: a persistent cache of the validation and header attributes of
+          dicom files, shared by the node_dcm components
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+from node_dcm.logman import bot
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# The validation levels, a result of the deep check also answers the quick one
+validation_levels = {'quick': 1, 'deep': 2}
+
+# The caches that are open, by file, so that components share a connection
+caches = dict()
+caches_lock = threading.Lock()
+
+
+def get_cache(cache_file=None, max_entries=1000000):
+    '''get_cache returns the HeaderCache for a file, opened once and shared. If
+    no file is given, it is taken from the environment (NODEDCM_CACHE), and if
+    that isn't set either, None is returned (no cache).
+    '''
+    if cache_file is None:
+        cache_file = os.environ.get('NODEDCM_CACHE')
+    if cache_file is None:
+        return None
+
+    with caches_lock:
+        if cache_file not in caches:
+            caches[cache_file] = HeaderCache(cache_file, max_entries=max_entries)
+        return caches[cache_file]
+
+
+def get_file_stat(path):
+    '''get_file_stat returns the (size, mtime, inode) a cache entry is valid for,
+    or None if the file doesn't exist'''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime, stat.st_ino)
+
+
+class HeaderCache:
+    '''A HeaderCache keeps, for each file, whether it is a valid dicom file (and
+    why not), and the attributes read from its header, in a sidecar sqlite file.
+    An entry is only used while the size, modification time and inode of the
+    file are unchanged, so a changed file is checked (or read) again. When the
+    cache has more than max_entries, the least recently used are evicted. A hit
+    doesn't write to the cache: when an entry was used is kept in memory until
+    the next commit.
+    '''
+
+    # Changes are committed (and the size checked) after this many updates
+    commit_every = 1000
+
+    def __init__(self, cache_file, max_entries=1000000, timeout=30.0):
+        '''
+        :param cache_file: the sqlite file of the cache (created if needed)
+        :param max_entries: the maximum number of files to keep
+        :param timeout: the seconds to wait for a write of another process to finish
+        '''
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.updates = 0
+        self.lock = threading.RLock()
+
+        # When each entry was last used, since the last commit
+        self.touched = dict()
+
+        self.conn = sqlite3.connect(cache_file, timeout=timeout, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                              '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                              'inode INTEGER, level INTEGER, valid INTEGER, '
+                              'error TEXT, attributes TEXT, used REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_used ON entries (used)')
+            self.conn.commit()
+
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+
+    def get(self, path):
+        '''get returns the entry of a file, a dict with its validation (level,
+        valid, error) and attributes, or None if it isn't cached or has changed.
+        '''
+        stat = get_file_stat(path)
+        if stat is None:
+            return None
+
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime, inode, level, valid, error, '
+                                    'attributes FROM entries WHERE path = ?',
+                                    (path,)).fetchone()
+            if row is None or tuple(row[:3]) != stat:
+                return None
+            self.touched[path] = time.time()
+            if len(self.touched) >= self.commit_every:
+                self.commit()
+
+        return {'level': row[3],
+                'valid': None if row[4] is None else bool(row[4]),
+                'error': row[5],
+                'attributes': json.loads(row[6] or '{}')}
+
+
+    def get_validation(self, path, level='quick'):
+        '''return the cached (valid, error) of a file, if it was validated at the
+        level given (or deeper), otherwise None'''
+        entry = self.get(path)
+        if entry is None or entry['level'] is None:
+            return None
+        if entry['level'] < validation_levels[level]:
+            return None
+        return entry['valid'], entry['error']
+
+
+    def get_attributes(self, path, fields):
+        '''return the cached attributes of a file, if all fields are cached,
+        otherwise None'''
+        entry = self.get(path)
+        if entry is None:
+            return None
+        attributes = entry['attributes']
+        if any([field not in attributes for field in fields]):
+            return None
+        return attributes
+
+
+    def put(self, path, valid=None, error=None, level=None, attributes=None, stat=None):
+        '''put updates the entry of a file: its validation (valid, error at a
+        level, quick or deep), and/or attributes (a dict, added to those cached).
+        An entry for an older version of the file is replaced.
+        :param stat: the (size, mtime, inode) of the file (see get_file_stat) from
+                     before it was read. If the file changed since, the entry is
+                     for the old version, and isn't used. Taken now if not given.
+        '''
+        if stat is None:
+            stat = get_file_stat(path)
+        if stat is None:
+            return
+
+        with self.lock:
+            self.touched.pop(path, None)
+            row = self.conn.execute('SELECT size, mtime, inode, level, valid, error, '
+                                    'attributes FROM entries WHERE path = ?',
+                                    (path,)).fetchone()
+            current = [None, None, None, '{}']
+            if row is not None and tuple(row[:3]) == stat:
+                current = list(row[3:])
+
+            if level is not None:
+                current[0:3] = [validation_levels[level], valid, error]
+            if attributes is not None:
+                merged = json.loads(current[3] or '{}')
+                merged.update(attributes)
+                current[3] = json.dumps(merged)
+
+            self.conn.execute('INSERT OR REPLACE INTO entries (path, size, mtime, '
+                              'inode, level, valid, error, attributes, used) VALUES '
+                              '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              [path] + list(stat) + current + [time.time()])
+
+            self.updates += 1
+            if self.updates >= self.commit_every:
+                self.commit()
+
+
+    def commit(self):
+        '''record when the entries used since the last commit were used, evict
+        the least recently used entries over max_entries, and commit'''
+        with self.lock:
+            self.updates = 0
+            if len(self.touched) > 0:
+                self.conn.executemany('UPDATE entries SET used = ? WHERE path = ?',
+                                      [(used, path) for path, used in self.touched.items()])
+                self.touched = dict()
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                # Evict a little more, so that eviction isn't needed on every commit
+                excess += self.max_entries // 10
+                bot.debug("Evicting %s entries from %s" %(excess, self.cache_file))
+                self.conn.execute('DELETE FROM entries WHERE path IN (SELECT path FROM '
+                                  'entries ORDER BY used LIMIT ?)', (excess,))
+            self.conn.commit()
+
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.conn.close()
@@ -0,0 +1,281 @@
+'''
+
+columns.py: an in memory, columnar copy of the metadata index, so that a
+            query can be checked against all instances at once
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import bisect
+import numpy
+import re
+
+
+# The code of a missing (empty) value in a column
+MISSING = -1
+
+
+def compile_wildcard(pattern):
+    '''compile_wildcard returns a compiled regular expression for a dicom
+    wildcard pattern, where * matches any sequence of characters and ?
+    matches a single character.
+    '''
+    regex = ''
+    for character in pattern:
+        if character == '*':
+            regex += '.*'
+        elif character == '?':
+            regex += '.'
+        else:
+            regex += re.escape(character)
+    return re.compile('%s$' %(regex), re.DOTALL)
+
+
+class ColumnStore:
+    '''A ColumnStore holds one integer array per field, where each value is
+    interned to a code, and the distinct values of the field (the vocabulary)
+    are kept once. A condition on a field is answered by finding the matching
+    codes in the (small) vocabulary, followed by a single comparison over the
+    column. Each condition returns a boolean mask over all rows, or over the
+    rows given (an array of row indices), to narrow down earlier matches.
+
+    The store is updated in place: rows are appended, and a deleted row is only
+    marked as such (a tombstone), so the index of a row never changes. The rows
+    that are not deleted are kept in order of their path (see order), until the
+    store is compacted.
+    '''
+
+    def __init__(self, fields, rows):
+        '''
+        :param fields: the names of the fields, in the order of the rows
+        :param rows: a list of rows, each (path, value1, value2, ...)
+        '''
+        self.fields = list(fields)
+        self.paths = []
+        self.lookup = dict()
+        self.vocabulary = dict([(field, []) for field in self.fields])
+        self.codes = dict([(field, dict()) for field in self.fields])
+        self.columns = dict([(field, numpy.empty(0, dtype=numpy.int32))
+                             for field in self.fields])
+        self.sorted = dict()
+
+        # The rows not deleted, and their paths, sorted by path
+        self.live = numpy.empty(0, dtype=bool)
+        self.order = numpy.empty(0, dtype=numpy.int64)
+        self.keys = numpy.empty(0, dtype=object)
+        self.deleted = 0
+        self.append(rows)
+
+
+    def __len__(self):
+        return len(self.order)
+
+
+    def append(self, rows):
+        '''append rows to the store. A row for a path that is already in the
+        store replaces it (the old row is deleted).
+        :param rows: a list of rows, each (path, value1, value2, ...)
+        '''
+        if len(rows) == 0:
+            return
+        self.delete([row[0] for row in rows])
+
+        start = len(self.paths)
+        for ii, field in enumerate(self.fields):
+            codes = self.codes[field]
+            vocabulary = self.vocabulary[field]
+            size = len(vocabulary)
+            column = numpy.empty(len(rows), dtype=numpy.int32)
+
+            for jj, row in enumerate(rows):
+                value = row[ii + 1]
+                if value is None:
+                    column[jj] = MISSING
+                    continue
+
+                code = codes.get(value)
+                if code is None:
+                    code = len(vocabulary)
+                    codes[value] = code
+                    vocabulary.append(value)
+                column[jj] = code
+
+            if len(vocabulary) != size:
+                self.sorted.pop(field, None)
+            self.columns[field] = numpy.concatenate([self.columns[field], column])
+
+        for row in rows:
+            self.lookup[row[0]] = len(self.paths)
+            self.paths.append(row[0])
+        self.live = numpy.concatenate([self.live, numpy.ones(len(rows), dtype=bool)])
+
+        # Merge the new rows into the order of the rows before them
+        added = sorted(range(start, len(self.paths)), key=self.paths.__getitem__)
+        keys = numpy.empty(len(added), dtype=object)
+        keys[:] = [self.paths[row] for row in added]
+        positions = numpy.searchsorted(self.keys, keys)
+        self.order = numpy.insert(self.order, positions, added)
+        self.keys = numpy.insert(self.keys, positions, keys)
+
+
+    def delete(self, paths):
+        '''mark the rows of paths as deleted, paths not in the store are ignored'''
+        rows = [self.lookup.pop(path) for path in paths if path in self.lookup]
+        if len(rows) == 0:
+            return
+        self.live[rows] = False
+        self.deleted += len(rows)
+        keep = self.live[self.order]
+        self.order = self.order[keep]
+        self.keys = self.keys[keep]
+
+
+    def compact(self):
+        '''compact returns a copy of the store without the deleted rows, and
+        without the values of the vocabulary that only deleted rows had'''
+        store = ColumnStore(self.fields, [])
+        store.paths = list(self.keys)
+        store.lookup = dict([(path, ii) for ii, path in enumerate(store.paths)])
+        store.live = numpy.ones(len(store.paths), dtype=bool)
+        store.order = numpy.arange(len(store.paths))
+        store.keys = self.keys.copy()
+
+        for field in self.fields:
+            column = self.columns[field][self.order]
+            used = numpy.unique(column[column != MISSING])
+            # The last (unused) code maps MISSING (-1) to itself
+            mapping = numpy.full(len(self.vocabulary[field]) + 1, MISSING,
+                                 dtype=numpy.int32)
+            mapping[used] = numpy.arange(len(used))
+            store.vocabulary[field] = [self.vocabulary[field][code] for code in used]
+            store.codes[field] = dict([(value, code) for code, value in
+                                       enumerate(store.vocabulary[field])])
+            store.columns[field] = mapping[column]
+        return store
+
+
+    def empty(self, rows=None):
+        '''return a mask that selects no rows'''
+        if rows is None:
+            return numpy.zeros(len(self.paths), dtype=bool)
+        return numpy.zeros(len(rows), dtype=bool)
+
+
+    def get_column(self, field, rows=None):
+        '''return the codes of a field for all rows, or the rows given'''
+        if rows is None:
+            return self.columns[field]
+        return self.columns[field][rows]
+
+
+    def get_sorted(self, field):
+        '''return the (sorted) vocabulary of a field with the code of each value,
+        used to find the values in a range or with a prefix without a full scan'''
+        if field not in self.sorted:
+            pairs = sorted(zip(self.vocabulary[field], range(len(self.vocabulary[field]))))
+            self.sorted[field] = ([x[0] for x in pairs], [x[1] for x in pairs])
+        return self.sorted[field]
+
+
+    def present(self, field, rows=None):
+        '''return a mask of the rows that have a value for a field'''
+        return self.get_column(field, rows) != MISSING
+
+
+    def isin(self, field, codes, rows=None):
+        '''return a mask of the rows with one of a list of codes for a field'''
+        if len(codes) == 0:
+            return self.empty(rows)
+        if len(codes) == 1:
+            return self.get_column(field, rows) == codes[0]
+        return numpy.isin(self.get_column(field, rows), codes)
+
+
+    def exact(self, field, value, rows=None):
+        '''return a mask of the rows where a field is exactly value'''
+        code = self.codes[field].get(value)
+        if code is None:
+            return self.empty(rows)
+        return self.get_column(field, rows) == code
+
+
+    def wildcard(self, field, pattern, rows=None):
+        '''return a mask of the rows where a field matches a wildcard pattern'''
+        return self.regex(field, compile_wildcard(pattern), rows)
+
+
+    def regex(self, field, regex, rows=None):
+        '''return a mask of the rows where a field matches a compiled regex'''
+        return self.matching(field, regex.match, rows)
+
+
+    def matching(self, field, function, rows=None):
+        '''return a mask of the rows where function is true for the value of a
+        field, called once for each distinct value'''
+        codes = [code for code, value in enumerate(self.vocabulary[field])
+                 if function(value)]
+        return self.isin(field, codes, rows)
+
+
+    def prefix(self, field, prefix, rows=None):
+        '''return a mask of the rows where a field starts with prefix'''
+        values, codes = self.get_sorted(field)
+        start = bisect.bisect_left(values, prefix)
+        end = start
+        while end < len(values) and values[end].startswith(prefix):
+            end += 1
+        return self.isin(field, codes[start:end], rows)
+
+
+    def range(self, field, lower=None, upper=None, rows=None):
+        '''return a mask of the rows where a field is between lower and upper
+        (inclusive, either can be None). Values are compared as strings, as for
+        dates and times, and to the precision of upper.'''
+        values, codes = self.get_sorted(field)
+        start = 0
+        if lower is not None:
+            start = bisect.bisect_left(values, lower)
+        end = len(values)
+        if upper is not None:
+            end = start
+            while end < len(values) and values[end][:len(upper)] <= upper:
+                end += 1
+        return self.isin(field, codes[start:end], rows)
+
+
+    def uid_list(self, field, uids, rows=None):
+        '''return a mask of the rows where a field is one of a list of uids'''
+        lookup = self.codes[field]
+        codes = [lookup[uid] for uid in uids if uid in lookup]
+        return self.isin(field, codes, rows)
+
+
+    def value(self, field, row):
+        '''return the value of a field for a row, or None if it's missing'''
+        code = self.columns[field][row]
+        if code == MISSING:
+            return None
+        return self.vocabulary[field][code]
+
+
+    def rows(self, mask):
+        '''return the indices of the rows selected by a mask'''
+        return numpy.flatnonzero(mask)
@@ -0,0 +1,820 @@
+'''
+
+index.py: a persistent metadata index of dicom files, so that providers
+          can answer queries without reading the files themselves
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+from node_dcm.cache import get_file_stat
+from node_dcm.columns import ColumnStore
+from node_dcm.logman import bot
+from node_dcm.query import (
+    Condition,
+    QueryPlan,
+    QueryPlanner,
+    get_kind
+)
+from node_dcm.reader import read_header
+from node_dcm.validate import validate_dicoms
+from pydicom.dataset import Dataset
+from pydicom.datadict import dictionary_VR
+from pydicom.multival import MultiValue
+import os
+import sqlite3
+import threading
+import time
+
+
+# Bump when the columns of the index change, an older index is then rebuilt
+SCHEMA_VERSION = 4
+
+
+# The (human friendly) fields that a query is allowed to search
+searchable = ['AccessionNumber',
+              'Columns',
+              'ConversionType',
+              'ImageComments',
+              'InstanceNumber',
+              'InstitutionName',
+              'Modality',
+              'NameOfPhysiciansReadingStudy',
+              'OperatorsName',
+              'PatientBirthDate',
+              'PatientID',
+              'PatientName',
+              'PatientSex',
+              'ReferringPhysicianName',
+              'Rows',
+              'SOPClassUID',
+              'SOPInstanceUID',
+              'SeriesDescription',
+              'SeriesInstanceUID',
+              'SeriesNumber',
+              'StudyDate',
+              'StudyDescription',
+              'StudyID',
+              'StudyInstanceUID',
+              'StudyTime']
+
+
+# The fields of the patient, study and series records, rolled up from the instances
+patient_fields = ['PatientID',
+                  'PatientName',
+                  'PatientSex',
+                  'PatientBirthDate']
+
+study_fields = patient_fields + ['StudyInstanceUID',
+                                 'StudyDate',
+                                 'StudyTime',
+                                 'StudyID',
+                                 'AccessionNumber',
+                                 'StudyDescription',
+                                 'ReferringPhysicianName',
+                                 'NameOfPhysiciansReadingStudy']
+
+series_fields = ['PatientID',
+                 'StudyInstanceUID',
+                 'SeriesInstanceUID',
+                 'Modality',
+                 'SeriesNumber',
+                 'SeriesDescription']
+
+
+# For each query level above IMAGE: the table of records, the unique key of a
+# record, the fields rolled up from its instances, and the counts kept for it
+levels = {'PATIENT': {'table': 'patients',
+                      'key': 'PatientID',
+                      'fields': patient_fields,
+                      'counts': ['NumberOfPatientRelatedStudies',
+                                 'NumberOfPatientRelatedSeries',
+                                 'NumberOfPatientRelatedInstances']},
+          'STUDY': {'table': 'studies',
+                    'key': 'StudyInstanceUID',
+                    'fields': study_fields,
+                    'counts': ['ModalitiesInStudy',
+                               'NumberOfStudyRelatedSeries',
+                               'NumberOfStudyRelatedInstances']},
+          'SERIES': {'table': 'series',
+                     'key': 'SeriesInstanceUID',
+                     'fields': series_fields,
+                     'counts': ['NumberOfSeriesRelatedInstances']}}
+
+
+# How each count is derived from the instances of a record
+rollup_counts = {'NumberOfPatientRelatedStudies': lambda x: len(x['studies']),
+                 'NumberOfPatientRelatedSeries': lambda x: len(x['series']),
+                 'NumberOfPatientRelatedInstances': lambda x: x['instances'],
+                 'ModalitiesInStudy': lambda x: '\\'.join(sorted(x['modalities'])),
+                 'NumberOfStudyRelatedSeries': lambda x: len(x['series']),
+                 'NumberOfStudyRelatedInstances': lambda x: x['instances'],
+                 'NumberOfSeriesRelatedInstances': lambda x: x['instances']}
+
+
+# Query keys that are matched against another field at a level, e.g. the
+# Modality of a study matches any of its ModalitiesInStudy
+level_aliases = {'STUDY': {'Modality': 'ModalitiesInStudy'}}
+
+
+# The unique keys that a response must include, for each query level
+level_keys = {'PATIENT': ['PatientID'],
+              'STUDY': ['PatientID', 'StudyInstanceUID'],
+              'SERIES': ['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID'],
+              'IMAGE': ['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID',
+                        'SOPInstanceUID']}
+
+
+def to_index_value(value):
+    '''to_index_value converts a dataset value to the string that is stored in
+    (and compared against) the index. Empty values are stored as None.
+    '''
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple, MultiValue)):
+        value = '\\'.join([str(x) for x in value])
+    value = str(value).strip()
+    if value == '':
+        return None
+    return value
+
+
+def from_index_value(field, value):
+    '''from_index_value converts a value stored in the index back to a value
+    that can be set for the field of a dataset.
+    '''
+    if value is None:
+        return ''
+    values = value.split('\\')
+    if dictionary_VR(field) in ['US', 'SS', 'UL', 'SL']:
+        values = [int(x) for x in values]
+    if len(values) == 1:
+        return values[0]
+    return values
+
+
+class MetadataIndex:
+    '''A sqlite index of the searchable attributes of a set of dicom files.
+    The index can be kept in memory (default) or persisted to an index_file,
+    in which case it is reused across restarts. Alongside the instances, the
+    index keeps one record per patient, study and series (see levels), updated
+    as instances are added and removed, so that a query at those levels doesn't
+    need to look at the instances.
+    '''
+
+    # The number of changes kept for the column stores to catch up with
+    changes_kept = 100000
+
+    def __init__(self, index_file=None, fields=None, cache=None, timeout=30.0):
+        '''
+        :param index_file: the sqlite file to persist the index to (default in memory)
+        :param fields: the fields to index, defaults to the searchable fields
+        :param cache: a HeaderCache to look up (and store) the headers of files
+        :param timeout: the seconds to wait for a write of another connection
+                        (e.g., a Store in another process) to finish
+        '''
+        if index_file is None:
+            index_file = ':memory:'
+
+        if fields is None:
+            fields = searchable
+
+        self.index_file = index_file
+        self.fields = list(fields)
+        self.cache = cache
+        self.lock = threading.RLock()
+
+        # The column store of each level, with the last change applied to it
+        self.stores = dict()
+        self.planner = QueryPlanner()
+
+        # The keys of the records to roll up again on the next commit
+        self.rollup_keys = [levels[x]['key'] for x in ['PATIENT', 'STUDY', 'SERIES']
+                            if levels[x]['key'] in self.fields]
+        self.dirty = dict([(level, set()) for level in levels])
+
+        # Associations are served from different threads, the lock protects the connection
+        self.conn = sqlite3.connect(index_file, timeout=timeout, check_same_thread=False)
+
+        # Readers of an index file don't block its writer (or the other way around)
+        if index_file != ':memory:':
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        self.create_tables()
+
+
+    def create_tables(self):
+        '''create the instances and record tables, rebuilding them if the
+        schema has changed'''
+        with self.lock:
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                bot.debug("Creating metadata index %s", self.index_file)
+                self.conn.execute('DROP TABLE IF EXISTS instances')
+                self.conn.execute('DROP TABLE IF EXISTS changes')
+                for level in levels.values():
+                    self.conn.execute('DROP TABLE IF EXISTS %s' %(level['table']))
+
+            for level in levels:
+                if levels[level]['key'] not in self.rollup_keys:
+                    continue
+                key = levels[level]['key']
+                columns = ", ".join(['"%s" TEXT' %(field) for field in
+                                     self.get_level_fields(level) if field != key])
+                self.conn.execute('CREATE TABLE IF NOT EXISTS %s ("%s" TEXT PRIMARY KEY, '
+                                  '%s)' %(levels[level]['table'], key, columns))
+
+            columns = ", ".join(['"%s" TEXT' %(field) for field in self.fields])
+            self.conn.execute('CREATE TABLE IF NOT EXISTS instances '
+                              '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                              '%s)' %(columns))
+
+            for field in self.fields:
+                self.conn.execute('CREATE INDEX IF NOT EXISTS "idx_%s" '
+                                  'ON instances ("%s")' %(field, field))
+
+            # Each record added or removed (by any connection) is logged, for
+            # the column stores to be updated with (see columns)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY '
+                              'KEY AUTOINCREMENT, level TEXT, key TEXT)')
+            tables = [('IMAGE', 'instances', 'path')]
+            tables += [(level, levels[level]['table'], levels[level]['key'])
+                       for level in levels if self.has_level(level)]
+            for level, table, key in tables:
+                for event, row in [('INSERT', 'NEW'), ('DELETE', 'OLD')]:
+                    self.conn.execute('CREATE TRIGGER IF NOT EXISTS "log_%s_%s" AFTER %s ON '
+                                      '%s BEGIN INSERT INTO changes (level, key) VALUES '
+                                      '(\'%s\', %s."%s"); END' %(table, event.lower(),
+                                                                 event, table, level,
+                                                                 row, key))
+
+            self.conn.execute('PRAGMA user_version = %s' %(SCHEMA_VERSION))
+            self.conn.commit()
+
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM instances').fetchone()[0]
+
+
+    def get_level_fields(self, level):
+        '''return the fields (and counts) kept for the records of a query level'''
+        if level == 'IMAGE':
+            return self.fields
+        fields = [x for x in levels[level]['fields'] if x in self.fields]
+        return fields + levels[level]['counts']
+
+
+    def has_level(self, level):
+        '''return True if the index can answer queries at a level'''
+        if level == 'IMAGE':
+            return True
+        return level in levels and levels[level]['key'] in self.rollup_keys
+
+
+    def count(self, level='IMAGE'):
+        '''return the number of records at a query level'''
+        table = 'instances'
+        if level != 'IMAGE':
+            table = levels[level]['table']
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM %s' %(table)).fetchone()[0]
+
+
+    def paths(self):
+        '''return the set of paths that are currently indexed'''
+        with self.lock:
+            rows = self.conn.execute('SELECT path FROM instances').fetchall()
+        return set([row[0] for row in rows])
+
+
+    def stats(self):
+        '''return a lookup of indexed paths to their (size, mtime) when indexed'''
+        with self.lock:
+            rows = self.conn.execute('SELECT path, size, mtime FROM instances').fetchall()
+        return dict([(row[0], (row[1], row[2])) for row in rows])
+
+
+    def get_row(self, path, dataset, stat=None):
+        '''get_row returns the values to insert into the index for a dataset'''
+        if stat is None:
+            stat = get_stat(path)
+        row = [path, stat[0], stat[1]]
+        for field in self.fields:
+            row.append(to_index_value(dataset.get(field)))
+        return row
+
+
+    def add(self, path, dataset=None, stat=None, commit=True):
+        '''add a single file to the index. If the dataset isn't provided, the
+        header of the file is read to obtain it.
+        :param path: the full path to the dicom file
+        :param dataset: the (already read) pydicom dataset for the path
+        :param stat: the (size, mtime) of the file, looked up if not provided
+        :param commit: commit the transaction (default True)
+        '''
+        if dataset is None:
+            dataset = self.read_header(path)
+        self.insert([self.get_row(path, dataset, stat=stat)], commit=commit)
+
+
+    def insert(self, rows, commit=True):
+        '''insert (or replace) rows from get_row into the index. The files of the
+        rows should be read before, to keep the write transaction short.
+        :param rows: the rows to insert, each from get_row
+        :param commit: commit the transaction (default True)
+        '''
+        if len(rows) == 0:
+            return
+
+        paths = [row[0] for row in rows]
+        columns = ", ".join(['"%s"' %(field) for field in self.fields])
+        values = ", ".join(['?'] * (len(self.fields) + 3))
+
+        with self.lock:
+            try:
+                self.mark_dirty(paths)
+                self.conn.executemany('INSERT OR REPLACE INTO instances (path, size, '
+                                      'mtime, %s) VALUES (%s)' %(columns, values), rows)
+                self.mark_dirty(paths)
+                if commit:
+                    self.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+
+
+    def read_header(self, path, stat=None):
+        '''read_header returns the values of the indexed fields of a file, from the
+        cache if the file is unchanged since it was cached, otherwise from the file
+        (and then cached).
+        :param stat: the (size, mtime, inode) of the file (see get_file_stat),
+                     taken before it's read if not given
+        '''
+        if self.cache is not None:
+            attributes = self.cache.get_attributes(path, self.fields)
+            if attributes is not None:
+                return attributes
+            if stat is None:
+                stat = get_file_stat(path)
+
+        dataset = read_header(path, tags=self.fields)
+        if self.cache is None:
+            return dataset
+
+        attributes = dict([(field, to_index_value(dataset.get(field)))
+                           for field in self.fields])
+        self.cache.put(path, attributes=attributes, stat=stat)
+        return attributes
+
+
+    def remove(self, paths):
+        '''remove one or more paths from the index'''
+        if not isinstance(paths, (list, set, tuple)):
+            paths = [paths]
+
+        with self.lock:
+            self.mark_dirty(paths)
+            self.conn.executemany('DELETE FROM instances WHERE path = ?',
+                                  [(path,) for path in paths])
+            self.commit()
+
+
+    def mark_dirty(self, paths):
+        '''mark the patient, study and series records of indexed paths to be
+        rolled up again on the next commit'''
+        if len(self.rollup_keys) == 0:
+            return
+
+        key_levels = dict([(levels[x]['key'], x) for x in levels])
+        columns = ", ".join(['"%s"' %(key) for key in self.rollup_keys])
+        with self.lock:
+            for chunk in get_chunks(list(paths)):
+                rows = self.conn.execute('SELECT %s FROM instances WHERE path IN (%s)'
+                                         %(columns, ", ".join(['?'] * len(chunk))),
+                                         chunk).fetchall()
+                for row in rows:
+                    for key, value in zip(self.rollup_keys, row):
+                        if value is not None:
+                            self.dirty[key_levels[key]].add(value)
+
+
+    def commit(self):
+        '''roll up the records changed since the last commit, drop the oldest
+        changes (beyond changes_kept), and commit'''
+        with self.lock:
+            self.update_rollups()
+            self.conn.execute('DELETE FROM changes WHERE seq <= (SELECT MAX(seq) '
+                              'FROM changes) - ?', (self.changes_kept,))
+            self.conn.commit()
+
+
+    def update_rollups(self):
+        '''update_rollups aggregates the instances of each changed patient, study
+        and series into its record, including the counts of related instances.
+        '''
+        for level in ['PATIENT', 'STUDY', 'SERIES']:
+            keys = list(self.dirty[level])
+            if len(keys) == 0:
+                continue
+
+            self.dirty[level] = set()
+            table = levels[level]['table']
+            key = levels[level]['key']
+            fields = [x for x in levels[level]['fields'] if x in self.fields]
+            extra = [x for x in ['StudyInstanceUID', 'SeriesInstanceUID', 'Modality']
+                     if x in self.fields and x not in fields]
+            columns = ", ".join(['"%s"' %(x) for x in fields + extra])
+            counts = levels[level]['counts']
+
+            for chunk in get_chunks(keys):
+                marks = ", ".join(['?'] * len(chunk))
+                rows = self.conn.execute('SELECT %s FROM instances WHERE "%s" IN (%s)'
+                                         %(columns, key, marks), chunk).fetchall()
+
+                records = dict()
+                for row in rows:
+                    values = dict(zip(fields + extra, row))
+                    record = records.setdefault(values[key], {'values': dict(),
+                                                              'instances': 0,
+                                                              'studies': set(),
+                                                              'series': set(),
+                                                              'modalities': set()})
+                    for field in fields:
+                        if record['values'].get(field) is None:
+                            record['values'][field] = values[field]
+
+                    record['instances'] += 1
+                    for name, field in [('studies', 'StudyInstanceUID'),
+                                        ('series', 'SeriesInstanceUID'),
+                                        ('modalities', 'Modality')]:
+                        if values.get(field) is not None:
+                            record[name].add(values[field])
+
+                self.conn.execute('DELETE FROM %s WHERE "%s" IN (%s)' %(table, key, marks),
+                                  chunk)
+
+                names = ", ".join(['"%s"' %(x) for x in fields + counts])
+                inserts = []
+                for record in records.values():
+                    row = [record['values'][x] for x in fields]
+                    row += [to_index_value(rollup_counts[x](record)) for x in counts]
+                    inserts.append(row)
+                self.conn.executemany('INSERT INTO %s (%s) VALUES (%s)'
+                                      %(table, names, ", ".join(['?'] * len(fields + counts))),
+                                      inserts)
+
+
+    def read_rows(self, dcm_files, stats=None):
+        '''read_rows reads the headers of files (before they are inserted), and
+        returns their rows. A file that can't be read is skipped.
+        :param dcm_files: the paths of the files to read
+        :param stats: a lookup of paths to their (size, mtime, inode), if known
+        '''
+        rows = []
+        for dcm_file in dcm_files:
+            stat = None
+            if stats is not None:
+                stat = stats.get(dcm_file)
+            try:
+                rows.append(self.get_row(dcm_file, self.read_header(dcm_file, stat=stat),
+                                         stat=stat))
+            except Exception as error:
+                bot.warning("Cannot index %s: %s", dcm_file, error)
+        return rows
+
+
+    def refresh(self, contenders, partial=False):
+        '''refresh the index against a list of (not yet validated) candidate
+        files. Only files that are new, or with a size or modification time that
+        differs from when they were indexed, are validated and read. Indexed files
+        not in contenders are removed, unless partial is True, in which case
+        contenders is only the set of paths that might have changed.
+        :param contenders: the paths of candidate dicom files
+        :param partial: if True, only consider the paths in contenders
+        :returns (added, removed): the number of files (re)indexed and removed
+        '''
+        indexed = self.stats()
+        current = dict()
+        for contender in contenders:
+            stat = get_file_stat(contender)
+            if stat is not None:
+                current[contender] = stat
+
+        if partial:
+            removed = set([x for x in contenders if x in indexed and x not in current])
+        else:
+            removed = set(indexed) - set(current)
+
+        changed = [x for x in current if indexed.get(x) != current[x][:2]]
+
+        # Changed files that are no longer valid are removed too
+        valids = []
+        if len(changed) > 0:
+            valids = validate_dicoms(changed, cache=self.cache)
+            removed.update([x for x in changed if x in indexed and x not in valids])
+
+        if len(removed) > 0:
+            bot.debug("Removing %s files from metadata index", len(removed))
+            self.remove(removed)
+
+        if len(valids) > 0:
+            bot.debug("Indexing %s new or changed files", len(valids))
+
+        self.insert(self.read_rows(valids, stats=current))
+
+        if self.cache is not None:
+            self.cache.commit()
+        return len(valids), len(removed)
+
+
+    def columns(self, level='IMAGE'):
+        '''columns returns the ColumnStore for the current contents of the index
+        at a query level. The store is built once, and then updated with the
+        records changed since (by this or any other connection, see changes):
+        the old rows of a changed record are deleted, and its current row (if
+        any) is appended. The store is compacted when it has more deleted rows
+        than rows, and built again only if the changes it needs were dropped.
+        The paths of the store are the files of the instances (IMAGE level), or
+        the unique keys of the records.
+        '''
+        with self.lock:
+            seq, store = self.stores.get(level, (None, None))
+            last = self.get_seq()
+            if store is not None and last != seq:
+                first = self.conn.execute('SELECT MIN(seq) FROM changes').fetchone()[0]
+                if first is None or first > seq + 1:
+                    store = None
+
+            if store is None:
+                store = ColumnStore(self.get_level_fields(level), self.get_rows(level))
+            elif last != seq:
+                rows = self.conn.execute('SELECT key FROM changes WHERE seq > ? AND '
+                                         'seq <= ? AND level = ?',
+                                         (seq, last, level)).fetchall()
+                keys = set([row[0] for row in rows])
+                if len(keys) > 0:
+                    store.delete(keys)
+                    store.append(self.get_rows(level, keys))
+                if store.deleted > len(store):
+                    store = store.compact()
+
+            self.stores[level] = (last, store)
+            return store
+
+
+    def get_seq(self):
+        '''return the number of the last change to the index'''
+        row = self.conn.execute('SELECT seq FROM sqlite_sequence WHERE '
+                                'name = \'changes\'').fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+
+    def get_rows(self, level, keys=None):
+        '''get_rows returns the rows for a ColumnStore of a level, for all records
+        or the records with the keys given, sorted by key
+        :param level: the query level, one of PATIENT, STUDY, SERIES or IMAGE
+        :param keys: the unique keys of the records (paths for IMAGE)
+        '''
+        table = 'instances'
+        key = 'path'
+        if level != 'IMAGE':
+            table = levels[level]['table']
+            key = '"%s"' %(levels[level]['key'])
+
+        names = ", ".join(['"%s"' %(field) for field in self.get_level_fields(level)])
+        if keys is None:
+            return self.conn.execute('SELECT %s, %s FROM %s ORDER BY %s'
+                                     %(key, names, table, key)).fetchall()
+
+        rows = []
+        for chunk in get_chunks(list(keys)):
+            rows += self.conn.execute('SELECT %s, %s FROM %s WHERE %s IN (%s)'
+                                      %(key, names, table, key,
+                                        ", ".join(['?'] * len(chunk))), chunk).fetchall()
+        return sorted(rows)
+
+
+    def find(self, query, fields, level='IMAGE'):
+        '''find returns the paths of indexed files (or the unique keys of the
+        records at a higher level) that match a query dataset (see find_rows)'''
+        store, rows, unsupported = self.find_rows(query, fields, level=level)
+        return [store.paths[row] for row in rows]
+
+
+    def find_rows(self, query, fields, level='IMAGE'):
+        '''find_rows returns the rows of the ColumnStore that match a query dataset
+        for the fields given. A field that is empty or "*" matches anything
+        (universal), a list of uids (separated by \\) matches any of them, a date
+        or time with - is a range, a value with * or ? is a wildcard match, and
+        other values must match exactly. A record without a value for a field is
+        not excluded by it, but at least one of the queried fields must be present
+        (and match), unless all fields are universal (see QueryPlan). A field that
+        isn't kept at the level is matched by the records above it (see
+        get_level_value), and one that can't be matched is unsupported.
+        :param query: the query dataset
+        :param fields: the fields of the query to match (see get_dataset_query)
+        :param level: the query level, one of PATIENT, STUDY, SERIES or IMAGE
+        :returns (store, rows, unsupported): the ColumnStore, the indices of
+                  matching rows, and the fields that couldn't be matched
+        '''
+        store = self.columns(level)
+        values = [self.get_level_value(store, level, field,
+                                       to_index_value(query.get(field)))
+                  for field in fields]
+        plan = self.planner.plan(values, level, store)
+        return store, plan.execute(store), plan.unsupported
+
+
+    def get_level_value(self, store, level, field, value):
+        '''get_level_value returns the (field, value, kind) to plan for a query
+        key at a level (see QueryPlanner.plan). A field of the store is matched
+        as is, an alias (see level_aliases) matches any of the values of its
+        field, and a field of a record above the level (e.g., the PatientName of
+        a series) matches the unique keys of the records above that match it. The
+        field is returned unchanged if none of these apply (it's unsupported).
+        :param store: the ColumnStore of the level
+        :param level: the query level
+        :param field: the keyword of the query key
+        :param value: the value of the key (see to_index_value)
+        '''
+        kind = get_kind(field, value)
+        if kind == 'universal' or field in store.columns:
+            return (field, value, kind)
+
+        alias = level_aliases.get(level, {}).get(field)
+        if alias is not None and alias in store.columns:
+            return (alias, (kind, value), 'multi')
+
+        # The nearest level above with the field, that the store has the key of
+        parents = ['SERIES', 'STUDY', 'PATIENT']
+        if level in parents:
+            parents = parents[parents.index(level) + 1:]
+        for parent in parents:
+            key = levels[parent]['key']
+            if key not in store.columns or not self.has_level(parent):
+                continue
+            parent_store = self.columns(parent)
+            if field not in parent_store.columns:
+                continue
+            plan = QueryPlan([Condition(field, kind, value)])
+            keys = [parent_store.paths[row] for row in plan.execute(parent_store)]
+            return (key, keys, 'keys')
+
+        return (field, value, kind)
+
+
+    def get_instances(self, level, keys):
+        '''get_instances returns the (sorted) paths of the instances of records
+        at a query level, e.g. all files of a list of studies.
+        :param level: the query level, one of PATIENT, STUDY, SERIES or IMAGE
+        :param keys: the unique keys of the records (paths for IMAGE)
+        '''
+        if level == 'IMAGE':
+            return sorted(keys)
+
+        key = levels[level]['key']
+        paths = []
+        with self.lock:
+            for chunk in get_chunks(list(keys)):
+                rows = self.conn.execute('SELECT path FROM instances WHERE "%s" IN (%s)'
+                                         %(key, ", ".join(['?'] * len(chunk))),
+                                         chunk).fetchall()
+                paths += [row[0] for row in rows]
+        return sorted(paths)
+
+
+    def get_dataset(self, store, row, keys):
+        '''get_dataset returns a dataset with the keys (keywords) requested for a
+        row of the column store, built from the index without reading the file.
+        Keys that are not kept for the level (or have no value) are returned empty.
+        :param store: the ColumnStore that the row belongs to
+        :param row: the index of the row
+        :param keys: the keywords to include in the dataset
+        '''
+        ds = Dataset()
+        for key in keys:
+            value = None
+            if key in store.columns:
+                value = store.value(key, row)
+            setattr(ds, key, from_index_value(key, value))
+        return ds
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class IndexPublisher:
+    '''An IndexPublisher adds stored instances to a MetadataIndex as they are
+    written, from the dataset that was received (the file isn't read again).
+    The rows of the instances are kept until a batch is full, or the first
+    instance of a batch has waited for interval seconds, and then inserted and
+    committed at once, so that the write transaction is short (other processes
+    using the index file wait for it). A Find over the same index then sees them
+    without walking the storage folder.
+    '''
+
+    def __init__(self, index, batch_size=100, interval=1.0):
+        '''
+        :param index: the MetadataIndex to publish to
+        :param batch_size: the number of instances to commit at once
+        :param interval: the maximum seconds an instance waits to be committed
+        '''
+        self.index = index
+        self.batch_size = batch_size
+        self.interval = interval
+        self.rows = []
+        self.batch_start = None
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def publish(self, path, dataset):
+        '''add the dataset stored at path to the batch, and commit the batch if
+        it's full. A failure is logged, the file is still stored.
+        '''
+        try:
+            row = self.index.get_row(path, dataset)
+        except Exception as error:
+            bot.warning("Cannot index %s: %s", path, error)
+            return
+
+        with self.lock:
+            if self.batch_start is None:
+                self.batch_start = time.time()
+            self.rows.append(row)
+            if len(self.rows) >= self.batch_size:
+                self.flush()
+
+
+    def flush(self):
+        '''insert and commit the instances published since the last commit'''
+        with self.lock:
+            rows = self.rows
+            if len(rows) == 0:
+                return
+            self.rows = []
+            self.batch_start = None
+            try:
+                self.index.insert(rows)
+            except Exception as error:
+                bot.warning("Cannot index %s stored instances: %s", len(rows), error)
+                return
+            bot.debug("Committed %s stored instances to the index", len(rows))
+
+
+    def run(self):
+        '''commit a batch that has waited too long to fill'''
+        while not self.stopped.wait(self.interval / 2.0):
+            with self.lock:
+                if self.batch_start is not None and \
+                   time.time() - self.batch_start >= self.interval:
+                    self.flush()
+
+
+    def stop(self):
+        '''commit any pending instances, and stop the background commits'''
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+
+
+def get_chunks(values, size=500):
+    '''get_chunks splits a list of values into chunks, to stay under the
+    limit of sqlite variables in a single statement'''
+    return [values[ii:ii + size] for ii in range(0, len(values), size)]
+
+
+def get_stat(path):
+    '''get_stat returns the (size, mtime) used to detect a changed file, or
+    None if the file doesn't exist.
+    '''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime)
@@ -0,0 +1,146 @@
+'''
+
+journal.py: record the outcome of each instance of a bulk send, so that an
+            interrupted send can be resumed
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+from node_dcm.logman import bot
+import json
+import os
+import sys
+import threading
+import time
+
+
+# How a send uses its journal: send everything, skip instances that were sent,
+# or send only the instances that failed
+journal_modes = [None, 'resume', 'retry']
+
+
+class SendJournal:
+    '''A SendJournal is an append-only file with a line (json) for each outcome
+    of sending an instance, keyed by its SOPInstanceUID. When the journal is
+    opened again, the last outcome of each instance is loaded, so that a send
+    can skip the instances already sent (resume), or send only the ones that
+    failed (retry). The last outcome of each file is kept too, with its size and
+    modification time, so that resume can skip a file that was sent without
+    reading it. A line cut short by an interruption is ignored.
+    '''
+
+    # The results of an instance that was sent
+    sent_results = ['completed', 'warning']
+
+    def __init__(self, journal_file, mode=None):
+        '''
+        :param journal_file: the file to append to (created if it doesn't exist)
+        :param mode: None (send everything), resume (skip instances that were
+                     sent), or retry (send only the instances that failed)
+        '''
+        if mode not in journal_modes:
+            bot.error("mode must be one of %s" %(journal_modes))
+            sys.exit(1)
+
+        self.journal_file = journal_file
+        self.mode = mode
+        self.outcomes = dict()
+        self.files = dict()
+        self.lock = threading.Lock()
+        self.load()
+        self.filey = open(journal_file, 'a')
+
+        # A partial last line is ended, so the next outcome isn't joined to it
+        if self.filey.tell() > 0:
+            with open(journal_file, 'rb') as filey:
+                filey.seek(-1, os.SEEK_END)
+                if filey.read(1) != b'\n':
+                    self.filey.write('\n')
+
+
+    def load(self):
+        '''load the last outcome of each instance from the journal file'''
+        if not os.path.exists(self.journal_file):
+            return
+
+        with open(self.journal_file, 'r') as filey:
+            for line in filey:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.outcomes[entry['uid']] = entry['result']
+                if entry.get('path') is not None:
+                    self.files[entry['path']] = (entry['result'], entry.get('size'),
+                                                 entry.get('mtime'))
+
+        bot.debug("Loaded %s outcomes from %s" %(len(self.outcomes), self.journal_file))
+
+
+    def should_send(self, uid):
+        '''return True if an instance should be sent, in the mode of the journal
+        :param uid: the SOPInstanceUID of the instance
+        '''
+        outcome = self.outcomes.get(uid)
+        if self.mode == 'resume':
+            return outcome not in self.sent_results
+        if self.mode == 'retry':
+            return outcome == 'failed'
+        return True
+
+
+    def was_sent(self, path, stat=None):
+        '''return True if a send that resumes can skip a file (without reading
+        it), because it was sent from the same path. If a stat is given, and one
+        was recorded for the file, they must also match.
+        :param path: the path of the file
+        :param stat: the (size, mtime) of the file now (see node_dcm.cache.get_file_stat)
+        '''
+        if self.mode != 'resume':
+            return False
+        outcome = self.files.get(path)
+        if outcome is None or outcome[0] not in self.sent_results:
+            return False
+        if stat is None or outcome[1] is None:
+            return True
+        return tuple(outcome[1:]) == tuple(stat[:2])
+
+
+    def record(self, uid, path, result, stat=None):
+        '''append the outcome of sending an instance to the journal
+        :param uid: the SOPInstanceUID of the instance
+        :param path: the file the instance was sent from
+        :param result: completed, warning or failed
+        :param stat: the (size, mtime) of the file when it was read (default None)
+        '''
+        entry = {'uid': uid, 'path': path, 'result': result, 'time': time.time()}
+        if stat is not None:
+            entry['size'], entry['mtime'] = stat[0], stat[1]
+        with self.lock:
+            self.outcomes[uid] = result
+            self.files[path] = (result, entry.get('size'), entry.get('mtime'))
+            self.filey.write(json.dumps(entry) + '\n')
+            self.filey.flush()
+
+
+    def close(self):
+        with self.lock:
+            self.filey.close()
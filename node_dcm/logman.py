@@ -53,10 +53,32 @@ The following levels are only to stdout
 The following levels do nothing (quiet)
 
 0
+
+A message can be given with arguments, as bot.debug('Stored %s', filename), and
+is only formatted if its level is emitted, so disabled messages cost a single
+comparison. The most recent emitted messages are kept in a history, of at most
+NODEDCM_HISTORY messages (default 1000, 0 to keep none).
+
+Messages are written as they are emitted, unless a queue is started (see
+start_queue, or set NODEDCM_LOGQUEUE to its size), in which case they are
+written in batches by a background thread, so a slow stream doesn't hold up
+the caller. When the queue is full, messages are dropped (and counted), or
+with NODEDCM_LOGPOLICY=block, the caller waits. With NODEDCM_LOGFORMAT=json,
+each message is written as a line of json, with its time, level and message.
 '''
 
+from collections import deque
+import atexit
+import json
 import os
 import sys
+import threading
+import time
+
+if sys.version_info[0] < 3:
+    import Queue as queue
+else:
+    import queue
 
 ABRT = -4
 ERROR = -3
@@ -69,15 +91,31 @@ VERBOSE2 = 3
 VERBOSE3 = 4
 DEBUG = 5
 
+# The names of the levels, for the json format
+level_names = {ABRT: 'ABRT',
+               ERROR: 'ERROR',
+               WARNING: 'WARNING',
+               LOG: 'LOG',
+               INFO: 'INFO',
+               VERBOSE: 'VERBOSE',
+               VERBOSE2: 'VERBOSE2',
+               VERBOSE3: 'VERBOSE3',
+               DEBUG: 'DEBUG'}
+
+# What to do with a message when the queue is full, and the output formats
+log_policies = ['drop', 'block']
+log_formats = ['text', 'json']
+
 
 class NodedcmMessage:
 
     def __init__(self,MESSAGELEVEL=None):
         self.level = get_logging_level()
-        self.history = []
+        self.history = deque(maxlen=get_history_size())
         self.errorStream = sys.stderr
         self.outputStream = sys.stdout
-        self.colorize = self.useColor()
+        self.format = get_log_format()
+        self.colorize = self.format == 'text' and self.useColor()
         self.colors = {ABRT:"\033[31m",    # dark red
                        ERROR: "\033[91m",  # red
                        WARNING:"\033[93m", # dark yellow
@@ -85,6 +123,18 @@ class NodedcmMessage:
                        DEBUG:"\033[36m",   # cyan
                        'OFF':"\033[0m"}    # end sequence
 
+        # Queued messages, written by a background thread (see start_queue)
+        self.queue = None
+        self.thread = None
+        self.policy = 'drop'
+        self.dropped = 0
+
+        # Guards the count of dropped messages, and the history
+        self.lock = threading.Lock()
+        size = get_queue_size()
+        if size > 0:
+            self.start_queue(size, policy=get_queue_policy())
+
 
     # Colors --------------------------------------------
 
@@ -147,13 +197,43 @@ class NodedcmMessage:
         return False
 
 
-    def emit(self,level,message,prefix=None):
+    def emit(self,level,message,prefix=None,args=None):
         '''emit is the main function to print the message
-        optionally with a prefix
+        optionally with a prefix. Nothing is done (not even formatting)
+        for a level that isn't enabled.
         :param level: the level of the message
         :param message: the message to print
         :param prefix: a prefix for the message
+        :param args: arguments to format the message with (message % args)
         '''
+        if self.level == QUIET or level > self.level:
+            return
+
+        # Arguments are formatted now, they could change before the message is written
+        if args:
+            message = message % args
+
+        messages = self.queue
+        if messages is None:
+            self.output([(level, message, prefix, time.time())])
+        elif self.policy == 'block':
+            messages.put((level, message, prefix, time.time()))
+        else:
+            try:
+                messages.put_nowait((level, message, prefix, time.time()))
+            except queue.Full:
+                with self.lock:
+                    self.dropped += 1
+
+
+    def render(self,level,message,prefix,created):
+        '''render returns the line to write for a message, as text (with
+        the prefix, colored if enabled) or as json.
+        '''
+        if self.format == 'json':
+            return "%s\n" %json.dumps({'time': created,
+                                       'level': level_names.get(level, level),
+                                       'message': message.rstrip('\n')})
 
         if prefix is not None:
             prefix = self.addColor(level,"%s " %(prefix))
@@ -166,20 +246,33 @@ class NodedcmMessage:
 
         if not message.endswith('\n'):
             message = "%s\n" %message
+        return message
 
-        # If the level is quiet, only print to error
-        if self.level == QUIET:
-            pass
 
-        # Otherwise if in range print to stdout and stderr
-        elif self.isEnabledFor(level):
+    def output(self,records):
+        '''output writes a batch of messages, each (level, message, prefix, created),
+        to stderr or stdout, and keeps them in the history.
+        '''
+        errors = []
+        outputs = []
+        rendered = []
+        for level, message, prefix, created in records:
+            message = self.render(level, message, prefix, created)
+            rendered.append(message)
             if self.emitError(level):
-                self.write(self.errorStream,message)
+                errors.append(message)
             else:
-                self.write(self.outputStream,message)
+                outputs.append(message)
+
+        # Keep the most recent messages (the oldest are dropped)
+        if self.history.maxlen != 0:
+            with self.lock:
+                self.history.extend(rendered)
 
-        # Add all log messages to history
-        self.history.append(message)
+        if len(errors) > 0:
+            self.write(self.errorStream,''.join(errors))
+        if len(outputs) > 0:
+            self.write(self.outputStream,''.join(outputs))
 
 
     def write(self,stream,message):
@@ -191,13 +284,88 @@ class NodedcmMessage:
         stream.write(message)
 
 
+    # Queue ---------------------------------------------
+
+    def start_queue(self,size=10000,policy='drop',batch_size=256):
+        '''start_queue starts writing messages from a background thread. Emitted
+        messages are put in a queue, and written in batches of up to batch_size.
+        :param size: the maximum number of messages waiting to be written
+        :param policy: drop (default) to drop messages when the queue is full, or
+                       block to wait for room
+        :param batch_size: the maximum number of messages to write at once
+        '''
+        if policy not in log_policies:
+            self.error("policy must be one of %s", log_policies)
+            sys.exit(1)
+
+        self.stop_queue()
+        self.policy = policy
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=size)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def run(self):
+        '''the loop of the background thread, a record of None stops it'''
+        messages = self.queue
+        while True:
+            records = [messages.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(messages.get_nowait())
+                except queue.Empty:
+                    break
+
+            done = len(records)
+            stop = None in records
+            records = [x for x in records if x is not None]
+            with self.lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped > 0:
+                records.append((WARNING, "Dropped %s log messages, the queue was "
+                                         "full" %(dropped), 'WARNING', time.time()))
+            try:
+                self.output(records)
+                for stream in [self.errorStream, self.outputStream]:
+                    if hasattr(stream, 'flush'):
+                        stream.flush()
+            except Exception:
+                pass
+            finally:
+                for ii in range(done):
+                    messages.task_done()
+            if stop:
+                return
+
+
+    def flush(self):
+        '''wait for the queued messages to be written'''
+        if self.queue is not None:
+            self.queue.join()
+
+
+    def stop_queue(self):
+        '''write the queued messages, and go back to writing them as emitted'''
+        if self.queue is None:
+            return
+        messages, thread = self.queue, self.thread
+        self.queue = None
+        self.thread = None
+        messages.put(None)
+        thread.join()
+
+
     def get_logs(self,join_newline=True):
         ''''get_logs will return the complete history, joined by newline
         (default) or as is.
         '''
+        with self.lock:
+            history = list(self.history)
         if join_newline:
-            return '\n'.join(self.history)
-        return self.history
+            return '\n'.join(history)
+        return history
         
 
 
@@ -242,35 +410,35 @@ class NodedcmMessage:
 
 
 
-    def abort(self,message):
-        self.emit(ABRT,message,'ABRT')        
+    def abort(self,message,*args):
+        self.emit(ABRT,message,'ABRT',args)
 
-    def error(self,message):
-        self.emit(ERROR,message,'ERROR')        
+    def error(self,message,*args):
+        self.emit(ERROR,message,'ERROR',args)
 
-    def warning(self,message):
-        self.emit(WARNING,message,'WARNING')        
+    def warning(self,message,*args):
+        self.emit(WARNING,message,'WARNING',args)
 
-    def log(self,message):
-        self.emit(LOG,message,'LOG')        
+    def log(self,message,*args):
+        self.emit(LOG,message,'LOG',args)
 
-    def info(self,message):
-        self.emit(INFO,message)        
+    def info(self,message,*args):
+        self.emit(INFO,message,args=args)
 
-    def verbose(self,message):
-        self.emit(VERBOSE,message,"VERBOSE")        
+    def verbose(self,message,*args):
+        self.emit(VERBOSE,message,"VERBOSE",args)
 
-    def verbose1(self,message):
-        self.emit(VERBOSE,message,"VERBOSE1")        
+    def verbose1(self,message,*args):
+        self.emit(VERBOSE,message,"VERBOSE1",args)
 
-    def verbose2(self,message):
-        self.emit(VERBOSE2,message,'VERBOSE2')        
+    def verbose2(self,message,*args):
+        self.emit(VERBOSE2,message,'VERBOSE2',args)
 
-    def verbose3(self,message):
-        self.emit(VERBOSE3,message,'VERBOSE3')        
+    def verbose3(self,message,*args):
+        self.emit(VERBOSE3,message,'VERBOSE3',args)
 
-    def debug(self,message):
-        self.emit(DEBUG,message,'DEBUG')        
+    def debug(self,message,*args):
+        self.emit(DEBUG,message,'DEBUG',args)
 
     def is_quiet(self):
         '''is_quiet returns true if the level is under 1
@@ -305,6 +473,40 @@ def get_logging_level():
     return int(os.environ.get("NODEDCM_MESSAGELEVEL",5))
     
 
+def get_history_size():
+    '''get_history_size returns the number of messages to keep in the history,
+    from NODEDCM_HISTORY (default 1000), where 0 keeps none.
+    '''
+    return max(0, int(os.environ.get("NODEDCM_HISTORY",1000)))
+
+
+def get_queue_size():
+    '''get_queue_size returns the size of the queue of messages to write from
+    a background thread, from NODEDCM_LOGQUEUE (default 0, no queue).
+    '''
+    return max(0, int(os.environ.get("NODEDCM_LOGQUEUE",0)))
+
+
+def get_queue_policy():
+    '''get_queue_policy returns what to do when the queue of messages is full,
+    from NODEDCM_LOGPOLICY, drop (default) or block.
+    '''
+    policy = os.environ.get("NODEDCM_LOGPOLICY",'drop').lower()
+    if policy not in log_policies:
+        return 'drop'
+    return policy
+
+
+def get_log_format():
+    '''get_log_format returns the format to write messages in, from
+    NODEDCM_LOGFORMAT, text (default) or json (a json object per line).
+    '''
+    log_format = os.environ.get("NODEDCM_LOGFORMAT",'text').lower()
+    if log_format not in log_formats:
+        return 'text'
+    return log_format
+
+
 def get_user_color_preference():
     COLORIZE = os.environ.get('NODEDCM_COLORIZE',None)
     if COLORIZE is not None:
@@ -321,3 +523,6 @@ def convert2boolean(arg):
 
 
 bot = NodedcmMessage()
+
+# Queued messages are written before exit
+atexit.register(bot.stop_queue)
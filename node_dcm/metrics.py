@@ -0,0 +1,359 @@
+'''
+
+metrics.py: count, time and size the DIMSE operations of the providers and
+            users, and serve them over http in the Prometheus text format
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+from node_dcm.logman import bot
+import inspect
+import os
+import threading
+import time
+import weakref
+
+try:
+    from http.server import (
+        BaseHTTPRequestHandler,
+        HTTPServer
+    )
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import (
+        BaseHTTPRequestHandler,
+        HTTPServer
+    )
+    from SocketServer import ThreadingMixIn
+
+
+# The upper bounds (seconds) of the latency histogram buckets
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0]
+
+# The status codes of a response that isn't the last (pending)
+pending_statuses = [0xFF00, 0xFF01]
+
+
+def is_final(status):
+    '''is_final returns True if a status (an int, a status dataset or a Status)
+    of a response is the final one, and not pending (or not a status at all)'''
+    code = getattr(status, 'Status', status)
+    if isinstance(code, int):
+        return code not in pending_statuses
+    status_type = getattr(status, 'status_type', None)
+    return status_type is not None and status_type != 'Pending'
+
+
+def get_status_result(status, get_result=None):
+    '''get_status_result returns the result of an operation from its final
+    status, completed if there is none (or no get_result to check it with)'''
+    if get_result is None or status is None:
+        return 'completed'
+    return get_result(status)
+
+
+def get_label(value):
+    '''get_label returns a value (e.g., an AE title, which can be bytes) as
+    a string to use as the value of a label'''
+    if value is None:
+        return ''
+    if isinstance(value, bytes):
+        value = value.decode('ascii', 'replace')
+    return str(value).strip()
+
+
+def get_peer(assoc=None):
+    '''get_peer returns the label of the peer of an association, as
+    AETITLE@address. Without an association, the association of the current
+    thread is used (a provider's callbacks run on the association thread).
+    '''
+    if assoc is None:
+        assoc = threading.current_thread()
+    peer = getattr(assoc, 'peer_ae', None)
+    if not isinstance(peer, dict):
+        return 'unknown'
+    return "%s@%s" %(get_label(peer.get('AET')), get_label(peer.get('Address')))
+
+
+def escape(value):
+    '''escape a label value for the Prometheus text format'''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    return '{%s}' %(','.join(['%s="%s"' %(name, escape(value))
+                              for name, value in zip(names, values)]))
+
+
+class Metrics:
+    '''Metrics keeps the number (by result), bytes and latency of the DIMSE
+    operations of each AE, by the operation (e.g., C-STORE), the role of the AE
+    (scp or scu), its title and the peer. The associations that are active are
+    counted (by AE and peer) from the registered AEs when the metrics are read.
+    An operation is identified by its labels, a tuple from get_labels.
+    '''
+
+    label_names = ['operation', 'role', 'ae', 'peer']
+
+    def __init__(self):
+        self.operations = dict()
+        self.bytes = dict()
+        self.latencies = dict()
+        self.aes = []
+        self.lock = threading.Lock()
+
+
+    def get_labels(self, operation, role, ae_title, peer=None):
+        '''get_labels returns the labels of an operation, for the peer of the
+        current thread if no peer is given (see get_peer)
+        :param operation: the DIMSE operation, e.g., C-FIND
+        :param role: scp (handled by a provider) or scu (requested by a user)
+        :param ae_title: the title of the AE of the provider or user
+        :param peer: the label of the peer
+        '''
+        if peer is None:
+            peer = get_peer()
+        return (operation, role, get_label(ae_title), peer)
+
+
+    def observe(self, labels, seconds, result='completed'):
+        '''record a finished operation, with its duration and result (completed,
+        warning, failed or cancelled)'''
+        with self.lock:
+            key = labels + (result,)
+            self.operations[key] = self.operations.get(key, 0) + 1
+
+            latency = self.latencies.get(labels)
+            if latency is None:
+                latency = self.latencies[labels] = [0] * len(latency_buckets) + [0.0, 0]
+            for ii, bound in enumerate(latency_buckets):
+                if seconds <= bound:
+                    latency[ii] += 1
+                    break
+            latency[-2] += seconds
+            latency[-1] += 1
+
+
+    def add_bytes(self, labels, size):
+        '''record the bytes of a dataset sent or received by an operation'''
+        with self.lock:
+            self.bytes[labels] = self.bytes.get(labels, 0) + size
+
+
+    def register(self, ae):
+        '''register an ae, to count its active associations'''
+        with self.lock:
+            self.aes = [x for x in self.aes if x() is not None]
+            if ae not in [x() for x in self.aes]:
+                self.aes.append(weakref.ref(ae))
+
+
+    def get_associations(self):
+        '''return the number of active associations, by (ae title, peer)'''
+        with self.lock:
+            aes = [x() for x in self.aes]
+
+        counts = dict()
+        for ae in aes:
+            if ae is None:
+                continue
+            title = get_label(getattr(ae, 'ae_title', None))
+            for assoc in list(getattr(ae, 'active_associations', None) or []):
+                key = (title, get_peer(assoc))
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+
+    def watch(self, labels, responses, get_result=None, start=None):
+        '''watch yields the responses of an operation (e.g., the pending and final
+        responses of a C-FIND) and records the operation when they are finished,
+        with the result of the last status that isn't pending, or as cancelled if
+        the responses weren't all taken.
+        :param labels: the labels of the operation (see get_labels)
+        :param responses: an iterable of responses, each (status, dataset)
+        :param get_result: a function returning the result of a status
+        :param start: when the operation started (default when iteration starts)
+        '''
+        if start is None:
+            start = time.time()
+        status = None
+        try:
+            for response in responses:
+                if isinstance(response, tuple) and is_final(response[0]):
+                    status = response[0]
+                yield response
+
+        # The responses weren't all taken (e.g., the association was aborted)
+        except GeneratorExit:
+            self.observe(labels, time.time() - start, 'cancelled')
+            raise
+        except:
+            self.observe(labels, time.time() - start, 'failed')
+            raise
+        self.observe(labels, time.time() - start, get_status_result(status, get_result))
+
+
+    def timed(self, operation, role, ae_title, callback, get_result=None):
+        '''timed wraps a callback (of a provider) to record each call as an
+        operation. A callback that returns a generator (C-FIND, C-GET, C-MOVE)
+        is timed until the generator is finished (see watch).
+        :param operation: the DIMSE operation of the callback
+        :param role: scp (default for callbacks) or scu
+        :param ae_title: the title of the AE of the callback
+        :param callback: the function to wrap
+        :param get_result: a function returning the result of a status (default
+                           completed, unless the callback raises an error)
+        '''
+        def wrapper(*args, **kwargs):
+            labels = self.get_labels(operation, role, ae_title)
+            start = time.time()
+            try:
+                response = callback(*args, **kwargs)
+            except:
+                self.observe(labels, time.time() - start, 'failed')
+                raise
+
+            if inspect.isgenerator(response):
+                return self.watch(labels, response, get_result, start=start)
+            self.observe(labels, time.time() - start, get_status_result(response, get_result))
+            return response
+
+        return wrapper
+
+
+    def render(self):
+        '''render returns the metrics in the Prometheus text format'''
+        with self.lock:
+            operations = sorted(self.operations.items())
+            sizes = sorted(self.bytes.items())
+            latencies = sorted([(key, list(value)) for key, value in self.latencies.items()])
+        associations = sorted(self.get_associations().items())
+
+        lines = ['# HELP nodedcm_operations_total DIMSE operations, by result',
+                 '# TYPE nodedcm_operations_total counter']
+        for key, count in operations:
+            lines.append('nodedcm_operations_total%s %s' %(format_labels(self.label_names +
+                                                                         ['result'], key),
+                                                           count))
+
+        lines += ['# HELP nodedcm_bytes_total Bytes of the datasets of DIMSE operations',
+                  '# TYPE nodedcm_bytes_total counter']
+        for key, size in sizes:
+            lines.append('nodedcm_bytes_total%s %s' %(format_labels(self.label_names, key),
+                                                      size))
+
+        lines += ['# HELP nodedcm_operation_seconds The duration of DIMSE operations',
+                  '# TYPE nodedcm_operation_seconds histogram']
+        for key, latency in latencies:
+            cumulative = 0
+            for bound, count in zip(latency_buckets, latency):
+                cumulative += count
+                labels = format_labels(self.label_names + ['le'], key + (str(bound),))
+                lines.append('nodedcm_operation_seconds_bucket%s %s' %(labels, cumulative))
+            labels = format_labels(self.label_names + ['le'], key + ('+Inf',))
+            lines.append('nodedcm_operation_seconds_bucket%s %s' %(labels, latency[-1]))
+            labels = format_labels(self.label_names, key)
+            lines.append('nodedcm_operation_seconds_sum%s %s' %(labels, repr(latency[-2])))
+            lines.append('nodedcm_operation_seconds_count%s %s' %(labels, latency[-1]))
+
+        lines += ['# HELP nodedcm_active_associations Associations that are active',
+                  '# TYPE nodedcm_active_associations gauge']
+        for key, count in associations:
+            lines.append('nodedcm_active_associations%s %s' %(format_labels(['ae', 'peer'], key),
+                                                              count))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''answer a GET of /metrics with the metrics of the server'''
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        bot.debug("metrics %s", format %args)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    '''A MetricsServer serves Metrics over http from a background thread'''
+
+    daemon_threads = True
+
+    def __init__(self, metrics, port, address='127.0.0.1'):
+        '''
+        :param metrics: the Metrics to serve
+        :param port: the port to listen on
+        :param address: the address to listen on (default local only)
+        '''
+        HTTPServer.__init__(self, (address, port), MetricsHandler)
+        self.metrics = metrics
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+# The metrics of this process, shared by all providers and users
+metrics = Metrics()
+
+# The servers that are started, by (address, port)
+servers = dict()
+servers_lock = threading.Lock()
+
+
+def start_metrics(port=None, address=None):
+    '''start_metrics starts serving the metrics on a port, once for each port.
+    If no port is given, it is taken from the environment (NODEDCM_METRICS_PORT),
+    and if that isn't set either, nothing is served and None is returned.
+    :param port: the port to serve the metrics on
+    :param address: the address to listen on (default NODEDCM_METRICS_ADDRESS,
+                    or 127.0.0.1)
+    '''
+    if port is None:
+        port = os.environ.get('NODEDCM_METRICS_PORT')
+    if port is None:
+        return None
+    if address is None:
+        address = os.environ.get('NODEDCM_METRICS_ADDRESS', '127.0.0.1')
+
+    key = (address, int(port))
+    with servers_lock:
+        if key not in servers:
+            try:
+                servers[key] = MetricsServer(metrics, key[1], address=address)
+            except Exception as error:
+                bot.warning("Cannot serve metrics on %s:%s: %s", address, port, error)
+                return None
+            bot.debug("Serving metrics on http://%s:%s/metrics", address, port)
+        return servers[key]
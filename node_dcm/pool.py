@@ -0,0 +1,140 @@
+'''
+
+pool.py: keep established associations with a peer, to reuse them instead
+         of negotiating a new association for each request
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+from node_dcm.logman import bot
+import threading
+import time
+
+
+def get_contexts(ae):
+    '''get_contexts returns the presentation contexts an ae requests as an
+    association, as a tuple of (abstract syntax, (transfer syntaxes))
+    '''
+    contexts = getattr(ae, 'presentation_contexts_scu', None) or []
+    return tuple([(str(context.AbstractSyntax),
+                   tuple([str(x) for x in context.TransferSyntax]))
+                  for context in contexts])
+
+
+class AssociationPool:
+    '''An AssociationPool holds idle (established) associations, by a key of
+    the peer and the requested presentation contexts, and hands them out again
+    to a request with the same key. An association that has been idle longer
+    than idle_timeout, or that the peer has closed, is not handed out, and idle
+    associations are released in the background once they time out.
+    '''
+
+    def __init__(self, idle_timeout=30, max_idle=4):
+        '''
+        :param idle_timeout: seconds to keep an idle association (0 to not keep any)
+        :param max_idle: the maximum idle associations to keep for a key
+        '''
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.idle = dict()
+        self.lock = threading.Lock()
+        self.reaper = None
+
+
+    def get_key(self, address, port, name, ae, pdu_max=None):
+        '''return the key of an association with a peer, from an ae'''
+        return (address, port, name, pdu_max, get_contexts(ae))
+
+
+    def acquire(self, key, connect):
+        '''acquire returns an idle association for key, or a new one from connect
+        :param key: the key of the association (see get_key)
+        :param connect: a function that returns a new association
+        '''
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while len(idle) > 0:
+                assoc, since = idle.pop()
+                if assoc.is_established and time.time() - since < self.idle_timeout:
+                    bot.debug("Reusing association with [%s] %s:%s", key[2],
+                                                                    key[0],
+                                                                    key[1])
+                    return assoc
+                self.close(assoc)
+        return connect()
+
+
+    def put(self, key, assoc):
+        '''put returns an association to the pool when a request is done with it'''
+        if not assoc.is_established:
+            return
+
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if self.idle_timeout <= 0 or len(idle) >= self.max_idle:
+                self.close(assoc)
+                return
+            idle.append((assoc, time.time()))
+
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self.reap)
+                self.reaper.daemon = True
+                self.reaper.start()
+
+
+    def reap(self):
+        '''release the idle associations that timed out, until none are left'''
+        while True:
+            time.sleep(max(self.idle_timeout / 2.0, 0.1))
+            with self.lock:
+                now = time.time()
+                for key in list(self.idle):
+                    keep = []
+                    for assoc, since in self.idle[key]:
+                        if assoc.is_established and now - since < self.idle_timeout:
+                            keep.append((assoc, since))
+                        else:
+                            self.close(assoc)
+                    if len(keep) == 0:
+                        del self.idle[key]
+                    else:
+                        self.idle[key] = keep
+
+                if len(self.idle) == 0:
+                    self.reaper = None
+                    return
+
+
+    def close(self, assoc):
+        '''release an association that is no longer kept'''
+        if assoc.is_established:
+            try:
+                assoc.release()
+            except Exception as error:
+                bot.debug("Error releasing association: %s" %(error))
+
+
+    def clear(self):
+        '''release all idle associations'''
+        with self.lock:
+            for key in list(self.idle):
+                for assoc, since in self.idle.pop(key):
+                    self.close(assoc)
@@ -25,16 +25,20 @@ SOFTWARE.
 
 from node_dcm.logman import bot
 import os
+import sys
 import time
 
-from pydicom import read_file
-from pydicom.dataset import Dataset
+from pydicom.dataset import (
+    Dataset,
+    FileDataset
+)
 
 from pynetdicom3 import (
     AE, 
     VerificationSOPClass,
     QueryRetrieveSOPClassList, 
-    StorageSOPClassList
+    StorageSOPClassList,
+    pynetdicom_uid_prefix
 )
 
 from pynetdicom3.sop_class import Status
@@ -50,7 +54,30 @@ from node_dcm.status import (
 
 
 from node_dcm.base import BaseSCP
-from node_dcm.utils import get_dicom_files
+from node_dcm.cache import get_cache
+from node_dcm.index import (
+    IndexPublisher,
+    MetadataIndex,
+    level_keys,
+    searchable,
+    to_index_value
+)
+from node_dcm.metrics import metrics
+from node_dcm.query import get_kind
+from node_dcm.reader import (
+    PREFETCH_BYTES,
+    Prefetcher,
+    read_dataset
+)
+from node_dcm.storage import (
+    StorageLayout,
+    WriterPool,
+    atomic_write,
+    write_passthrough
+)
+from node_dcm.transfer import get_size
+from node_dcm.utils import find_dicoms
+from node_dcm.watcher import ChangeWatcher
 
 class Echo(BaseSCP):
     '''A threaded verification SCP used for testing'''
@@ -134,7 +161,9 @@ class Store(BaseSCP):
 
     def __init__(self, output_dir,port=11112,name="STORESCP",prefer_uncompr=True,prefer_little=False,
                        prefer_big=False, implicit=False, timeout=None, dimse_timeout=None,
-                       acse_timeout=60, pdu_max=16384, start=False, store=True):
+                       acse_timeout=60, pdu_max=16384, start=False, store=True, writers=0,
+                       queue_size=1000, fsync=None, passthrough=False, layout='flat',
+                       index=None, index_batch=100, write_timeout=60):
 
         '''
         :param port: the port to use, default is 11112.
@@ -150,11 +179,46 @@ class Store(BaseSCP):
         :param pdu_max: set max receive pdu to n bytes (4096..131072) default 16382
         :param start: if True, start the ae.
         :param store: store the data when it is received (default True)
+        :param writers: number of background writer threads, if 0 (default) the
+                        data is written by the association thread. Either way, the
+                        C-STORE is answered once the data is written
+        :param queue_size: the maximum number of datasets waiting to be written, when
+                           full the C-STORE is refused (out of resources)
+        :param fsync: None (default), 'each' or 'group' (see storage.WriterPool)
+        :param passthrough: write datasets in the transfer syntax they were received
+                            in, without decoding them (default False)
+        :param layout: how files are organized in output_dir: flat (default), hashed
+                       (folders by hash of the SOPInstanceUID) or hierarchy
+                       (PatientID/StudyInstanceUID/SeriesInstanceUID folders)
+        :param index: a MetadataIndex (or the sqlite file of one) to add stored
+                      instances to, e.g. the index of a Find over output_dir
+        :param index_batch: the number of stored instances to commit to the index
+                            at once (default 100)
+        :param write_timeout: seconds to wait for a background write to be flushed
+                              (with fsync) before failing the C-STORE, and cancelling
+                              the write if it isn't in place yet (default 60)
         ''' 
 
         self.port = port
         self.store = store
+        self.passthrough = passthrough
         self.set_output(output_dir)
+        self.layout = StorageLayout(self.output_dir, layout=layout)
+
+        # Stored instances are published to the index (in batches) as they are written
+        self.publisher = None
+        if index is not None:
+            if not isinstance(index, MetadataIndex):
+                index = MetadataIndex(index)
+            self.index = index
+            self.publisher = IndexPublisher(index, batch_size=index_batch)
+
+        self.writers = None
+        self.write_timeout = write_timeout
+        if writers > 0:
+            self.writers = WriterPool(writers=writers,
+                                      queue_size=queue_size,
+                                      fsync=fsync)
 
         # Update preferences
         self.update_transfer_syntax(prefer_uncompr=prefer_uncompr,
@@ -173,7 +237,7 @@ class Store(BaseSCP):
 
         BaseSCP.__init__(self,ae=ae)
 
-        self.ae.maximum_pdu_size = max_pdu
+        self.ae.maximum_pdu_size = pdu_max
         self.ae.network_timeout = timeout
         self.ae.acse_timeout = acse_timeout
         self.ae.dimse_timeout = dimse_timeout
@@ -183,6 +247,15 @@ class Store(BaseSCP):
             self.run()
 
 
+    def stop(self):
+        '''Stop the SCP thread, after writing (and indexing) any queued datasets'''
+        BaseSCP.stop(self)
+        if self.writers is not None:
+            self.writers.stop()
+        if self.publisher is not None:
+            self.publisher.stop()
+
+
     def set_output(self,output_dir):
         '''set output will test and set the output directory. It must be read/writable
         '''
@@ -223,28 +296,34 @@ class Store(BaseSCP):
         except:
             pass
 
-        filename = '{0!s}.{1!s}'.format(mode_prefix, dataset.SOPInstanceUID)
-        bot.info('Storing DICOM file: {0!s}'.format(filename))
-
-        if os.path.exists(filename):
-            bot.warning('DICOM file already exists, overwriting')
-
-        meta = Dataset()
-        meta.MediaStorageSOPClassUID = dataset.SOPClassUID
-        meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
-        meta.ImplementationClassUID = pynetdicom_uid_prefix
-
-        ds = FileDataset(filename, {}, file_meta=meta, preamble=b"\0" * 128)
-        ds.update(dataset)
-
-        ds.is_little_endian = True
-        ds.is_implicit_VR = True
+        filename = '{0!s}.{1!s}.dcm'.format(mode_prefix, dataset.SOPInstanceUID)
+        bot.info('Storing DICOM file: %s', filename)
 
         if self.store is True:
+            filename = self.layout.get_path(filename, dataset)
+
+            # With writers, the dataset is written in the background. Without fsync
+            # the store is acknowledged once queued, otherwise once flushed to disk
+            labels = metrics.get_labels('C-STORE', 'scp', self.ae.ae_title)
+            if self.writers is not None:
+                job = self.writers.submit(self.write_dataset, filename, dataset, labels)
+                if job is None:
+                    return 0xA700 # Failed - Out of Resources
+                if self.writers.fsync is None:
+                    return 0x0000 # Success
+
+                # A refused store must not be stored after all (e.g. again on retry)
+                if not job.wait(self.write_timeout):
+                    if job.done.is_set() or not job.cancel():
+                        bot.error("Could not write %s: %s", filename, job.error or 'timed out')
+                    else:
+                        bot.error("Could not write %s in %ss, cancelled", filename,
+                                                                         self.write_timeout)
+                    return 0xA700 # Failed - Out of Resources
+                return 0x0000 # Success
 
-            filename = os.path.join(self.output_dir, filename)
             try:
-                ds.save_as(filename)
+                self.write_dataset(filename, dataset, labels)
 
             except IOError:
                 bot.error('Could not write file to specified directory:')
@@ -261,8 +340,201 @@ class Store(BaseSCP):
         return 0x0000 # Success
 
 
+    def write_dataset(self, filename, dataset, labels=None, job=None):
+        '''write a received dataset to filename as little endian implicit VR, or
+        as received if passthrough is set, returning the filename written. The
+        file is written to a temporary file first, and renamed when complete,
+        and then published to the index (if there is one).
+        :param labels: the labels of the C-STORE, to record the bytes written
+        :param job: the WriteJob of a background write, None is returned (and
+                    nothing is stored) if it was cancelled
+        '''
+        self.layout.make_folder(filename)
+        if os.path.exists(filename):
+            bot.warning('DICOM file already exists, overwriting')
 
-class Find(BaseSCP):
+        if self.passthrough is True:
+            written = atomic_write(filename, write_passthrough, dataset,
+                                   pynetdicom_uid_prefix, job=job)
+
+        else:
+            meta = Dataset()
+            meta.MediaStorageSOPClassUID = dataset.SOPClassUID
+            meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
+            meta.ImplementationClassUID = pynetdicom_uid_prefix
+
+            ds = FileDataset(filename, {}, file_meta=meta, preamble=b"\0" * 128)
+            ds.update(dataset)
+
+            ds.is_little_endian = True
+            ds.is_implicit_VR = True
+            written = atomic_write(filename, ds.save_as, job=job)
+
+        if written is None:
+            bot.warning("Discarded %s, its store was cancelled", filename)
+            return None
+        if labels is not None:
+            metrics.add_bytes(labels, get_size(filename))
+        if self.publisher is not None:
+            self.publisher.publish(filename, dataset)
+        return filename
+
+
+
+class IndexedSCP(BaseSCP):
+    '''An IndexedSCP answers requests from a metadata index of the dicom files in
+    a base folder (see node_dcm.index), shared by the Find, Get and Move providers.
+    '''
+
+    # The number of files (and bytes) to read ahead of sending, 0 to disable
+    prefetch = 0
+    prefetch_bytes = PREFETCH_BYTES
+
+    def init_index(self, dicom_home, index_file=None, index=None, watch=False,
+                         cache_file=None):
+        '''init_index creates (or takes) the index of dicom_home, and brings it
+        up to date with the files there.
+        :param dicom_home: the base folder of dicom files
+        :param index_file: sqlite file to persist the metadata index to (default in memory)
+        :param index: a MetadataIndex to share (e.g., with a Store), instead of index_file
+        :param watch: if True, watch dicom_home for changes (see update_index)
+        :param cache_file: sqlite file of the header cache (default NODEDCM_CACHE, or none)
+        '''
+        # Base for dicom files (we can do better here)
+        self.base = dicom_home
+
+        # Requests are answered from the index, files are only read to add them
+        if index is None:
+            index = MetadataIndex(index_file, cache=get_cache(cache_file))
+        self.index = index
+
+        # Watch for changes before the first refresh, so none are missed
+        self.watcher = None
+        if watch is True:
+            self.watcher = ChangeWatcher(self.base)
+        self.index.refresh(find_dicoms(self.base))
+
+
+    def update_index(self):
+        '''update_index refreshes the index with the files that were added, changed
+        or removed in the dicom base since the last update. Only the changed paths
+        are checked if they are known (see ChangeWatcher), otherwise the size and
+        modification time of every file is compared to the index.
+        '''
+        changed = None
+
+        # Updates can be turned on after creation, the first update is then full
+        if self.watcher is None:
+            self.watcher = ChangeWatcher(self.base)
+        else:
+            changed = self.watcher.changes()
+
+        if changed is None:
+            added, removed = self.index.refresh(find_dicoms(self.base))
+        else:
+            added, removed = self.index.refresh(changed, partial=True)
+
+        if added + removed > 0:
+            bot.debug("[%s] indexed %s, removed %s dicom files", self.ae.ae_title,
+                                                                 added,
+                                                                 removed)
+
+
+    def get_dataset_query(self,dataset):
+        '''get_dataset_query will return allowable, defined fields provided in a query dataset.
+        Datasets returned must contain all the fields specified, with the list reasonable to
+        search. Currently, I am only including the likely (human friendly) fields that would
+        be desired to search (see node_dcm.index.searchable), these are also the fields
+        kept in the metadata index.
+        '''
+        return [x for x in dataset.dir() if dataset.get(x) != '' and x in searchable]
+
+
+    def get_retrieve_paths(self, dataset):
+        '''get_retrieve_paths returns the files of the instances that a retrieve
+        (C-GET or C-MOVE) identifier matches, or None if the identifier can't be
+        matched (an unsupported level, or no unique key at or above the level to
+        match, e.g. the StudyInstanceUID of a STUDY retrieve). The records are
+        matched at the QueryRetrieveLevel, and the instances of each matching
+        record are looked up in the index, so no file is read.
+        '''
+        level = dataset.get('QueryRetrieveLevel') or 'IMAGE'
+        if not self.index.has_level(level):
+            bot.error("[%s] unsupported retrieve level %s", self.ae.ae_title, level)
+            return None
+
+        # A retrieve must say what to retrieve, it never matches everything
+        fields = self.get_dataset_query(dataset)
+        keys = [x for x in level_keys[level] if x in fields and
+                get_kind(x, to_index_value(dataset.get(x))) != 'universal']
+        if len(keys) == 0:
+            bot.error("[%s] retrieve identifier has no unique keys to match" %(self.ae.ae_title))
+            return None
+
+        matches = self.index.find(query=dataset, fields=fields, level=level)
+        return self.index.get_instances(level, matches)
+
+
+    def read_instances(self, dcm_files):
+        '''read_instances yields (path, dataset, error) for each of the files to
+        send, read ahead on a background thread if prefetch is set (see
+        node_dcm.reader.Prefetcher). The dataset is None if reading failed.
+        '''
+        if self.prefetch > 0:
+            prefetcher = Prefetcher(dcm_files,
+                                    depth=self.prefetch,
+                                    max_bytes=self.prefetch_bytes)
+            try:
+                for item in prefetcher:
+                    yield item
+            finally:
+                prefetcher.close()
+            return
+
+        for dcm in dcm_files:
+            try:
+                yield dcm, read_dataset(dcm), None
+            except Exception as error:
+                yield dcm, None, error
+
+
+    def retrieve_instances(self, dcm_files, labels=None):
+        '''retrieve_instances yields the responses of a retrieve (C-GET or C-MOVE)
+        after the number of sub-operations: a pending response with each instance
+        that can be read, for the AE to send. A file that can't be read is a
+        failed sub-operation, and if there are any, the last response is a warning
+        (or a failure, if none could be read) with the number that failed.
+        :param labels: the labels of the retrieve, to record the bytes sent
+        '''
+        failed = 0
+        for dcm, ds, error in self.read_instances(dcm_files):
+
+            if self.cancel:
+                yield self.cancel_status, None
+                return
+
+            if ds is None:
+                bot.error("Cannot read %s: %s", dcm, error)
+                failed += 1
+                continue
+            yield 0xFF00, ds
+
+            # The AE asks for the next response once the sub-operation is done
+            # (its C-STORE status isn't passed back), files read ahead don't count
+            if labels is not None:
+                metrics.add_bytes(labels, get_size(dcm))
+
+        if failed > 0:
+            ds = Dataset()
+            ds.NumberOfFailedSuboperations = failed
+            if failed == len(dcm_files):
+                yield self.out_of_resources_unable, ds
+            else:
+                yield self.warning, ds
+
+
+
+class Find(IndexedSCP):
     
     description='''The findscp application implements a Service Class
                    Provider (SCP) for the Query/Retrieve (QR) Service Class
@@ -280,9 +552,13 @@ class Find(BaseSCP):
     pending_matches = pending.matches
     pending_warning = pending.matches_warning
 
+    # Matches are read (and cancel is checked) in batches of this size
+    batch_size = 50
+
     def __init__(self, dicom_home,port=11112,name="FINDSCP",prefer_uncompr=True,prefer_little=False,
                        prefer_big=False, implicit=False, timeout=None, dimse_timeout=None,
-                       acse_timeout=60, pdu_max=16384, update_on_find=False, start=False):
+                       acse_timeout=60, pdu_max=16384, update_on_find=False, index_file=None,
+                       max_results=None, index=None, cache_file=None, start=False):
 
         '''create a FindSCP (Service Class Provider) for query/retrieve and basic workflow management
         :param dicom_home: must be the base folder of dicom files **TODO: make this more robust
@@ -297,14 +573,16 @@ class Find(BaseSCP):
         :param dimse_timeout: timeout for the DIMSE messages (default None) 
         :param pdu_max: set max receive pdu to n bytes (4096..131072) default 16382
         :param update_on_find: if True, dicoms in dicom_home are updated on the find request
+        :param index_file: sqlite file to persist the metadata index to (default in memory)
+        :param max_results: the maximum number of matches to return for a query (default None)
+        :param index: a MetadataIndex to share (e.g., with a Store), instead of index_file
+        :param cache_file: sqlite file of the header cache (default NODEDCM_CACHE, or none)
         '''
         self.port = port
-
-        # Base for dicom files (we can do better here)
-        self.base = dicom_home
-
-        self.dicoms = get_dicom_files(self.base)
+        self.max_results = max_results
         self.update_on_find = update_on_find
+        self.init_index(dicom_home, index_file=index_file, index=index,
+                        watch=update_on_find, cache_file=cache_file)
 
         # Update preferences
         self.update_transfer_syntax(prefer_uncompr=prefer_uncompr,
@@ -338,90 +616,75 @@ class Find(BaseSCP):
 
         # Should we update the dicom base for each find request (default False)
         if self.update_on_find is True:
-            bot.debug("[%s] updating dicom list to search" %(self.ae.ae_title))
-            self.dicoms = get_dicom_files(self.base)
+            bot.debug("[%s] updating dicom list to search", self.ae.ae_title)
+            self.update_index()
         
         # Variables that the user has specified in the query dataset
         fields = self.get_dataset_query(dataset)
-        bot.debug("Requested fields include %s" %(",".join(fields)))
-
-        for dcm in self.dicoms:
-
-            # Here we assume that the user wants to return
-            # datasets that match all of the query
-            ds = read_file(dcm, force=True)
-
-            is_match = self.match_dataset(query=dataset,
-                                          contender=ds,
-                                          fields=fields)
-
-            # I'm not sure if we only want to sent back a subset of information?
-            ds.RetrieveAETitle = self.ae.ae_title
-
-            if is_match:
-                bot.debug("Found matching dataset %s" %dcm)
-                yield 0xff00, ds
+        bot.debug("Requested fields include %s", ",".join(fields))
+
+        # Matching is done against the patient, study, series or image records
+        level = dataset.get('QueryRetrieveLevel')
+        if not self.index.has_level(level or 'IMAGE'):
+            bot.error("[%s] unsupported query level %s", self.ae.ae_title, level)
+            yield self.identifier_doesnt_match_sop, None
+            return
+
+        # Responses include only the keys of the query, and those the level requires
+        keys = self.get_response_keys(dataset)
+
+        # Here we assume that the user wants to return
+        # datasets that match all of the query
+        store, rows, unsupported = self.index.find_rows(query=dataset,
+                                                        fields=fields,
+                                                        level=level or 'IMAGE')
+
+        # Keys that can't be matched don't widen the matches, but each is a warning
+        status = 0xff00
+        if len(unsupported) > 0:
+            bot.warning("[%s] unsupported keys at level %s: %s", self.ae.ae_title,
+                                                                 level or 'IMAGE',
+                                                                 ",".join(unsupported))
+            status = 0xff01
+
+        if self.max_results is not None and len(rows) > self.max_results:
+            bot.warning("[%s] %s matches, returning the first %s", self.ae.ae_title,
+                                                                   len(rows),
+                                                                   self.max_results)
+            rows = rows[:self.max_results]
+
+        # Only matches are sent as pending responses, the final status is sent after
+        self.cancel = False
+        for start in range(0, len(rows), self.batch_size):
 
-            else:
-                yield self.status, None
-                
             if self.cancel:
                 yield self.matching_terminated_cancel, None
                 return
 
-            yield self.status, None
-
+            for row in rows[start:start + self.batch_size]:
 
-    def match_dataset(self,query,contender,fields=None):
-        '''match dataset will compare a contender dataset to a query, optionally with fields
-        for comparison already defined (a list of the query.dir(). If all fields defined match
-        the contender, returns True, otherwise, False.
-        '''
-        if fields is None:
-            fields = self.get_dataset_query(query)
-
-        is_match = True
-        overlapping_fields = False
-        for field in fields:
-
-            if query.get(field) == "*":
-                continue
+                # The response is built from the index, the file isn't opened
+                ds = self.index.get_dataset(store, row, keys)
+                ds.RetrieveAETitle = self.ae.ae_title
+                if level is not None:
+                    ds.QueryRetrieveLevel = level
 
-            elif query.get(field) is not None and contender.get(field) is not None:
-                overlapping_fields = True
-                if query.get(field) != contender.get(field):
-                    is_match = False
-                
-        if overlapping_fields is False:
-            is_match = False
-        return is_match
+                bot.debug("Found matching %s %s", level or 'IMAGE', store.paths[row])
+                yield status, ds
 
 
-    def get_dataset_query(self,dataset):
-        '''get_dataset_query will return allowable, defined fields provided in a query dataset.
-        Datasets returned must contain all the fields specified, with the list reasonable to
-        search. Currently, I am only including the likely (human friendly) fields that would
-        be desired to search. A more robust find/search method should be implemented.
+    def get_response_keys(self,dataset):
+        '''get_response_keys returns the keys to return for each match of a query
+        dataset: all keys in the query (return keys are usually empty), and the
+        unique keys of the query level.
         '''
-        searchable = ['Columns',
-                      'ConversionType',
-                      'ImageComments',
-                      'InstitutionName',
-                      'NameOfPhysiciansReadingStudy',
-                      'OperatorsName',
-                      'PatientID',
-                      'PatientName',
-                      'PatientSex',
-                      'ReferringPhysicianName',
-                      'Rows',
-                      'SOPClassUID',
-                      'SOPInstanceUID',
-                      'SeriesInstanceUID',
-                      'StudyDate',
-                      'StudyInstanceUID',
-                      'StudyTime']
-
-        return [x for x in dataset.dir() if dataset.get(x) != '' and x in searchable]
+        keys = [x for x in dataset.dir() if x not in ['QueryRetrieveLevel',
+                                                      'RetrieveAETitle']]
+        level = dataset.get('QueryRetrieveLevel')
+        for key in level_keys.get(level, []):
+            if key not in keys:
+                keys.append(key)
+        return keys
 
 
     def on_c_cancel_find(self):
@@ -430,7 +693,7 @@ class Find(BaseSCP):
 
 
 
-class Get(BaseSCP):
+class Get(IndexedSCP):
 
     description='''The getscp application implements a Service Class
                    Provider (SCP) for the Query/Retrieve (QR) Service Class
@@ -453,7 +716,9 @@ class Get(BaseSCP):
 
     def __init__(self, dicom_home,port=11112,name="GETSCP",prefer_uncompr=True,prefer_little=False,
                        prefer_big=False, implicit=False, timeout=None, dimse_timeout=None,
-                       acse_timeout=60, pdu_max=16384, start=False):
+                       acse_timeout=60, pdu_max=16384, update_on_retrieve=False, index_file=None,
+                       index=None, prefetch=0, prefetch_bytes=PREFETCH_BYTES, cache_file=None,
+                       start=False):
         '''
         :param dicom_home: must be the base folder of dicom files **TODO: make this more robust
         :param port: TCP/IP port number to listen on
@@ -466,15 +731,30 @@ class Get(BaseSCP):
         :param acse_timeout: timeout for ACSE messages (default 60)
         :param dimse_timeout: timeout for the DIMSE messages (default None) 
         :param pdu_max: set max receive pdu to n bytes (4096..131072) default 16382
+        :param update_on_retrieve: if True, dicoms in dicom_home are updated on the get request
+        :param index_file: sqlite file to persist the metadata index to (default in memory)
+        :param index: a MetadataIndex to share (e.g., with a Store), instead of index_file
+        :param prefetch: the number of files to read ahead while sending (default 0, off)
+        :param prefetch_bytes: the maximum bytes of files read ahead (default 64MB)
+        :param cache_file: sqlite file of the header cache (default NODEDCM_CACHE, or none)
         '''
         self.port = port
+        self.prefetch = prefetch
+        self.prefetch_bytes = prefetch_bytes
+        self.update_on_retrieve = update_on_retrieve
+        self.init_index(dicom_home, index_file=index_file, index=index,
+                        watch=update_on_retrieve, cache_file=cache_file)
 
-        self.base = dicom_home
+        # Update preferences
+        self.update_transfer_syntax(prefer_uncompr=prefer_uncompr,
+                                    prefer_little=prefer_little,
+                                    prefer_big=prefer_big,
+                                    implicit=implicit)
 
         scp_sop_class = StorageSOPClassList.copy()
         scp_sop_class.extend(QueryRetrieveSOPClassList)
 
-        ae = AE(scp_sop_class=scp_classes,
+        ae = AE(scp_sop_class=scp_sop_class,
                 transfer_syntax=self.transfer_syntax,
                 scu_sop_class=[],
                 ae_title=name,
@@ -482,7 +762,7 @@ class Get(BaseSCP):
 
         BaseSCP.__init__(self,ae=ae)
 
-        self.ae.maximum_pdu_size = max_pdu
+        self.ae.maximum_pdu_size = pdu_max
         self.ae.network_timeout = timeout
         self.ae.acse_timeout = acse_timeout
         self.ae.dimse_timeout = dimse_timeout
@@ -494,25 +774,29 @@ class Get(BaseSCP):
             self.run()
 
 
-    def on_c_get(self, patient_name, query_level):
-        '''Callback for ae.on_c_get'''
-
+    def on_c_get(self, dataset):
+        '''Callback for ae.on_c_get. The identifier is matched against the index,
+        the number of sub-operations is yielded first, followed by each matching
+        instance (only matching files are read).
+        '''
         time.sleep(self.delay)
 
-        # I think here I need to do the search/match
-        #TODO: this needs to search some metddata for files
-        dcm_files = glob("%s/*.dcm" %(self.base))
-
-        yield len(dcm_files)
+        if self.update_on_retrieve is True:
+            self.update_index()
 
-        for dcm in dcm_files:
+        dcm_files = self.get_retrieve_paths(dataset)
+        if dcm_files is None:
+            yield 0
+            yield self.identifier_doesnt_match_sop, None
+            return
 
-            if self.cancel:
-                yield self.cancel, None
-                return
+        bot.debug("[%s] %s instances to get", self.ae.ae_title, len(dcm_files))
+        yield len(dcm_files)
 
-            ds = read_file(dcm, force=True)
-            yield 0xFF00, ds
+        self.cancel = False
+        labels = metrics.get_labels('C-GET', 'scp', self.ae.ae_title)
+        for response in self.retrieve_instances(dcm_files, labels):
+            yield response
 
 
     def on_c_cancel_get(self):
@@ -523,7 +807,7 @@ class Get(BaseSCP):
 
 
 
-class Move(BaseSCP):
+class Move(IndexedSCP):
 
     description='''The movescp application implements a Service Class
                    Provider (SCP) for the Query/Retrieve (QR) Service Class 
@@ -546,7 +830,9 @@ class Move(BaseSCP):
  
     def __init__(self, dicom_home,port=11112,name="MOVESCP",prefer_uncompr=True,prefer_little=False,
                        prefer_big=False, implicit=False, timeout=None, dimse_timeout=None,
-                       acse_timeout=60, pdu_max=16384, start=False):
+                       acse_timeout=60, pdu_max=16384, destinations=None,
+                       update_on_retrieve=False, index_file=None, index=None, prefetch=0,
+                       prefetch_bytes=PREFETCH_BYTES, cache_file=None, start=False):
         '''
         :param dicom_home: must be the base folder of dicom files **TODO: make this more robust
         :param port: TCP/IP port number to listen on
@@ -559,9 +845,28 @@ class Move(BaseSCP):
         :param acse_timeout: timeout for ACSE messages (default 60)
         :param dimse_timeout: timeout for the DIMSE messages (default None) 
         :param pdu_max: set max receive pdu to n bytes (4096..131072) default 16382
+        :param destinations: a lookup of known move destinations, from the AE title
+                             to its (address, port)
+        :param update_on_retrieve: if True, dicoms in dicom_home are updated on the move request
+        :param index_file: sqlite file to persist the metadata index to (default in memory)
+        :param index: a MetadataIndex to share (e.g., with a Store), instead of index_file
+        :param prefetch: the number of files to read ahead while sending (default 0, off)
+        :param prefetch_bytes: the maximum bytes of files read ahead (default 64MB)
+        :param cache_file: sqlite file of the header cache (default NODEDCM_CACHE, or none)
         '''
         self.port = port 
-        self.base = dicom_home
+        self.prefetch = prefetch
+        self.prefetch_bytes = prefetch_bytes
+        self.destinations = destinations or dict()
+        self.update_on_retrieve = update_on_retrieve
+        self.init_index(dicom_home, index_file=index_file, index=index,
+                        watch=update_on_retrieve, cache_file=cache_file)
+
+        # Update preferences
+        self.update_transfer_syntax(prefer_uncompr=prefer_uncompr,
+                                    prefer_little=prefer_little,
+                                    prefer_big=prefer_big,
+                                    implicit=implicit)
 
         ae = AE(ae_title=name,
                 port=self.port,
@@ -573,7 +878,7 @@ class Move(BaseSCP):
         self.status = self.pending
         self.cancel = False
 
-        self.ae.maximum_pdu_size = max_pdu
+        self.ae.maximum_pdu_size = pdu_max
         self.ae.network_timeout = timeout
         self.ae.acse_timeout = acse_timeout
         self.ae.dimse_timeout = dimse_timeout
@@ -582,29 +887,50 @@ class Move(BaseSCP):
             self.run()
 
 
-    def on_c_move(self, ds, move_aet):
-        '''Callback for ae.on_c_move'''
-
+    def on_c_move(self, dataset, move_aet):
+        '''Callback for ae.on_c_move. The (address, port) of the move destination is
+        yielded first, then the number of sub-operations, followed by each matching
+        instance (only matching files are read). The AE sends each instance to
+        the destination over its own association, and reports the sub-operation
+        counts of the pending responses. A pending response must therefore
+        always carry an instance, the counts can't be reported without one.
+        '''
         time.sleep(self.delay)
 
-        # I think here I need to do the search/match
-        #TODO: this needs to search some metddata for files
-        dcm_files = glob("%s/*.dcm" %(self.base))
+        if isinstance(move_aet, bytes):
+            move_aet = move_aet.decode('ascii')
+        move_aet = move_aet.strip()
+
+        destination = self.destinations.get(move_aet)
+        if destination is None:
+            bot.error("[%s] unknown move destination %s" %(self.ae.ae_title, move_aet))
+            yield None, None
+            return
+        yield destination
+
+        if self.update_on_retrieve is True:
+            self.update_index()
+
+        dcm_files = self.get_retrieve_paths(dataset)
+        if dcm_files is None:
+            yield 0
+            yield self.identifier_doesnt_match_sop, None
+            return
 
         # Number of matches
+        bot.debug("[%s] %s instances to move to %s", self.ae.ae_title,
+                                                     len(dcm_files),
+                                                     move_aet)
         yield len(dcm_files)
 
-        # Matching datasets to send
-        for dcm in dcm_files:
-
-            if self.cancel:
-                yield self.cancel, None
-                return
+        self.cancel = False
+        labels = metrics.get_labels('C-MOVE', 'scp', self.ae.ae_title)
 
-            ds = read_file(dcm, force=True)
-            yield 0xff00, ds
+        # Matching datasets to send
+        for response in self.retrieve_instances(dcm_files, labels):
+            yield response
 
 
-    def on_c_cancel_find(self):
+    def on_c_cancel_move(self):
         '''Callback for ae.on_c_cancel_move'''
         self.cancel = True
@@ -0,0 +1,231 @@
+'''
+
+query.py: compile the keys of a C-FIND identifier into a plan of conditions,
+          ordered to narrow down the matching records as early as possible
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+from node_dcm.columns import compile_wildcard
+from collections import OrderedDict
+import numpy
+import threading
+
+
+# Fields that are dates or times, where a value with - is a range
+range_fields = ['PatientBirthDate',
+                'StudyDate',
+                'StudyTime']
+
+
+# The estimated fraction of distinct values that a condition of a kind selects,
+# exact, uid_list and keys are further divided by the number of distinct values
+selectivity = {'exact': 1.0,
+               'uid_list': 4.0,
+               'keys': 4.0,
+               'multi': 0.5,
+               'range': 0.25,
+               'prefix': 0.1,
+               'wildcard': 0.5}
+
+
+def get_kind(field, value):
+    '''get_kind returns the kind of matching for the value of a query key:
+    universal, uid_list, range, prefix, wildcard or exact
+    :param field: the keyword of the query key
+    :param value: the value of the key, as stored in the index (see to_index_value)
+    '''
+    if value is None or value.strip('*') == '':
+        return 'universal'
+    if field.endswith('UID') and '\\' in value:
+        return 'uid_list'
+    if field in range_fields and '-' in value:
+        return 'range'
+    if '?' not in value and value.find('*') == len(value) - 1:
+        return 'prefix'
+    if '*' in value or '?' in value:
+        return 'wildcard'
+    return 'exact'
+
+
+class Condition:
+    '''A condition on one field of a query, with its value compiled for the
+    kind of matching (a regex for a wildcard, the bounds of a range, etc.). Two
+    kinds don't come from the value of a query key: keys matches a list of the
+    values of the field (e.g., the unique keys of matching parent records, which
+    may be none), and multi matches a field of values separated by \\ if any of
+    them meets a condition (a (kind, value) of the query key).
+    '''
+
+    def __init__(self, field, kind, value):
+        self.field = field
+        self.kind = kind
+        self.value = value
+
+        if kind == 'multi':
+            self.value = Condition(field, value[0], value[1])
+        elif kind == 'wildcard':
+            self.value = compile_wildcard(value)
+        elif kind == 'prefix':
+            self.value = value.rstrip('*')
+        elif kind == 'uid_list':
+            self.value = value.split('\\')
+        elif kind == 'range':
+            lower, upper = value.split('-', 1)
+            self.value = (lower or None, upper or None)
+
+
+    def matches(self, value):
+        '''return True if a single value meets the condition'''
+        if self.kind == 'multi':
+            return any([self.value.matches(x) for x in value.split('\\')])
+        if self.kind == 'wildcard':
+            return self.value.match(value) is not None
+        if self.kind == 'prefix':
+            return value.startswith(self.value)
+        if self.kind in ['uid_list', 'keys']:
+            return value in self.value
+        if self.kind == 'range':
+            lower, upper = self.value
+            return (lower is None or value >= lower) and \
+                   (upper is None or value[:len(upper)] <= upper)
+        return value == self.value
+
+
+    def evaluate(self, store, rows):
+        '''return a mask of the rows of the store that meet the condition'''
+        if self.kind == 'multi':
+            return store.matching(self.field, self.matches, rows)
+        if self.kind == 'wildcard':
+            return store.regex(self.field, self.value, rows)
+        if self.kind == 'prefix':
+            return store.prefix(self.field, self.value, rows)
+        if self.kind in ['uid_list', 'keys']:
+            return store.uid_list(self.field, self.value, rows)
+        if self.kind == 'range':
+            return store.range(self.field, self.value[0], self.value[1], rows)
+        return store.exact(self.field, self.value, rows)
+
+
+class QueryPlan:
+    '''A QueryPlan is an ordered list of conditions. Each condition is only
+    evaluated for the rows that met the conditions before it. A record without
+    a value for a field is not excluded by its condition, but must have a value
+    for at least one. A plan without conditions (universal matching) matches
+    every record, unless the query had keys that can't be matched (unsupported),
+    which then match nothing rather than everything.
+    '''
+
+    def __init__(self, conditions, unsupported=None):
+        '''
+        :param conditions: the conditions, in the order to evaluate them
+        :param unsupported: the (non universal) keys that weren't matched
+        '''
+        self.conditions = conditions
+        self.unsupported = unsupported or []
+
+
+    def execute(self, store):
+        '''return the indices of the rows of a ColumnStore that match, in the
+        order of their paths (deleted rows are never matched)'''
+        rows = store.order
+        if len(self.conditions) == 0:
+            if len(self.unsupported) > 0:
+                return rows[:0]
+            return rows
+
+        present = numpy.zeros(len(rows), dtype=bool)
+        for condition in self.conditions:
+            has_value = store.present(condition.field, rows)
+            keep = condition.evaluate(store, rows) | ~has_value
+            present = (present | has_value)[keep]
+            rows = rows[keep]
+            if len(rows) == 0:
+                break
+
+        return rows[present]
+
+
+class QueryPlanner:
+    '''The QueryPlanner turns the values of a query into a QueryPlan. The order
+    of the conditions depends only on the shape of the query (the level, and the
+    kind of matching for each field), and is kept for the most recent shapes so
+    that repeated queries skip planning.
+    '''
+
+    def __init__(self, size=128):
+        '''
+        :param size: the number of query shapes to keep plans for
+        '''
+        self.size = size
+        self.plans = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def plan(self, values, level, store):
+        '''plan returns the QueryPlan for a query. A key that isn't a field of
+        the store is unsupported (see QueryPlan), it is never ignored silently.
+        :param values: a list of (field, value) for the keys of the query, or
+                       (field, value, kind) for a kind that isn't from the value
+                       (see Condition)
+        :param level: the query level
+        :param store: the ColumnStore the plan is for
+        '''
+        kinds = dict()
+        lookup = dict()
+        unsupported = []
+        for value in values:
+            field, value, kind = (tuple(value) + (None,))[:3]
+            if kind is None:
+                kind = get_kind(field, value)
+            if kind == 'universal':
+                continue
+            if field not in store.columns:
+                unsupported.append(field)
+                continue
+            kinds[field] = kind
+            lookup[field] = value
+
+        shape = (level, tuple(sorted(kinds.items())))
+        with self.lock:
+            order = self.plans.pop(shape, None)
+            if order is None:
+                order = self.get_order(kinds, store)
+            self.plans[shape] = order
+            while len(self.plans) > self.size:
+                self.plans.popitem(last=False)
+
+        return QueryPlan([Condition(field, kinds[field], lookup[field])
+                          for field in order], unsupported)
+
+
+    def get_order(self, kinds, store):
+        '''get_order returns the fields of the conditions, the most selective
+        (estimated from the kind of matching, and the distinct values of the
+        field) first.
+        '''
+        def estimate(field):
+            fraction = selectivity[kinds[field]]
+            if kinds[field] in ['exact', 'uid_list', 'keys']:
+                fraction = fraction / max(1, len(store.vocabulary[field]))
+            return fraction
+
+        return sorted(kinds, key=lambda field: (estimate(field), field))
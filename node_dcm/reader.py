@@ -0,0 +1,152 @@
+'''
+
+reader.py: shared functions for reading dicom files, reading only as much
+           of each file as the caller needs
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+from pydicom import read_file
+from collections import deque
+import os
+import threading
+
+
+# Elements larger than this (bytes) are read from disk only when accessed
+DEFER_SIZE = 1024
+
+# The default maximum bytes of files held by a Prefetcher
+PREFETCH_BYTES = 64 * 1024 * 1024
+
+
+def read_header(dcm_file, tags=None):
+    '''read_header reads the header of a dicom file, stopping before the pixel
+    data. If tags are given, only those elements are parsed.
+    :param dcm_file: the path to the dicom file
+    :param tags: a list of keywords or tags to read (default reads all)
+    '''
+    return read_file(dcm_file,
+                     force=True,
+                     stop_before_pixels=True,
+                     specific_tags=tags)
+
+
+def read_dataset(dcm_file, defer_size=DEFER_SIZE):
+    '''read_dataset reads a complete dicom file, intended for sending. The values
+    of bulk elements (e.g., pixel data) are deferred, and only read from disk
+    when the dataset is encoded.
+    :param dcm_file: the path to the dicom file (not a file object, the file
+                     is opened again to read deferred elements)
+    :param defer_size: elements larger than this number of bytes are deferred
+    '''
+    return read_file(dcm_file,
+                     force=True,
+                     defer_size=defer_size)
+
+
+class Prefetcher:
+    '''A Prefetcher reads a list of dicom files on a background thread, ahead of
+    the caller iterating over them, so that reading the next files overlaps with
+    sending the current one. The files are read completely (nothing deferred),
+    and the files waiting to be taken are bounded by count (depth) and by their
+    total size in bytes. A single file larger than max_bytes is still read, once
+    no other file is waiting. Iterating yields (path, dataset, error), where the
+    dataset is None if reading failed.
+    '''
+
+    def __init__(self, paths, depth=4, max_bytes=PREFETCH_BYTES):
+        '''
+        :param paths: the paths of the dicom files, in the order to yield them
+        :param depth: the maximum number of files read ahead
+        :param max_bytes: the maximum total size of the files read ahead
+        '''
+        self.paths = list(paths)
+        self.depth = max(1, depth)
+        self.max_bytes = max_bytes
+
+        self.ready = deque()
+        self.bytes = 0
+        self.done = False
+        self.stopped = False
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def is_full(self, size):
+        '''return True if a file of size bytes can't be read ahead yet'''
+        if len(self.ready) == 0:
+            return False
+        return len(self.ready) >= self.depth or self.bytes + size > self.max_bytes
+
+
+    def run(self):
+        '''read the files in order, waiting while the read ahead files are full'''
+        for path in self.paths:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+
+            with self.condition:
+                while not self.stopped and self.is_full(size):
+                    self.condition.wait()
+                if self.stopped:
+                    break
+
+            dataset = error = None
+            try:
+                dataset = read_dataset(path, defer_size=None)
+            except Exception as exc:
+                error = exc
+
+            with self.condition:
+                self.ready.append((path, dataset, error, size))
+                self.bytes += size
+                self.condition.notify_all()
+
+        with self.condition:
+            self.done = True
+            self.condition.notify_all()
+
+
+    def __iter__(self):
+        while True:
+            with self.condition:
+                while len(self.ready) == 0 and not self.done:
+                    self.condition.wait()
+                if len(self.ready) == 0:
+                    return
+                path, dataset, error, size = self.ready.popleft()
+                self.bytes -= size
+                self.condition.notify_all()
+            yield path, dataset, error
+
+
+    def close(self):
+        '''stop reading ahead, e.g. when the caller is cancelled'''
+        with self.condition:
+            self.stopped = True
+            self.ready.clear()
+            self.bytes = 0
+            self.condition.notify_all()
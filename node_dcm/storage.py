@@ -0,0 +1,426 @@
+'''
+
+storage.py: write received datasets to disk off of the association threads
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+from node_dcm.logman import bot
+from pydicom.dataset import Dataset
+from pydicom.filebase import DicomFileLike
+from pydicom.filewriter import (
+    write_dataset,
+    write_file_meta_info
+)
+from pydicom.uid import (
+    ExplicitVRLittleEndian,
+    ExplicitVRBigEndian,
+    ImplicitVRLittleEndian
+)
+import hashlib
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+
+if sys.version_info[0] < 3:
+    import Queue as queue
+else:
+    import queue
+
+
+# The fsync policies: none, after each file, or for a group of files at once
+fsync_policies = [None, 'each', 'group']
+
+# The layouts of an output folder: all files in the folder, in folders named by
+# the hash of the SOPInstanceUID, or in Patient/Study/Series folders
+layouts = ['flat', 'hashed', 'hierarchy']
+
+
+def get_encoding(dataset):
+    '''get_encoding returns the (is_implicit_VR, is_little_endian) that a dataset
+    was decoded with, defaulting to implicit VR little endian.
+    '''
+    is_implicit_VR = getattr(dataset, 'read_implicit_vr', None)
+    is_little_endian = getattr(dataset, 'read_little_endian', None)
+    if is_implicit_VR is None:
+        is_implicit_VR = dataset.is_implicit_VR
+    if is_little_endian is None:
+        is_little_endian = dataset.is_little_endian
+
+    if is_implicit_VR is None:
+        is_implicit_VR = True
+    if is_little_endian is None:
+        is_little_endian = True
+    return is_implicit_VR, is_little_endian
+
+
+def get_transfer_syntax(is_implicit_VR, is_little_endian):
+    '''get_transfer_syntax returns the uncompressed transfer syntax uid for
+    an encoding'''
+    if is_implicit_VR:
+        return ImplicitVRLittleEndian
+    if is_little_endian:
+        return ExplicitVRLittleEndian
+    return ExplicitVRBigEndian
+
+
+def write_passthrough(filename, dataset, implementation_uid):
+    '''write_passthrough writes a received dataset to filename in the transfer
+    syntax it was received in, behind a newly generated file meta header. The
+    elements of a received dataset are still raw (not yet decoded), and are
+    written as they are, without converting or encoding them again.
+    :param filename: the file to write to
+    :param dataset: the dataset, as received with the C-STORE
+    :param implementation_uid: the ImplementationClassUID for the file meta
+    '''
+    is_implicit_VR, is_little_endian = get_encoding(dataset)
+
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = dataset.SOPClassUID
+    meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
+    meta.TransferSyntaxUID = get_transfer_syntax(is_implicit_VR, is_little_endian)
+    meta.ImplementationClassUID = implementation_uid
+
+    with open(filename, 'wb') as filey:
+        fp = DicomFileLike(filey)
+        fp.write(b'\0' * 128)
+        fp.write(b'DICM')
+        write_file_meta_info(fp, meta)
+
+        fp.is_implicit_VR = is_implicit_VR
+        fp.is_little_endian = is_little_endian
+        write_dataset(fp, dataset)
+
+    return filename
+
+
+def atomic_write(filename, function, *args, **kwargs):
+    '''atomic_write calls function to write to a temporary file next to filename,
+    and then renames it to filename, so that a reader never sees a partial file.
+    If a WriteJob is given (job=), the file is only renamed if the job can be
+    committed, otherwise it is removed and None is returned (see WriteJob).
+    :param filename: the final path of the file
+    :param function: a function that writes its first argument (the path)
+    :param args: other arguments to pass to the function
+    '''
+    job = kwargs.get('job')
+    folder, name = os.path.split(filename)
+    temporary = os.path.join(folder, '.%s.%s.tmp' %(name, uuid.uuid4().hex))
+    try:
+        function(temporary, *args)
+        if job is not None and not job.commit():
+            os.remove(temporary)
+            return None
+        os.rename(temporary, filename)
+    except:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return filename
+
+
+class StorageLayout:
+    '''A StorageLayout decides where in an output folder a dataset is stored,
+    so that no single folder grows too large. Folders that are known to exist
+    are cached, so storing a file doesn't need to check or create them.
+    '''
+
+    def __init__(self, output_dir, layout='flat', depth=2, width=2):
+        '''
+        :param output_dir: the output folder to store to
+        :param layout: one of flat (default), hashed or hierarchy
+        :param depth: the number of nested folders (for hashed)
+        :param width: the number of hash characters per folder (for hashed)
+        '''
+        if layout not in layouts:
+            bot.error("layout must be one of %s" %(layouts))
+            sys.exit(1)
+
+        self.output_dir = output_dir
+        self.layout = layout
+        self.depth = depth
+        self.width = width
+        self.folders = set([output_dir])
+        self.lock = threading.Lock()
+
+
+    def get_folders(self, dataset):
+        '''return the list of nested folder names for a dataset'''
+        if self.layout == 'hashed':
+            digest = hashlib.sha1(str(dataset.SOPInstanceUID).encode('utf-8')).hexdigest()
+            return [digest[ii * self.width:(ii + 1) * self.width]
+                    for ii in range(self.depth)]
+
+        if self.layout == 'hierarchy':
+            return [clean_name(dataset.get(x)) for x in ['PatientID',
+                                                         'StudyInstanceUID',
+                                                         'SeriesInstanceUID']]
+        return []
+
+
+    def get_path(self, filename, dataset):
+        '''return the full path to store a dataset as filename'''
+        folders = [self.output_dir] + self.get_folders(dataset)
+        return os.path.join(*(folders + [filename]))
+
+
+    def make_folder(self, path):
+        '''make the folder of a path if it isn't known to exist'''
+        folder = os.path.dirname(path)
+        if folder in self.folders:
+            return
+
+        with self.lock:
+            if not os.path.exists(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError:
+                    if not os.path.isdir(folder):
+                        raise
+            self.folders.add(folder)
+
+
+def clean_name(value):
+    '''clean_name returns a value that is safe to use as a folder name'''
+    value = str(value or '').strip()
+    value = re.sub('[^A-Za-z0-9._-]', '_', value)
+    if value.strip('.') == '':
+        return 'UNKNOWN'
+    return value
+
+
+def fsync_path(path):
+    '''fsync_path flushes a written file (or directory) to disk'''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteJob:
+    '''A WriteJob is a write submitted to a WriterPool. It is done when the file
+    is written, and flushed to disk if the pool fsyncs, or when that failed. A
+    caller that stops waiting for it can cancel it, as long as the file wasn't
+    put in place yet: the write function commits the job before it does (see
+    atomic_write), and a cancelled job can't be committed.
+    '''
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.path = None
+        self.error = None
+        self.done = threading.Event()
+        self.cancelled = False
+        self.committed = False
+        self.lock = threading.Lock()
+
+
+    def commit(self):
+        '''commit the job, before the file is put in place, returning False if
+        it was cancelled (and the file should be discarded)'''
+        with self.lock:
+            if not self.cancelled:
+                self.committed = True
+            return self.committed
+
+
+    def cancel(self):
+        '''cancel the job, returning False if it's too late (it was committed)'''
+        with self.lock:
+            if not self.committed:
+                self.cancelled = True
+            return self.cancelled
+
+
+    def finish(self, error=None):
+        '''mark the job as done, with the error that failed it (if any)'''
+        if error is not None:
+            self.error = error
+        self.done.set()
+
+
+    def wait(self, timeout=None):
+        '''wait for the job to be done, returning True if the file was written
+        (and flushed), or False if it failed or isn't done within timeout
+        '''
+        if not self.done.wait(timeout):
+            return False
+        return self.error is None and not self.cancelled
+
+
+class WriterPool:
+    '''A WriterPool holds a bounded queue of write jobs, drained by a pool of
+    writer threads. A job is a function that writes a single file and returns
+    its path (or None if it wrote nothing), called with the job (job=) to commit
+    it (see WriteJob). If the queue is full, submit returns None and the caller
+    should refuse the data (backpressure), rather than wait on the disk.
+    Otherwise the caller can wait on the returned WriteJob, which is done only
+    when the file is written, and flushed to disk if fsync is set. With
+    fsync='group', the files written while others were queued are flushed
+    together, as soon as the queue is empty (or the group is full, or old
+    enough).
+    '''
+
+    def __init__(self, writers=2, queue_size=1000, fsync=None, group_size=64,
+                       group_interval=1.0):
+        '''
+        :param writers: the number of writer threads
+        :param queue_size: the maximum number of jobs waiting to be written
+        :param fsync: None (leave it to the OS), 'each' to fsync each file, or
+                      'group' to fsync files (and their folders) in groups
+        :param group_size: the maximum number of files in a group (for fsync='group')
+        :param group_interval: the maximum seconds to wait for a group to fill
+        '''
+        if fsync not in fsync_policies:
+            bot.error("fsync must be one of %s" %(fsync_policies))
+            sys.exit(1)
+
+        self.fsync = fsync
+        self.group_size = group_size
+        self.group_interval = group_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        # Written jobs waiting for a group fsync, and when the group started
+        self.group = []
+        self.group_start = None
+        self.group_lock = threading.Lock()
+
+        self.threads = []
+        for ii in range(writers):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+
+    def submit(self, function, *args):
+        '''submit a write job to the queue, returning the WriteJob, or None if
+        the queue is full
+        :param function: the function to write a file, returning the path written,
+                         called with the args and the job (job=)
+        :param args: the arguments to pass to the function
+        '''
+        job = WriteJob(function, args)
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            bot.warning("Write queue is full (%s jobs)" %(self.queue.qsize()))
+            return None
+        return job
+
+
+    def run(self):
+        '''the loop of a writer thread, a job of None stops the thread'''
+        while True:
+            try:
+                job = self.queue.get(timeout=self.group_interval)
+            except queue.Empty:
+                self.sync_group(force=True)
+                continue
+
+            if job is None:
+                self.sync_group(force=True)
+                self.queue.task_done()
+                return
+
+            try:
+                job.path = None
+                if not job.cancelled:
+                    job.path = job.function(*job.args, job=job)
+                if job.path is None or self.fsync is None:
+                    job.finish()
+                elif self.fsync == 'each':
+                    fsync_path(job.path)
+                    fsync_path(os.path.dirname(job.path) or '.')
+                    job.finish()
+                else:
+                    self.add_to_group(job)
+            except Exception as error:
+                bot.error("Error writing in the background: %s" %(error))
+                job.finish(error)
+            finally:
+                self.queue.task_done()
+
+            # Nothing else is waiting to be written, so the group is as full as it gets
+            if self.fsync == 'group':
+                self.sync_group(force=self.queue.empty())
+
+
+    def add_to_group(self, job):
+        with self.group_lock:
+            if self.group_start is None:
+                self.group_start = time.time()
+            self.group.append(job)
+
+
+    def sync_group(self, force=False):
+        '''fsync the files of the current group (and their folders), if the group
+        is full or old enough, or if force is True, and finish their jobs.
+        '''
+        with self.group_lock:
+            if len(self.group) == 0:
+                return
+            waited = time.time() - self.group_start
+            if not force and len(self.group) < self.group_size and waited < self.group_interval:
+                return
+            group = self.group
+            self.group = []
+            self.group_start = None
+
+        folders = dict()
+        for job in group:
+            try:
+                fsync_path(job.path)
+                folders.setdefault(os.path.dirname(job.path) or '.', []).append(job)
+            except OSError as error:
+                bot.error("Cannot fsync %s: %s" %(job.path, error))
+                job.finish(error)
+
+        # A new file is only durable when its directory entry is
+        for folder, jobs in folders.items():
+            try:
+                fsync_path(folder)
+            except OSError as error:
+                bot.error("Cannot fsync %s: %s" %(folder, error))
+                for job in jobs:
+                    job.error = error
+            for job in jobs:
+                job.finish()
+
+
+    def join(self):
+        '''wait for all queued jobs to be written'''
+        self.queue.join()
+        self.sync_group(force=True)
+
+
+    def stop(self):
+        '''write the queued jobs, and stop the writer threads'''
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
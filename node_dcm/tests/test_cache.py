@@ -0,0 +1,143 @@
+'''
+
+test_cache.py: Testing the persistent validation and header cache
+
+The MIT License (MIT)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+import os
+
+from node_dcm.cache import (
+    HeaderCache,
+    get_file_stat
+)
+from node_dcm.index import MetadataIndex
+from node_dcm.transfer import scan_context
+from node_dcm.validate import validate_files
+
+from unittest import TestCase
+import shutil
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+dataset_base = os.path.join(here, 'dicom_files')
+
+
+class TestHeaderCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmpdir, 'cache.db')
+        self.dicoms = []
+        for name in ['CTImageStorage.dcm', 'RTImageStorage.dcm']:
+            self.dicoms.append(os.path.join(self.tmpdir, name))
+            shutil.copyfile(os.path.join(dataset_base, name), self.dicoms[-1])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_changed(self):
+        '''test that an entry is used until its file changes
+        '''
+        cache = HeaderCache(self.cache_file)
+        cache.put(self.dicoms[0], True, None, level='quick')
+        self.assertEqual(cache.get_validation(self.dicoms[0], 'quick'), (True, None))
+        self.assertEqual(cache.get_validation(self.dicoms[0], 'deep'), None)
+        self.assertEqual(cache.get_validation(self.dicoms[1], 'quick'), None)
+
+        cache.put(self.dicoms[0], attributes={'Modality': 'CT'})
+        self.assertEqual(cache.get_attributes(self.dicoms[0], ['Modality']),
+                         {'Modality': 'CT'})
+        self.assertEqual(cache.get_attributes(self.dicoms[0], ['Modality', 'Rows']), None)
+        cache.close()
+
+        cache = HeaderCache(self.cache_file)
+        self.assertEqual(cache.get_validation(self.dicoms[0], 'quick'), (True, None))
+        os.utime(self.dicoms[0], (0, 0))
+        self.assertEqual(cache.get(self.dicoms[0]), None)
+
+    def test_eviction(self):
+        '''test that the least recently used entries are evicted
+        '''
+        cache = HeaderCache(self.cache_file, max_entries=1)
+        cache.put(self.dicoms[0], True, None, level='quick')
+        cache.put(self.dicoms[1], True, None, level='quick')
+        cache.get(self.dicoms[1])
+        cache.commit()
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get(self.dicoms[0]), None)
+
+    def test_touches(self):
+        '''test that a hit doesn't write, and when it was used is recorded
+        on commit
+        '''
+        cache = HeaderCache(self.cache_file)
+        self.assertEqual(cache.conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        cache.put(self.dicoms[0], True, None, level='quick')
+        cache.commit()
+        used = cache.conn.execute('SELECT used FROM entries').fetchone()[0]
+
+        cache.get(self.dicoms[0])
+        self.assertFalse(cache.conn.in_transaction)
+        self.assertEqual(list(cache.touched), [self.dicoms[0]])
+        cache.commit()
+        self.assertEqual(cache.touched, dict())
+        self.assertTrue(cache.conn.execute('SELECT used FROM entries').fetchone()[0] > used)
+
+    def test_stat(self):
+        '''test that an entry put with the stat of an older version of the
+        file isn't used
+        '''
+        cache = HeaderCache(self.cache_file)
+        stat = get_file_stat(self.dicoms[0])
+        os.utime(self.dicoms[0], (0, 0))
+        cache.put(self.dicoms[0], attributes={'Modality': 'CT'}, stat=stat)
+        self.assertEqual(cache.get(self.dicoms[0]), None)
+
+        cache.put(self.dicoms[0], attributes={'Modality': 'CT'})
+        self.assertEqual(cache.get_attributes(self.dicoms[0], ['Modality']),
+                         {'Modality': 'CT'})
+
+    def test_integration(self):
+        '''test that validation, indexing and scanning use the cache
+        '''
+        cache = HeaderCache(self.cache_file)
+        results = validate_files(self.dicoms, deep=True, workers=1, cache=cache)
+        self.assertEqual([x.valid for x in results], [True, True])
+        self.assertEqual(cache.get_validation(self.dicoms[1], 'quick'), (True, None))
+
+        index = MetadataIndex(cache=cache)
+        index.refresh(self.dicoms)
+        self.assertEqual(cache.get_attributes(self.dicoms[0], ['Modality'])['Modality'], 'CT')
+        self.assertEqual(MetadataIndex(cache=cache).read_header(self.dicoms[0])['Modality'], 'CT')
+
+        # A cached value is returned without reading the file
+        cache.put(self.dicoms[0], attributes={'SOPClassUID': '1.2',
+                                              'TransferSyntaxUID': '1.2.840.10008.1.2',
+                                              'SOPInstanceUID': '1.2.3'})
+        self.assertEqual(scan_context(self.dicoms[0], cache=cache),
+                         ('1.2', '1.2.840.10008.1.2', '1.2.3'))
+        context = scan_context(self.dicoms[1], cache=cache)
+        self.assertEqual(cache.get_attributes(self.dicoms[1], ['SOPInstanceUID'])['SOPInstanceUID'],
+                         context[2])
@@ -0,0 +1,309 @@
+'''
+
+test_index.py: Testing the metadata index used by the providers
+
+The MIT License (MIT)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import os
+
+from pydicom.dataset import Dataset
+
+from node_dcm.columns import ColumnStore
+from node_dcm.index import (
+    IndexPublisher,
+    MetadataIndex
+)
+from node_dcm.reader import read_header
+
+from unittest import TestCase
+import shutil
+import tempfile
+import threading
+
+here = os.path.dirname(os.path.abspath(__file__))
+dataset_base = os.path.join(here, 'dicom_files')
+
+
+class TestMetadataIndex(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.tmpdir, 'index.db')
+        self.dicoms = [os.path.join(dataset_base, x) for x in
+                       ['CTImageStorage.dcm',
+                        'MRImageStorage_JPG2000_Lossless.dcm',
+                        'RTImageStorage.dcm']]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def query(self, **kwargs):
+        ds = Dataset()
+        for key, value in kwargs.items():
+            setattr(ds, key, value)
+        return ds, list(kwargs.keys())
+
+    def test_find(self):
+        '''test that find answers a query from the index
+        '''
+        index = MetadataIndex(self.index_file)
+        index.refresh(self.dicoms)
+        self.assertEqual(len(index), 3)
+
+        ds, fields = self.query(PatientID='1CT1')
+        self.assertEqual(index.find(ds, fields), [self.dicoms[0]])
+
+        ds, fields = self.query(PatientID='1CT1', Rows=64)
+        self.assertEqual(index.find(ds, fields), [])
+
+        ds, fields = self.query(PatientName='*')
+        self.assertEqual(index.find(ds, fields), self.dicoms)
+
+        ds, fields = self.query(PatientName='CompressedSamples^?R1')
+        self.assertEqual(index.find(ds, fields), [self.dicoms[1]])
+
+        ds, fields = self.query(StudyInstanceUID=['1.3.46.423632.132218.1415242681.6',
+                                                  '1.3.6.1.4.1.5962.1.2.1.20040119072730.12322'])
+        self.assertEqual(index.find(ds, fields), [self.dicoms[0], self.dicoms[2]])
+
+    def test_get_dataset(self):
+        '''test that a response dataset is built from the index
+        '''
+        index = MetadataIndex(self.index_file)
+        index.refresh(self.dicoms)
+
+        ds, fields = self.query(PatientID='4MR1')
+        store, rows, unsupported = index.find_rows(ds, fields)
+        self.assertEqual(len(rows), 1)
+
+        response = index.get_dataset(store, rows[0], ['PatientID', 'Rows',
+                                                      'StudyDescription'])
+        self.assertEqual(response.PatientID, '4MR1')
+        self.assertEqual(response.Rows, 64)
+        self.assertEqual(response.StudyDescription, '')
+        self.assertTrue('PixelData' not in response)
+
+    def test_levels(self):
+        '''test that patient, study and series records are rolled up
+        '''
+        index = MetadataIndex(self.index_file)
+        index.refresh(self.dicoms)
+        for level in ['PATIENT', 'STUDY', 'SERIES', 'IMAGE']:
+            self.assertEqual(index.count(level), 3)
+
+        ds, fields = self.query(StudyDate='20040119')
+        store, rows, unsupported = index.find_rows(ds, fields, level='STUDY')
+        self.assertEqual(len(rows), 1)
+        response = index.get_dataset(store, rows[0], ['ModalitiesInStudy',
+                                                      'NumberOfStudyRelatedInstances'])
+        self.assertEqual(response.ModalitiesInStudy, 'CT')
+        self.assertEqual(response.NumberOfStudyRelatedInstances, 1)
+
+        studies = index.find(ds, fields, level='STUDY')
+        self.assertEqual(index.get_instances('STUDY', studies), self.dicoms[:1])
+        self.assertEqual(index.get_instances('PATIENT', ['1CT1', '4MR1']), self.dicoms[:2])
+
+        index.remove(self.dicoms[0])
+        self.assertEqual(index.count('STUDY'), 2)
+        self.assertEqual(index.find(ds, fields, level='STUDY'), [])
+
+    def test_query_planner(self):
+        '''test range and prefix matching, and that plans are reused
+        '''
+        index = MetadataIndex(self.index_file)
+        index.refresh(self.dicoms)
+
+        ds, fields = self.query(StudyDate='20040101-20041231', PatientName='Compressed*')
+        self.assertEqual(index.find(ds, fields), self.dicoms[:2])
+
+        ds, fields = self.query(StudyDate='-20040601', PatientID='1CT1')
+        self.assertEqual(index.find(ds, fields, level='STUDY'),
+                         ['1.3.6.1.4.1.5962.1.2.1.20040119072730.12322'])
+
+        ds, fields = self.query(StudyTime='1144-', Rows='')
+        self.assertEqual(index.find(ds, fields), self.dicoms[1:])
+        self.assertEqual(len(index.planner.plans), 3)
+
+        ds, fields = self.query(StudyDate='20150101-', PatientName='ANON*')
+        self.assertEqual(index.find(ds, fields), self.dicoms[2:])
+        self.assertEqual(len(index.planner.plans), 3)
+
+    def test_level_keys(self):
+        '''test that keys of the records above a level are matched by them, and
+        that a key that can't be matched never matches everything
+        '''
+        index = MetadataIndex(self.index_file)
+        index.refresh(self.dicoms)
+
+        ds, fields = self.query(PatientName='nobody')
+        self.assertEqual(index.find(ds, fields, level='SERIES'), [])
+        ds, fields = self.query(PatientName='Compressed*', Modality='CT')
+        self.assertEqual(len(index.find(ds, fields, level='SERIES')), 1)
+
+        ds, fields = self.query(Modality='XX')
+        self.assertEqual(index.find(ds, fields, level='STUDY'), [])
+        ds, fields = self.query(Modality='CT')
+        self.assertEqual(index.find(ds, fields, level='STUDY'),
+                         ['1.3.6.1.4.1.5962.1.2.1.20040119072730.12322'])
+
+        ds, fields = self.query(InstitutionName='nowhere')
+        store, rows, unsupported = index.find_rows(ds, fields, level='SERIES')
+        self.assertEqual(len(rows), 0)
+        self.assertEqual(unsupported, ['InstitutionName'])
+
+        ds, fields = self.query(InstitutionName='nowhere', PatientID='1CT1')
+        store, rows, unsupported = index.find_rows(ds, fields, level='STUDY')
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(unsupported, ['InstitutionName'])
+
+    def test_column_store(self):
+        '''test the vectorized matches of the column store
+        '''
+        rows = [('a', 'CT', '1.2'),
+                ('b', 'MR', None),
+                ('c', 'CT', '1.3')]
+        store = ColumnStore(['Modality', 'SeriesInstanceUID'], rows)
+        self.assertEqual(list(store.rows(store.exact('Modality', 'CT'))), [0, 2])
+        self.assertEqual(list(store.rows(store.wildcard('Modality', '*R'))), [1])
+        self.assertEqual(list(store.rows(store.uid_list('SeriesInstanceUID',
+                                                        ['1.3', '1.4']))), [2])
+        self.assertEqual(list(store.rows(store.present('SeriesInstanceUID'))), [0, 2])
+        self.assertEqual(list(store.rows(store.exact('Modality', 'US'))), [])
+
+    def test_column_store_update(self):
+        '''test that rows are appended and deleted in place, and compacted
+        '''
+        store = ColumnStore(['Modality'], [('b', 'MR'), ('a', 'CT')])
+        self.assertEqual(list(store.keys), ['a', 'b'])
+
+        store.append([('c', 'US'), ('b', 'CT')])
+        store.delete(['a'])
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.deleted, 2)
+        self.assertEqual([store.paths[x] for x in store.order], ['b', 'c'])
+        self.assertEqual([store.paths[x] for x in
+                          store.rows(store.exact('Modality', 'CT') & store.live)], ['b'])
+
+        store = store.compact()
+        self.assertEqual(store.paths, ['b', 'c'])
+        self.assertEqual(store.vocabulary['Modality'], ['CT', 'US'])
+        self.assertEqual(store.value('Modality', 0), 'CT')
+        self.assertEqual(store.deleted, 0)
+
+    def test_persistence(self):
+        '''test that an index file is reused, and removed files are dropped
+        '''
+        index = MetadataIndex(self.index_file)
+        index.refresh(self.dicoms)
+        index.close()
+
+        index = MetadataIndex(self.index_file)
+        self.assertEqual(len(index), 3)
+        index.refresh(self.dicoms[:2])
+        self.assertEqual(index.paths(), set(self.dicoms[:2]))
+
+    def test_refresh(self):
+        '''test that refresh only re-indexes added, changed or removed files
+        '''
+        base = os.path.join(self.tmpdir, 'base')
+        os.mkdir(base)
+        contenders = []
+        for dicom in self.dicoms:
+            contenders.append(os.path.join(base, os.path.basename(dicom)))
+            shutil.copyfile(dicom, contenders[-1])
+
+        index = MetadataIndex(self.index_file)
+        self.assertEqual(index.refresh(contenders), (3, 0))
+        self.assertEqual(index.refresh(contenders), (0, 0))
+
+        # A changed file is indexed again, a deleted one is removed
+        os.utime(contenders[0], (0, 0))
+        os.remove(contenders[1])
+        self.assertEqual(index.refresh(contenders[:1], partial=True), (1, 0))
+        self.assertEqual(index.refresh(contenders[1:], partial=True), (0, 1))
+        self.assertEqual(index.paths(), set([contenders[0], contenders[2]]))
+
+    def test_publisher(self):
+        '''test that published instances are committed in batches, and seen
+        by another connection to the same index file
+        '''
+        index = MetadataIndex(self.index_file)
+        other = MetadataIndex(self.index_file)
+        publisher = IndexPublisher(index, batch_size=2, interval=60)
+
+        ds, fields = self.query(Modality='*')
+        publisher.publish(self.dicoms[0], read_header(self.dicoms[0]))
+        self.assertEqual(len(index.find(ds, fields)), 0)
+        self.assertFalse(index.conn.in_transaction)
+
+        publisher.publish(self.dicoms[1], read_header(self.dicoms[1]))
+        self.assertEqual(len(index.find(ds, fields)), 2)
+        self.assertEqual(len(other.find(ds, fields)), 2)
+        self.assertEqual(other.count('STUDY'), 2)
+
+        publisher.publish(self.dicoms[2], read_header(self.dicoms[2]))
+        publisher.stop()
+        self.assertEqual(other.find(ds, fields), self.dicoms)
+
+    def test_columns(self):
+        '''test that the column store is updated with the changes of any
+        connection, and not built again
+        '''
+        index = MetadataIndex(self.index_file)
+        other = MetadataIndex(self.index_file)
+        index.refresh(self.dicoms[:2])
+
+        ds, fields = self.query(Modality='*')
+        store = other.columns()
+        self.assertEqual(other.find(ds, fields), self.dicoms[:2])
+
+        index.add(self.dicoms[2])
+        index.remove(self.dicoms[0])
+        self.assertEqual(other.find(ds, fields), self.dicoms[1:])
+        self.assertTrue(other.columns() is store)
+        self.assertEqual(other.count('STUDY'), 2)
+
+        # Changes that were dropped can't be applied, the store is built again
+        index.changes_kept = 0
+        index.add(self.dicoms[0])
+        index.add(self.dicoms[0])
+        self.assertEqual(other.find(ds, fields), self.dicoms)
+        self.assertFalse(other.columns() is store)
+
+    def test_concurrent_writes(self):
+        '''test that a connection can read while another writes, and waits
+        for the write to finish to write itself
+        '''
+        index = MetadataIndex(self.index_file)
+        other = MetadataIndex(self.index_file, timeout=5)
+        self.assertEqual(index.conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+        index.add(self.dicoms[0], commit=False)
+        self.assertEqual(len(other), 0)
+
+        thread = threading.Timer(0.2, index.commit)
+        thread.start()
+        other.add(self.dicoms[1])
+        thread.join()
+        self.assertEqual(index.paths(), set(self.dicoms[:2]))
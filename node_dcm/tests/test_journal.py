@@ -0,0 +1,94 @@
+'''
+
+test_journal.py: Testing the journal of a bulk send
+
+The MIT License (MIT)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+import os
+
+from node_dcm.journal import SendJournal
+
+from unittest import TestCase
+import shutil
+import tempfile
+
+
+class TestSendJournal(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal_file = os.path.join(self.tmpdir, 'send.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_modes(self):
+        '''test that resume skips sent instances, and retry sends failures
+        '''
+        journal = SendJournal(self.journal_file)
+        journal.record('1.1', 'a.dcm', 'completed')
+        journal.record('1.2', 'b.dcm', 'failed')
+        journal.record('1.3', 'c.dcm', 'failed')
+        journal.record('1.3', 'c.dcm', 'warning')
+        journal.close()
+
+        # An interrupted write leaves a partial line
+        with open(self.journal_file, 'a') as filey:
+            filey.write('{"uid": "1.4", "pa')
+
+        journal = SendJournal(self.journal_file, mode='resume')
+        self.assertEqual([journal.should_send(x) for x in ['1.1', '1.2', '1.3', '1.4']],
+                         [False, True, False, True])
+        journal.close()
+
+        journal = SendJournal(self.journal_file, mode='retry')
+        self.assertEqual([journal.should_send(x) for x in ['1.1', '1.2', '1.3', '1.4']],
+                         [False, True, False, False])
+        journal.record('1.2', 'b.dcm', 'completed')
+        journal.close()
+
+        journal = SendJournal(self.journal_file, mode='retry')
+        self.assertFalse(journal.should_send('1.2'))
+        journal.close()
+
+    def test_files(self):
+        '''test that resume skips a file sent from the same path, unless it
+        changed since
+        '''
+        journal = SendJournal(self.journal_file)
+        journal.record('1.1', 'a.dcm', 'completed', stat=(10, 1.5))
+        journal.record('1.2', 'b.dcm', 'failed', stat=(10, 1.5))
+        journal.record('1.3', 'c.dcm', 'warning')
+        self.assertFalse(journal.was_sent('a.dcm'))
+        journal.close()
+
+        journal = SendJournal(self.journal_file, mode='resume')
+        self.assertTrue(journal.was_sent('a.dcm', (10, 1.5, 7)))
+        self.assertTrue(journal.was_sent('a.dcm'))
+        self.assertFalse(journal.was_sent('a.dcm', (11, 1.5)))
+        self.assertFalse(journal.was_sent('b.dcm', (10, 1.5)))
+        self.assertTrue(journal.was_sent('c.dcm', (10, 1.5)))
+        self.assertFalse(journal.was_sent('d.dcm'))
+        journal.close()
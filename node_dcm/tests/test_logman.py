@@ -0,0 +1,158 @@
+'''
+
+test_logman.py: Testing the level checks and history of the logger
+
+The MIT License (MIT)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+from node_dcm.logman import (
+    DEBUG,
+    INFO,
+    QUIET,
+    NodedcmMessage
+)
+
+from collections import deque
+import json
+import threading
+from unittest import TestCase
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+class Unformattable:
+    '''an argument that fails the test if it is ever formatted'''
+
+    def __str__(self):
+        raise AssertionError("a disabled message was formatted")
+
+
+class StuckStream(StringIO):
+    '''a stream that can't be written to until it is ready'''
+
+    def __init__(self):
+        StringIO.__init__(self)
+        self.ready = threading.Event()
+
+    def write(self, message):
+        self.ready.wait()
+        return StringIO.write(self, message)
+
+
+class TestNodedcmMessage(TestCase):
+
+    def setUp(self):
+        self.bot = NodedcmMessage()
+        self.bot.colorize = False
+        self.bot.errorStream = StringIO()
+        self.bot.outputStream = StringIO()
+
+    def test_levels(self):
+        '''test that messages are formatted only if their level is enabled
+        '''
+        self.bot.level = INFO
+        self.bot.debug("Storing %s", Unformattable())
+        self.bot.info("Storing %s of %s", 1, 2)
+        self.bot.warning("100% done")
+        self.assertEqual(self.bot.outputStream.getvalue(), "Storing 1 of 2\n")
+        self.assertEqual(self.bot.errorStream.getvalue(), "WARNING 100% done\n")
+
+        self.bot.level = QUIET
+        self.bot.warning("Storing %s", Unformattable())
+        self.assertEqual(len(self.bot.history), 2)
+
+    def test_history(self):
+        '''test that the history keeps only the most recent messages
+        '''
+        self.bot.level = DEBUG
+        self.bot.history = deque(maxlen=2)
+        for ii in range(5):
+            self.bot.debug("message %s", ii)
+        self.assertEqual(self.bot.get_logs(join_newline=False),
+                         ["DEBUG message 3\n", "DEBUG message 4\n"])
+
+        self.bot.history = deque(maxlen=0)
+        self.bot.error("message")
+        self.assertEqual(self.bot.get_logs(), '')
+
+    def test_queue(self):
+        '''test that queued messages are written by the background thread, and
+        dropped (and counted) when the queue is full
+        '''
+        self.bot.level = DEBUG
+        self.bot.start_queue(size=1000, policy='block', batch_size=10)
+        for ii in range(100):
+            self.bot.debug("message %s", ii)
+        self.bot.flush()
+        self.assertEqual(len(self.bot.errorStream.getvalue().splitlines()), 100)
+
+        # While the stream is stuck, messages past the size of the queue are dropped
+        self.bot.stop_queue()
+        self.bot.errorStream = StuckStream()
+        self.bot.start_queue(size=2, policy='drop')
+        for ii in range(10):
+            self.bot.debug("message %s", ii)
+        self.assertTrue(self.bot.dropped > 0)
+
+        self.bot.errorStream.ready.set()
+        self.bot.flush()
+        self.bot.stop_queue()
+        self.assertTrue("Dropped" in self.bot.errorStream.getvalue())
+
+    def test_dropped_count(self):
+        '''test that messages dropped from many threads are all counted
+        '''
+        self.bot.level = DEBUG
+        self.bot.errorStream = StuckStream()
+        self.bot.start_queue(size=1, policy='drop')
+
+        def emit():
+            for ii in range(500):
+                self.bot.debug("message %s", ii)
+        threads = [threading.Thread(target=emit) for ii in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.bot.errorStream.ready.set()
+        self.bot.flush()
+        self.bot.stop_queue()
+        lines = self.bot.get_logs(join_newline=False)
+        written = len([x for x in lines if x.startswith('DEBUG message')])
+        dropped = sum([int(x.split()[2]) for x in lines if 'Dropped' in x])
+        self.assertEqual(written + dropped, 4000)
+
+    def test_json(self):
+        '''test that messages are written as lines of json
+        '''
+        self.bot.level = INFO
+        self.bot.format = 'json'
+        self.bot.info("Sent %s files", 3)
+        record = json.loads(self.bot.outputStream.getvalue())
+        self.assertEqual(record['level'], 'INFO')
+        self.assertEqual(record['message'], 'Sent 3 files')
@@ -0,0 +1,115 @@
+'''
+
+test_metrics.py: Testing the operation metrics and their http endpoint
+
+The MIT License (MIT)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+from node_dcm.metrics import (
+    Metrics,
+    MetricsServer
+)
+from node_dcm.transfer import get_result
+
+from unittest import TestCase
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+
+class Association:
+    '''a stand in for an association, with the peer it is with'''
+
+    def __init__(self, title, address):
+        self.peer_ae = {'AET': title, 'Address': address, 'Port': 104}
+
+
+class ApplicationEntity:
+    '''a stand in for an ae, with its active associations'''
+
+    def __init__(self, title):
+        self.ae_title = title
+        self.active_associations = []
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_timed(self):
+        '''test that calls, and the responses of generators, are recorded
+        '''
+        store = self.metrics.timed('C-STORE', 'scp', b'STORESCP', lambda ds: 0xA700,
+                                   get_result)
+        self.assertEqual(store(None), 0xA700)
+
+        def find(ds):
+            yield 0xFF00, ds
+            yield 0xFF00, ds
+        find = self.metrics.timed('C-FIND', 'scp', 'FINDSCP', find, get_result)
+        self.assertEqual(len(list(find('query'))), 2)
+
+        # Responses that aren't all taken are a cancelled operation
+        responses = find('query')
+        next(responses)
+        responses.close()
+
+        labels = ('C-STORE', 'scp', 'STORESCP', 'unknown')
+        self.assertEqual(self.metrics.operations[labels + ('failed',)], 1)
+        labels = ('C-FIND', 'scp', 'FINDSCP', 'unknown')
+        self.assertEqual(self.metrics.operations[labels + ('completed',)], 1)
+        self.assertEqual(self.metrics.operations[labels + ('cancelled',)], 1)
+        self.assertEqual(self.metrics.latencies[labels][-1], 2)
+
+    def test_render(self):
+        '''test the Prometheus text format, and that it is served over http
+        '''
+        labels = self.metrics.get_labels('C-STORE', 'scu', 'STORESCU', peer='PACS@10.0.0.1')
+        self.metrics.observe(labels, 0.02)
+        self.metrics.observe(labels, 120)
+        self.metrics.add_bytes(labels, 1024)
+
+        ae = ApplicationEntity('STORESCU')
+        ae.active_associations = [Association('PACS', '10.0.0.1')] * 2
+        self.metrics.register(ae)
+
+        text = self.metrics.render()
+        labels = 'operation="C-STORE",role="scu",ae="STORESCU",peer="PACS@10.0.0.1"'
+        self.assertTrue('nodedcm_operations_total{%s,result="completed"} 2' %labels in text)
+        self.assertTrue('nodedcm_bytes_total{%s} 1024' %labels in text)
+        self.assertTrue('nodedcm_operation_seconds_bucket{%s,le="0.01"} 0' %labels in text)
+        self.assertTrue('nodedcm_operation_seconds_bucket{%s,le="0.025"} 1' %labels in text)
+        self.assertTrue('nodedcm_operation_seconds_bucket{%s,le="+Inf"} 2' %labels in text)
+        self.assertTrue('nodedcm_operation_seconds_count{%s} 2' %labels in text)
+        self.assertTrue('nodedcm_active_associations{ae="STORESCU",peer="PACS@10.0.0.1"} 2' in text)
+
+        server = MetricsServer(self.metrics, 0)
+        try:
+            url = 'http://127.0.0.1:%s/metrics' %(server.server_address[1])
+            self.assertEqual(urlopen(url).read().decode('utf-8'), text)
+        finally:
+            server.stop()
@@ -0,0 +1,76 @@
+'''
+
+test_pool.py: Testing the reuse of associations
+
+The MIT License (MIT)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+from node_dcm.pool import AssociationPool
+
+from unittest import TestCase
+import time
+
+
+class Association:
+
+    def __init__(self):
+        self.is_established = True
+        self.released = False
+
+    def release(self):
+        self.is_established = False
+        self.released = True
+
+
+class TestAssociationPool(TestCase):
+
+    def test_reuse(self):
+        '''test that an association is reused for the same key only
+        '''
+        pool = AssociationPool(idle_timeout=30)
+        key = ('localhost', 11112, 'PACS', None, ())
+        assoc = pool.acquire(key, Association)
+        pool.put(key, assoc)
+
+        other = ('localhost', 11112, 'OTHER', None, ())
+        self.assertFalse(pool.acquire(other, Association) is assoc)
+        self.assertTrue(pool.acquire(key, Association) is assoc)
+        self.assertFalse(pool.acquire(key, Association) is assoc)
+
+        # An association closed by the peer isn't handed out
+        pool.put(key, assoc)
+        assoc.is_established = False
+        self.assertFalse(pool.acquire(key, Association) is assoc)
+
+    def test_idle_timeout(self):
+        '''test that idle associations are released after the timeout
+        '''
+        pool = AssociationPool(idle_timeout=0.2)
+        key = ('localhost', 11112, 'PACS', None, ())
+        assoc = pool.acquire(key, Association)
+        pool.put(key, assoc)
+
+        time.sleep(0.5)
+        self.assertTrue(assoc.released)
+        self.assertEqual(pool.idle, dict())
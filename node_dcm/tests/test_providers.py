@@ -0,0 +1,270 @@
+'''
+
+test_providers.py: Testing the responses of the service class providers
+
+The MIT License (MIT)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+import os
+
+from pydicom import read_file
+from pydicom.dataset import Dataset
+
+from node_dcm.metrics import metrics
+from node_dcm.providers import (
+    Find,
+    Get,
+    Move,
+    Store
+)
+from node_dcm.reader import read_header
+
+from unittest import TestCase
+import shutil
+import tempfile
+import threading
+
+here = os.path.dirname(os.path.abspath(__file__))
+dataset_base = os.path.join(here, 'dicom_files')
+
+
+def get_identifier():
+    '''an identifier for the instances of the test files, by SOPInstanceUID'''
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'IMAGE'
+    ds.SOPInstanceUID = [read_header(os.path.join(dataset_base, x)).SOPInstanceUID
+                         for x in ['CTImageStorage.dcm',
+                                   'MRImageStorage_JPG2000_Lossless.dcm',
+                                   'RTImageStorage.dcm']]
+    return ds
+
+
+class TestMove(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name in ['CTImageStorage.dcm', 'RTImageStorage.dcm']:
+            shutil.copyfile(os.path.join(dataset_base, name),
+                            os.path.join(self.tmpdir, name))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_move_instances(self):
+        '''test that every pending response of a move carries an instance for
+        the AE to send
+        '''
+        move = Move(self.tmpdir, port=11312,
+                    destinations={'DEST': ('127.0.0.1', 11313)})
+
+        responses = list(move.on_c_move(get_identifier(), b'DEST'))
+        self.assertEqual(responses[0], ('127.0.0.1', 11313))
+        self.assertEqual(responses[1], 2)
+
+        pending = [x for x in responses[2:] if x[0] == 0xFF00]
+        self.assertEqual(len(pending), 2)
+        for status, instance in pending:
+            self.assertTrue('SOPClassUID' in instance)
+            self.assertTrue('SOPInstanceUID' in instance)
+
+    def test_unreadable(self):
+        '''test that a file that can't be read is a failed sub-operation
+        '''
+        move = Move(self.tmpdir, port=11314, destinations={'DEST': ('127.0.0.1', 11313)})
+        os.remove(os.path.join(self.tmpdir, 'RTImageStorage.dcm'))
+
+        responses = list(move.on_c_move(get_identifier(), b'DEST'))
+        self.assertEqual(responses[1], 2)
+        self.assertEqual(len([x for x in responses[2:] if x[0] == 0xFF00]), 1)
+        status, ds = responses[-1]
+        self.assertEqual(status, move.warning)
+        self.assertEqual(ds.NumberOfFailedSuboperations, 1)
+
+
+class TestGet(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name in ['CTImageStorage.dcm', 'RTImageStorage.dcm']:
+            shutil.copyfile(os.path.join(dataset_base, name),
+                            os.path.join(self.tmpdir, name))
+        self.get = Get(self.tmpdir, port=11315)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_unreadable(self):
+        '''test that files that can't be read are failed sub-operations, and the
+        get fails if none could be read
+        '''
+        responses = list(self.get.on_c_get(get_identifier()))
+        self.assertEqual(responses[0], 2)
+        self.assertEqual([x[0] for x in responses[1:]], [0xFF00, 0xFF00])
+
+        for name in os.listdir(self.tmpdir):
+            os.remove(os.path.join(self.tmpdir, name))
+        responses = list(self.get.on_c_get(get_identifier()))
+        self.assertEqual(responses[0], 2)
+        status, ds = responses[-1]
+        self.assertEqual(status, self.get.out_of_resources_unable)
+        self.assertEqual(ds.NumberOfFailedSuboperations, 2)
+
+
+    def test_bytes(self):
+        '''test that the bytes of an instance are recorded once its sub-operation
+        is done, not when it is read
+        '''
+        self.get.prefetch = 2
+        labels = metrics.get_labels('C-GET', 'scp', self.get.ae.ae_title)
+        before = metrics.bytes.get(labels, 0)
+        sizes = sorted([os.path.getsize(os.path.join(self.tmpdir, x))
+                        for x in os.listdir(self.tmpdir)])
+
+        responses = self.get.on_c_get(get_identifier())
+        self.assertEqual(next(responses), 2)
+        next(responses)
+        self.assertEqual(metrics.bytes.get(labels, 0), before)
+        next(responses)
+        self.assertTrue(metrics.bytes[labels] - before in sizes)
+        responses.close()
+
+
+    def test_no_condition(self):
+        '''test that an identifier without a unique key to match is refused, not
+        matched to every instance
+        '''
+        for level, key, value in [('IMAGE', 'Modality', '*'),
+                                  ('SERIES', 'PatientName', 'nobody'),
+                                  ('STUDY', 'Modality', 'CT'),
+                                  ('STUDY', 'StudyInstanceUID', '*')]:
+            ds = Dataset()
+            ds.QueryRetrieveLevel = level
+            setattr(ds, key, value)
+            responses = list(self.get.on_c_get(ds))
+            self.assertEqual(responses, [0, (self.get.identifier_doesnt_match_sop, None)])
+
+        ds = Dataset()
+        ds.QueryRetrieveLevel = 'STUDY'
+        ds.PatientID = '1CT1'
+        self.assertEqual(next(self.get.on_c_get(ds)), 1)
+
+
+class TestStore(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dataset = read_file(os.path.join(dataset_base, 'CTImageStorage.dcm'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def block(self, store):
+        '''occupy the (single) writer of a store until the returned event is set'''
+        started = threading.Event()
+        release = threading.Event()
+        def wait(job=None):
+            started.set()
+            release.wait()
+        store.writers.submit(wait)
+        started.wait()
+        return release
+
+    def test_acknowledge_queued(self):
+        '''test that without fsync a store is acknowledged once it's queued
+        '''
+        store = Store(self.tmpdir, port=11319, writers=1)
+        release = self.block(store)
+        self.assertEqual(store.on_c_store(self.dataset), 0x0000)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+        release.set()
+        store.writers.join()
+        self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+        store.writers.stop()
+
+    def test_write_timeout(self):
+        '''test that a store that isn't written in time fails, and is then not
+        written at all
+        '''
+        store = Store(self.tmpdir, port=11320, writers=1, fsync='each',
+                      write_timeout=0.1)
+        release = self.block(store)
+        self.assertEqual(store.on_c_store(self.dataset), 0xA700)
+
+        release.set()
+        store.writers.join()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        store.writers.stop()
+
+
+class TestFind(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.names = ['CTImageStorage.dcm',
+                      'MRImageStorage_JPG2000_Lossless.dcm',
+                      'RTImageStorage.dcm']
+        for name in self.names:
+            shutil.copyfile(os.path.join(dataset_base, name),
+                            os.path.join(self.tmpdir, name))
+        self.find = Find(self.tmpdir, port=11317)
+        self.find.batch_size = 1
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_max_results(self):
+        '''test that no more than max_results matches are returned
+        '''
+        self.assertEqual(len(list(self.find.on_c_find(get_identifier()))), 3)
+        self.find.max_results = 2
+        responses = list(self.find.on_c_find(get_identifier()))
+        self.assertEqual([x[0] for x in responses], [0xFF00, 0xFF00])
+
+    def test_cancel(self):
+        '''test that a cancel ends the matches at the next batch, and that the
+        next find isn't cancelled by it
+        '''
+        responses = self.find.on_c_find(get_identifier())
+        self.assertEqual(next(responses)[0], 0xFF00)
+        self.find.on_c_cancel_find()
+        self.assertEqual(list(responses), [(self.find.matching_terminated_cancel, None)])
+
+        self.assertTrue(self.find.cancel)
+        responses = list(self.find.on_c_find(get_identifier()))
+        self.assertEqual([x[0] for x in responses], [0xFF00] * 3)
+        self.assertFalse(self.find.cancel)
+
+    def test_unsupported(self):
+        '''test that a key that can't be matched at the level is a warning, and
+        doesn't match everything
+        '''
+        ds = Dataset()
+        ds.QueryRetrieveLevel = 'SERIES'
+        ds.InstitutionName = 'nowhere'
+        self.assertEqual(list(self.find.on_c_find(ds)), [])
+
+        ds.Modality = 'CT'
+        responses = list(self.find.on_c_find(ds))
+        self.assertEqual([x[0] for x in responses], [0xFF01])
@@ -0,0 +1,124 @@
+'''
+
+test_reader.py: Testing how dicom files are read for sending
+
+The MIT License (MIT)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+import os
+
+from pydicom import read_file
+
+from node_dcm.reader import (
+    Prefetcher,
+    read_dataset,
+    read_header
+)
+
+from unittest import TestCase
+import shutil
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+dataset_base = os.path.join(here, 'dicom_files')
+
+
+class TestRead(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dicom = os.path.join(self.tmpdir, 'CTImageStorage.dcm')
+        shutil.copyfile(os.path.join(dataset_base, 'CTImageStorage.dcm'), self.dicom)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_header(self):
+        '''test that the header is read without the pixel data, and only the
+        tags asked for
+        '''
+        ds = read_header(self.dicom)
+        self.assertEqual(ds.Modality, 'CT')
+        self.assertTrue('PixelData' not in ds)
+
+        ds = read_header(self.dicom, tags=['Modality', 'PatientID'])
+        self.assertEqual(ds.Modality, 'CT')
+        self.assertEqual(ds.PatientID, '1CT1')
+        self.assertTrue('StudyInstanceUID' not in ds)
+        self.assertTrue('PixelData' not in ds)
+
+    def test_read_dataset(self):
+        '''test that bulk elements are deferred, and read from the file when
+        accessed
+        '''
+        pixels = read_file(self.dicom).PixelData
+        self.assertEqual(read_dataset(self.dicom).PixelData, pixels)
+
+        # Once the file is gone, only the elements read up front are there
+        deferred = read_dataset(self.dicom)
+        complete = read_dataset(self.dicom, defer_size=None)
+        os.remove(self.dicom)
+        self.assertEqual(deferred.Modality, 'CT')
+        self.assertEqual(complete.PixelData, pixels)
+        self.assertRaises(IOError, getattr, deferred, 'PixelData')
+
+
+class TestPrefetcher(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dicoms = [os.path.join(dataset_base, x) for x in
+                       ['CTImageStorage.dcm',
+                        'MRImageStorage_JPG2000_Lossless.dcm',
+                        'RTImageStorage.dcm']]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_order(self):
+        '''test that files are yielded in order, read completely
+        '''
+        missing = os.path.join(self.tmpdir, 'missing.dcm')
+        paths = self.dicoms + [missing]
+
+        # A byte limit smaller than one file still reads every file
+        results = list(Prefetcher(paths, depth=2, max_bytes=1))
+        self.assertEqual([x[0] for x in results], paths)
+        for path, dataset, error in results[:3]:
+            self.assertEqual(error, None)
+            self.assertTrue('PixelData' in dataset)
+        self.assertEqual(results[3][1], None)
+        self.assertTrue(results[3][2] is not None)
+
+    def test_bounded(self):
+        '''test that no more than depth files are read ahead
+        '''
+        prefetcher = Prefetcher(self.dicoms, depth=1)
+        prefetcher.thread.join(0.5)
+        self.assertTrue(prefetcher.thread.is_alive())
+        self.assertEqual(len(prefetcher.ready), 1)
+
+        prefetcher.close()
+        prefetcher.thread.join(5)
+        self.assertFalse(prefetcher.thread.is_alive())
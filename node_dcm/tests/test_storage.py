@@ -0,0 +1,230 @@
+'''
+
+test_storage.py: Testing how received datasets are written to disk
+
+The MIT License (MIT)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import os
+
+from pydicom import read_file
+from pydicom.filebase import DicomBytesIO
+from pydicom.filereader import read_dataset
+from pydicom.filewriter import write_dataset
+from pydicom.uid import (
+    ExplicitVRLittleEndian,
+    ImplicitVRLittleEndian
+)
+
+from node_dcm import storage
+from node_dcm.storage import (
+    StorageLayout,
+    WriteJob,
+    WriterPool,
+    atomic_write,
+    write_passthrough
+)
+
+from unittest import TestCase
+import shutil
+import tempfile
+import threading
+
+here = os.path.dirname(os.path.abspath(__file__))
+dataset_base = os.path.join(here, 'dicom_files')
+
+
+class TestStorage(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dataset = read_file(os.path.join(dataset_base, 'CTImageStorage.dcm'))
+        self.filename = 'CT.%s' %(self.dataset.SOPInstanceUID)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_layouts(self):
+        '''test that each layout writes a file to its folders
+        '''
+        expected = {'flat': 0, 'hashed': 2, 'hierarchy': 3}
+        for name, depth in expected.items():
+            layout = StorageLayout(self.tmpdir, layout=name)
+            path = layout.get_path(self.filename, self.dataset)
+            folder = os.path.relpath(os.path.dirname(path), self.tmpdir)
+            self.assertEqual(len([x for x in folder.split(os.sep) if x != '.']), depth)
+
+            layout.make_folder(path)
+            atomic_write(path, write_passthrough, self.dataset, '1.2.3')
+            self.assertEqual(read_file(path).SOPInstanceUID, self.dataset.SOPInstanceUID)
+            self.assertTrue(os.path.dirname(path) in layout.folders)
+
+        path = StorageLayout(self.tmpdir, 'hierarchy').get_path(self.filename, self.dataset)
+        self.assertTrue(path.startswith(os.path.join(self.tmpdir, '1CT1')))
+
+    def receive(self, is_implicit_VR, is_little_endian):
+        '''return the test dataset as a peer would send it, encoded and decoded
+        in a transfer syntax (see pynetdicom3.dsutils.decode)'''
+        fp = DicomBytesIO()
+        fp.is_implicit_VR = is_implicit_VR
+        fp.is_little_endian = is_little_endian
+        write_dataset(fp, self.dataset)
+        fp.seek(0)
+        return read_dataset(fp, is_implicit_VR, is_little_endian)
+
+    def test_write_passthrough(self):
+        '''test that a received dataset is stored in its transfer syntax, and
+        reads back the same
+        '''
+        path = os.path.join(self.tmpdir, self.filename)
+        for transfer_syntax, is_implicit_VR in [(ImplicitVRLittleEndian, True),
+                                                (ExplicitVRLittleEndian, False)]:
+            received = self.receive(is_implicit_VR, True)
+            write_passthrough(path, received, '1.2.3')
+
+            stored = read_file(path)
+            self.assertEqual(stored.file_meta.TransferSyntaxUID, transfer_syntax)
+            self.assertEqual(stored.file_meta.ImplementationClassUID, '1.2.3')
+            self.assertEqual(stored.is_implicit_VR, is_implicit_VR)
+            self.assertEqual(len(stored), len(received))
+            for element in received:
+                self.assertEqual(stored[element.tag].value, element.value)
+            self.assertEqual(stored.PixelData, self.dataset.PixelData)
+
+    def test_atomic_write(self):
+        '''test that a failed write leaves no partial or temporary file
+        '''
+        def write(path):
+            with open(path, 'w') as filey:
+                filey.write('partial')
+            raise IOError('disk full')
+
+        path = os.path.join(self.tmpdir, self.filename)
+        self.assertRaises(IOError, atomic_write, path, write)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_cancelled_write(self):
+        '''test that the file of a cancelled job isn't put in place, and that a
+        committed job can't be cancelled
+        '''
+        def write(path):
+            with open(path, 'w') as filey:
+                filey.write('written')
+
+        path = os.path.join(self.tmpdir, self.filename)
+        job = WriteJob(write, ())
+        self.assertTrue(job.cancel())
+        self.assertEqual(atomic_write(path, write, job=job), None)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+        job = WriteJob(write, ())
+        self.assertEqual(atomic_write(path, write, job=job), path)
+        self.assertFalse(job.cancel())
+        self.assertEqual(os.listdir(self.tmpdir), [self.filename])
+
+
+class TestWriterPool(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.synced = []
+        self.fsync_path = storage.fsync_path
+        storage.fsync_path = self.synced.append
+
+    def tearDown(self):
+        storage.fsync_path = self.fsync_path
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, job=None):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as filey:
+            filey.write(name)
+        return path
+
+    def test_queue_full(self):
+        '''test that a job is refused when the queue is full
+        '''
+        started = threading.Event()
+        release = threading.Event()
+        def block(job=None):
+            started.set()
+            release.wait()
+
+        pool = WriterPool(writers=1, queue_size=1)
+        first = pool.submit(block)
+        started.wait()
+        second = pool.submit(self.write, 'second')
+        self.assertEqual(pool.submit(self.write, 'third'), None)
+        self.assertFalse(second.wait(0.01))
+
+        release.set()
+        self.assertTrue(first.wait(5))
+        self.assertTrue(second.wait(5))
+        pool.stop()
+
+    def test_fsync_policies(self):
+        '''test that a job is done only once its file (and folder) is flushed
+        '''
+        pool = WriterPool(writers=1, fsync=None)
+        self.assertTrue(pool.submit(self.write, 'none').wait(5))
+        self.assertEqual(self.synced, [])
+        pool.stop()
+
+        pool = WriterPool(writers=1, fsync='each')
+        job = pool.submit(self.write, 'each')
+        self.assertTrue(job.wait(5))
+        self.assertEqual(self.synced, [job.path, self.tmpdir])
+        pool.stop()
+
+        # A group is flushed as soon as nothing else is waiting to be written
+        del self.synced[:]
+        pool = WriterPool(writers=1, fsync='group', group_interval=60)
+        jobs = [pool.submit(self.write, 'group%s' %(ii)) for ii in range(3)]
+        for job in jobs:
+            self.assertTrue(job.wait(5))
+        for job in jobs:
+            self.assertTrue(job.path in self.synced)
+        self.assertTrue(self.tmpdir in self.synced)
+        pool.stop()
+
+    def test_errors(self):
+        '''test that write and fsync errors reach the caller
+        '''
+        def fail(job=None):
+            raise IOError('disk full')
+
+        pool = WriterPool(writers=1)
+        job = pool.submit(fail)
+        self.assertFalse(job.wait(5))
+        self.assertTrue(isinstance(job.error, IOError))
+        pool.stop()
+
+        def fail_fsync(path):
+            raise OSError('fsync failed')
+        storage.fsync_path = fail_fsync
+        for fsync in ['each', 'group']:
+            pool = WriterPool(writers=1, fsync=fsync)
+            job = pool.submit(self.write, fsync)
+            self.assertFalse(job.wait(5))
+            self.assertTrue(isinstance(job.error, OSError))
+            pool.stop()
@@ -0,0 +1,151 @@
+'''
+
+test_transfer.py: Testing sending datasets over several associations
+
+The MIT License (MIT)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+from pydicom.dataset import Dataset
+
+from node_dcm.pool import AssociationPool
+from node_dcm.transfer import (
+    ParallelSender,
+    get_context_groups,
+    get_result,
+    scan_context
+)
+
+from unittest import TestCase
+import os
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+dataset_base = os.path.join(here, 'dicom_files')
+
+
+class Association:
+
+    def __init__(self, ae):
+        self.ae = ae
+        self.is_established = True
+
+    def send_c_store(self, dataset):
+        with self.ae.lock:
+            self.ae.sent.append((id(self), dataset.SOPInstanceUID))
+        time.sleep(0.01)
+        return dataset.Status
+
+    def release(self):
+        self.is_established = False
+
+
+class ApplicationEntity:
+
+    def __init__(self):
+        self.ae_title = 'STORESCU'
+        self.lock = threading.Lock()
+        self.sent = []
+
+    def associate(self, address, port, name):
+        return Association(self)
+
+
+class TestTransfer(TestCase):
+
+    def get_items(self, statuses):
+        for ii, status in enumerate(statuses):
+            ds = Dataset()
+            ds.SOPInstanceUID = '1.2.%s' %(ii)
+            ds.Status = status
+            yield 'file%s.dcm' %(ii), ds, None
+        yield 'missing.dcm', None, IOError('missing')
+
+    def test_parallel_send(self):
+        '''test that datasets are spread over the associations, and that each
+        is finished with its status
+        '''
+        ae = ApplicationEntity()
+        statuses = [0x0000] * 18 + [0xB000, 0xA700]
+        sender = ParallelSender(ae, 'localhost', 11112, 'DEST', associations=4)
+
+        paths = []
+        results = []
+        for path, status in sender.send(self.get_items(statuses)):
+            results.append(get_result(status))
+            paths.append(path)
+
+        self.assertEqual(len(paths), 21)
+        self.assertEqual(len(ae.sent), 20)
+        self.assertEqual(len(set([x[0] for x in ae.sent])), 4)
+
+        self.assertEqual(results.count('completed'), 18)
+        self.assertEqual(results.count('warning'), 1)
+        self.assertEqual(results.count('failed'), 2)
+
+    def test_pool(self):
+        '''test that the associations of a send are kept in a pool, and reused
+        by the next send
+        '''
+        ae = ApplicationEntity()
+        pool = AssociationPool()
+        for ii in range(2):
+            sender = ParallelSender(ae, 'localhost', 11112, 'DEST', associations=2,
+                                    pool=pool)
+            results = list(sender.send(self.get_items([0x0000] * 4)))
+            self.assertEqual(len(results), 5)
+            self.assertEqual(len(pool.idle[sender.key]), 2)
+
+        self.assertEqual(len(ae.sent), 8)
+        self.assertEqual(len(set([x[0] for x in ae.sent])), 2)
+        pool.clear()
+
+    def test_context_groups(self):
+        '''test that only the contexts of the files are proposed, in groups
+        '''
+        dicom = os.path.join(dataset_base, 'MRImageStorage_JPG2000_Lossless.dcm')
+        self.assertEqual(scan_context(dicom)[:2], ('1.2.840.10008.5.1.4.1.1.4',
+                                                   '1.2.840.10008.1.2.4.90'))
+
+        contexts = dict([('file%s.dcm' %(ii), ('1.2.%s' %(ii % 200), '1.2.840.10008.1.2'))
+                         for ii in range(400)])
+        groups = get_context_groups(contexts)
+        self.assertEqual([len(x[0]) for x in groups], [128, 72])
+        self.assertEqual(sum([len(x[2]) for x in groups]), 400)
+        self.assertEqual(groups[0][1], ['1.2.840.10008.1.2'])
+
+        # Files of a SOP class in another transfer syntax are sent in their own group
+        contexts = dict([('file%s.dcm' %(ii), ('1.2.%s' %(ii % 100),
+                                               ['1.2.840.10008.1.2.1',
+                                                '1.2.840.10008.1.2.4.90'][ii % 2]))
+                         for ii in range(400)])
+        groups = get_context_groups(contexts, limit=30)
+        self.assertEqual([x[1] for x in groups], [['1.2.840.10008.1.2.1']] * 2 +
+                                                 [['1.2.840.10008.1.2.4.90']] * 2)
+        self.assertEqual([len(x[0]) for x in groups], [30, 20, 30, 20])
+        for sop_classes, transfer_syntaxes, paths in groups:
+            for path in paths:
+                self.assertEqual(contexts[path][1], transfer_syntaxes[0])
+                self.assertTrue(contexts[path][0] in sop_classes)
+        self.assertEqual(sum([len(x[2]) for x in groups]), 400)
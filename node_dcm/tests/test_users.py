@@ -0,0 +1,114 @@
+'''
+
+test_users.py: Testing the service class users
+
+The MIT License (MIT)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+
+import os
+
+from node_dcm import users
+from node_dcm.transfer import Throughput
+from node_dcm.users import Store
+
+from unittest import TestCase
+import shutil
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+dataset_base = os.path.join(here, 'dicom_files')
+
+
+class Sender:
+    '''answers each dataset with the status for its file in statuses'''
+
+    statuses = dict()
+
+    def __init__(self, ae, address, port, name, associations=1, pdu_max=None,
+                 pool=None):
+        pass
+
+    def send(self, items):
+        for dcm_file, dataset, error in items:
+            if dataset is None:
+                yield dcm_file, None
+            else:
+                yield dcm_file, self.statuses[os.path.basename(dcm_file)]
+
+
+class TestStore(TestCase):
+
+    def setUp(self):
+        self.sender = users.ParallelSender
+        self.scan_context = users.scan_context
+        users.ParallelSender = Sender
+        Sender.statuses = {'CTImageStorage.dcm': 0x0000,
+                           'MRImageStorage_JPG2000_Lossless.dcm': 0xB000,
+                           'RTImageStorage.dcm': 0xA700}
+        self.dicoms = [os.path.join(dataset_base, x) for x in sorted(Sender.statuses)]
+        self.store = Store(peer='127.0.0.1', to_port=11316)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        users.ParallelSender = self.sender
+        users.scan_context = self.scan_context
+        shutil.rmtree(self.tmpdir)
+
+    def test_send_files(self):
+        '''test that only the files the peer stored are in the throughput
+        '''
+        throughput = Throughput()
+        missing = os.path.join(dataset_base, 'missing.dcm')
+        results = dict(self.store.send_files(None, self.dicoms + [missing], throughput))
+        self.assertEqual(results[self.dicoms[1]], 0xB000)
+        self.assertEqual(results[missing], None)
+        self.assertEqual(throughput.instances, 2)
+        self.assertEqual(throughput.bytes, sum([os.path.getsize(x) for x in self.dicoms[:2]]))
+
+    def test_send(self):
+        '''test that send returns the status of each file, and that a failure
+        status fails the file
+        '''
+        results = self.store.send(self.dicoms)
+        self.assertEqual(sorted(results), sorted(zip(self.dicoms, [0x0000, 0xB000, 0xA700])))
+        self.assertEqual(self.store.throughput.instances, 2)
+
+    def test_resume(self):
+        '''test that a resumed send skips the files that were sent, without
+        reading them
+        '''
+        journal_file = os.path.join(self.tmpdir, 'send.journal')
+        self.store.send(self.dicoms, journal_file=journal_file)
+
+        scanned = []
+        def scan_context(dcm_file, cache=None):
+            scanned.append(dcm_file)
+            return self.scan_context(dcm_file, cache=cache)
+        users.scan_context = scan_context
+
+        Sender.statuses['RTImageStorage.dcm'] = 0x0000
+        results = self.store.send(self.dicoms, journal_file=journal_file, mode='resume')
+        self.assertEqual(results, [(self.dicoms[2], 0x0000)])
+        self.assertEqual(scanned, [self.dicoms[2]])
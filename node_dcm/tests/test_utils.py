@@ -0,0 +1,91 @@
+'''
+
+test_utils.py: Testing finding dicom files
+
+The MIT License (MIT)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+import os
+
+from node_dcm.utils import (
+    find_dicoms,
+    get_dicom_files,
+    recursive_find_dicoms
+)
+
+from unittest import TestCase
+import shutil
+import tempfile
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+dataset_base = os.path.join(here, 'dicom_files')
+
+
+class TestFindDicoms(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dicoms = []
+        for folder in ['', 'a', 'a/b', 'c', 'd/e/f']:
+            os.makedirs(os.path.join(self.tmpdir, folder, 'empty'))
+            self.dicoms.append(os.path.join(self.tmpdir, folder, 'image.dcm'))
+            shutil.copyfile(os.path.join(dataset_base, 'CTImageStorage.dcm'),
+                            self.dicoms[-1])
+            with open(os.path.join(self.tmpdir, folder, 'notes.txt'), 'w') as filey:
+                filey.write('not a dicom')
+        self.dicoms = [os.path.normpath(x) for x in self.dicoms]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_find_dicoms(self):
+        '''test that dicoms are found with one or more workers
+        '''
+        for workers in [1, 3]:
+            found = [os.path.normpath(x) for x in find_dicoms(self.tmpdir, workers=workers)]
+            self.assertEqual(sorted(found), sorted(self.dicoms))
+        self.assertEqual(len(recursive_find_dicoms(self.tmpdir)), 5)
+
+    def test_stop(self):
+        '''test that the scan threads finish when iterating stops early
+        '''
+        before = set(threading.enumerate())
+        found = find_dicoms(self.tmpdir, workers=3)
+        next(found)
+        next(found)
+        found.close()
+
+        for ii in range(50):
+            if len(set(threading.enumerate()) - before) == 0:
+                break
+            time.sleep(0.1)
+        self.assertEqual(set(threading.enumerate()) - before, set())
+
+    def test_get_dicom_files(self):
+        '''test that single files and folders are found and validated
+        '''
+        found = get_dicom_files([os.path.join(self.tmpdir, 'a'), self.dicoms[0]])
+        self.assertEqual(sorted(found), sorted(self.dicoms[:3]))
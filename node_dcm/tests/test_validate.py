@@ -0,0 +1,84 @@
+'''
+
+test_validate.py: Testing the validation of dicom files
+
+The MIT License (MIT)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+import os
+
+from node_dcm.validate import (
+    validate_dicoms,
+    validate_files
+)
+
+from unittest import TestCase
+import shutil
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+dataset_base = os.path.join(here, 'dicom_files')
+
+
+class TestValidate(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(dataset_base, 'CTImageStorage.dcm'), 'rb') as filey:
+            content = filey.read()
+
+        self.dicoms = []
+        for ii in range(8):
+            self.dicoms.append(os.path.join(self.tmpdir, 'image%s.dcm' %(ii)))
+            with open(self.dicoms[-1], 'wb') as filey:
+                filey.write(content)
+
+        self.text = os.path.join(self.tmpdir, 'text.dcm')
+        with open(self.text, 'w') as filey:
+            filey.write('not a dicom file')
+
+        # A valid start, but a header that is cut short
+        self.truncated = os.path.join(self.tmpdir, 'truncated.dcm')
+        with open(self.truncated, 'wb') as filey:
+            filey.write(content[:200])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_quick(self):
+        '''test that the quick check only looks at the start of a file
+        '''
+        missing = os.path.join(self.tmpdir, 'missing.dcm')
+        results = validate_files([self.dicoms[0], self.text, self.truncated, missing])
+        self.assertEqual([x.valid for x in results], [True, False, True, False])
+        self.assertEqual(results[1].error, 'File is too small')
+
+    def test_deep(self):
+        '''test that a deep check parses the headers, over a process pool
+        '''
+        dcm_files = self.dicoms + [self.text, self.truncated]
+        results = validate_files(dcm_files, deep=True, workers=2)
+        self.assertEqual([x.path for x in results], dcm_files)
+        self.assertEqual([x.valid for x in results], [True] * 8 + [False, False])
+        self.assertEqual(validate_dicoms(dcm_files, deep=True, workers=1), self.dicoms)
@@ -0,0 +1,94 @@
+'''
+
+test_watcher.py: Testing the watcher of changed dicom files
+
+The MIT License (MIT)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+
+import os
+
+from inotify_simple import (
+    Event,
+    flags
+)
+
+from node_dcm.watcher import ChangeWatcher
+
+from unittest import TestCase
+import shutil
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+dataset_base = os.path.join(here, 'dicom_files')
+
+
+class TestChangeWatcher(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.outside = tempfile.mkdtemp()
+        self.base = os.path.join(self.tmpdir, 'base')
+        os.makedirs(os.path.join(self.base, 'a'))
+        self.watcher = ChangeWatcher(self.base)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.tmpdir)
+        shutil.rmtree(self.outside)
+
+    def add_dicom(self, folder):
+        path = os.path.join(self.base, folder, 'image.dcm')
+        shutil.copyfile(os.path.join(dataset_base, 'CTImageStorage.dcm'), path)
+        return path
+
+    def test_changes(self):
+        '''test that changed files are found, and that the rest of a batch is
+        handled when the changes are unknown
+        '''
+        path = self.add_dicom('a')
+        self.assertEqual(self.watcher.changes(), set([path]))
+
+        # The directory created after one is moved out is still watched
+        shutil.move(os.path.join(self.base, 'a'), self.outside)
+        os.mkdir(os.path.join(self.base, 'b'))
+        self.assertEqual(self.watcher.changes(), None)
+        self.assertEqual(self.watcher.changes(), set())
+
+        path = self.add_dicom('b')
+        self.assertEqual(self.watcher.changes(), set([path]))
+
+    def test_overflow(self):
+        '''test that the tree is watched again when events were lost
+        '''
+        os.mkdir(os.path.join(self.base, 'b'))
+        self.watcher.inotify.read(timeout=0)
+
+        read = self.watcher.inotify.read
+        self.watcher.inotify.read = lambda timeout: [Event(-1, flags.Q_OVERFLOW, 0, '')]
+        self.assertEqual(self.watcher.changes(), None)
+        self.watcher.inotify.read = read
+
+        path = self.add_dicom('b')
+        self.assertEqual(self.watcher.changes(), set([path]))
@@ -0,0 +1,318 @@
+'''
+
+transfer.py: send datasets to a peer over several associations at once,
+             and count the results of the sub-operations
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+from node_dcm.cache import get_file_stat
+from node_dcm.logman import bot
+from node_dcm.metrics import (
+    get_peer,
+    metrics
+)
+from node_dcm.reader import read_header
+from pydicom.dataset import Dataset
+from pydicom.uid import ImplicitVRLittleEndian
+import os
+import sys
+import threading
+import time
+
+if sys.version_info[0] < 3:
+    import Queue as queue
+else:
+    import queue
+
+
+# The most presentation contexts that an association can propose
+MAX_CONTEXTS = 128
+
+
+def get_batches(items, size):
+    '''get_batches groups the items of an iterable into lists of size items'''
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+# The attributes scan_context reads, as cached (see node_dcm.cache)
+context_fields = ['SOPClassUID', 'TransferSyntaxUID', 'SOPInstanceUID']
+
+
+def scan_context(dcm_file, cache=None):
+    '''scan_context returns the (SOP class, transfer syntax) of a dicom file,
+    the presentation context needed to send it, and its SOPInstanceUID, from
+    its header only. With a cache, an unchanged file isn't read again.
+    :param dcm_file: the dicom file to scan
+    :param cache: a HeaderCache to look up and store the context (default None)
+    '''
+    stat = None
+    if cache is not None:
+        attributes = cache.get_attributes(dcm_file, context_fields)
+        if attributes is not None:
+            return tuple([attributes[x] for x in context_fields])
+        stat = get_file_stat(dcm_file)
+
+    ds = read_header(dcm_file, tags=['SOPClassUID', 'SOPInstanceUID'])
+    meta = getattr(ds, 'file_meta', None) or Dataset()
+    sop_class = ds.get('SOPClassUID') or meta.get('MediaStorageSOPClassUID')
+    if sop_class is None:
+        raise ValueError("no SOPClassUID")
+    transfer_syntax = meta.get('TransferSyntaxUID') or ImplicitVRLittleEndian
+    sop_instance = ds.get('SOPInstanceUID') or meta.get('MediaStorageSOPInstanceUID')
+    context = (str(sop_class), str(transfer_syntax), str(sop_instance))
+
+    if cache is not None:
+        cache.put(dcm_file, attributes=dict(zip(context_fields, context)), stat=stat)
+    return context
+
+
+def get_context_groups(contexts, limit=MAX_CONTEXTS):
+    '''get_context_groups splits files into groups to send over one association
+    each. A peer accepts a single transfer syntax for each presentation context,
+    so a group is the files in one transfer syntax, and proposes a context for
+    each of their SOP classes (at most limit) with only that transfer syntax.
+    :param contexts: a lookup of paths to their (SOP class, transfer syntax),
+                     other values after these are ignored (see scan_context)
+    :param limit: the maximum number of contexts (SOP classes) of a group
+    :returns groups: a list of (sop_classes, [transfer_syntax], paths)
+    '''
+    syntaxes = dict()
+    for path, context in contexts.items():
+        sop_class, transfer_syntax = context[:2]
+        classes = syntaxes.setdefault(transfer_syntax, dict())
+        classes.setdefault(sop_class, []).append(path)
+
+    groups = []
+    for transfer_syntax in sorted(syntaxes):
+        classes = syntaxes[transfer_syntax]
+        names = sorted(classes)
+        for start in range(0, len(names), limit):
+            sop_classes = names[start:start + limit]
+            paths = []
+            for sop_class in sop_classes:
+                paths += classes[sop_class]
+            groups.append((sop_classes, [transfer_syntax], sorted(paths)))
+    return groups
+
+
+def get_result(status):
+    '''get_result returns the result of a C-STORE status: completed, warning or
+    failed. The status can be a pynetdicom3 Status, a status dataset, an int,
+    or None (the dataset couldn't be read or sent).
+    '''
+    if status is None:
+        return 'failed'
+
+    status_type = getattr(status, 'status_type', None)
+    if status_type is None:
+        code = int(getattr(status, 'Status', status))
+        status_type = 'Failure'
+        if code == 0x0000:
+            status_type = 'Success'
+        elif code & 0xF000 == 0xB000:
+            status_type = 'Warning'
+
+    if status_type == 'Success':
+        return 'completed'
+    if status_type == 'Warning':
+        return 'warning'
+    return 'failed'
+
+
+def get_size(path):
+    '''get_size returns the size of a file, or 0 if it can't be found'''
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+class Throughput:
+    '''Throughput measures the instances and bytes sent since it was created'''
+
+    def __init__(self):
+        self.start = time.time()
+        self.instances = 0
+        self.bytes = 0
+
+
+    def record(self, size):
+        '''record a sent instance of size bytes'''
+        self.instances += 1
+        self.bytes += size
+
+
+    def rates(self):
+        '''return the (instances per second, MB per second) so far'''
+        seconds = max(time.time() - self.start, 1e-6)
+        return self.instances / seconds, self.bytes / seconds / (1024 * 1024)
+
+
+    def __str__(self):
+        instances, megabytes = self.rates()
+        return "%s instances in %.1fs (%.1f instances/s, %.2f MB/s)" %(self.instances,
+                                                                      time.time() - self.start,
+                                                                      instances,
+                                                                      megabytes)
+
+
+class ParallelSender:
+    '''A ParallelSender sends datasets to a peer (C-STORE) over a number of
+    associations at once, each used by its own thread, to keep more than one
+    dataset on the wire when the peer is far away. An association that is lost
+    is made again. If it can't be, the datasets its thread takes are failed.
+    With a pool, associations are taken from (and returned to) it, so that they
+    are reused by the next send to the same peer.
+    '''
+
+    def __init__(self, ae, address, port, name, associations=4, pdu_max=None,
+                 pool=None):
+        '''
+        :param ae: the (SCU) application entity to associate from
+        :param address: the address of the peer
+        :param port: the port of the peer
+        :param name: the AE title of the peer
+        :param associations: the number of associations to send over
+        :param pdu_max: the max pdu (bytes) to request (default of the ae)
+        :param pool: an AssociationPool to reuse associations from (default None)
+        '''
+        self.ae = ae
+        self.address = address
+        self.port = port
+        self.name = name
+        self.pdu_max = pdu_max
+        self.associations = max(1, associations)
+        self.stopped = threading.Event()
+        self.pool = pool
+        self.key = None
+        if pool is not None:
+            self.key = pool.get_key(address, port, name, ae, pdu_max=pdu_max)
+
+
+    def associate(self):
+        '''return an association with the peer (an idle one from the pool, if
+        there is one), or None if it failed'''
+        if self.pool is not None:
+            return self.pool.acquire(self.key, self.connect)
+        return self.connect()
+
+
+    def connect(self):
+        '''return a new association with the peer, or None if it failed'''
+        try:
+            if self.pdu_max is None:
+                assoc = self.ae.associate(self.address, self.port, self.name)
+            else:
+                assoc = self.ae.associate(self.address, self.port, self.name,
+                                          max_pdu=self.pdu_max)
+        except Exception as error:
+            bot.error("Cannot associate with %s: %s" %(self.name, error))
+            return None
+        if not assoc.is_established:
+            return None
+        return assoc
+
+
+    def send(self, items):
+        '''send is a generator that sends each item, and yields (path, status)
+        as each is finished, in the order they finish. The status is None if the
+        dataset couldn't be read or sent.
+        :param items: an iterable of (path, dataset, error), as from read_instances
+        '''
+        self.stopped.clear()
+        pending = queue.Queue(maxsize=self.associations * 2)
+        results = queue.Queue()
+
+        def feed():
+            for item in items:
+                while not self.stopped.is_set():
+                    try:
+                        pending.put(item, timeout=0.5)
+                        break
+                    except queue.Full:
+                        pass
+                if self.stopped.is_set():
+                    break
+            for ii in range(self.associations):
+                pending.put(None)
+
+        def work():
+            assoc = self.associate()
+            try:
+                while True:
+                    item = pending.get()
+                    if item is None:
+                        break
+                    path, dataset, error = item
+                    if self.stopped.is_set() or dataset is None:
+                        results.put((path, None))
+                        continue
+
+                    if assoc is None or not assoc.is_established:
+                        assoc = self.associate()
+                    if assoc is None:
+                        results.put((path, None))
+                        continue
+
+                    labels = metrics.get_labels('C-STORE', 'scu', self.ae.ae_title,
+                                                peer=get_peer(assoc))
+                    start = time.time()
+                    try:
+                        status = assoc.send_c_store(dataset)
+                    except Exception as error:
+                        bot.error("Cannot send %s: %s" %(path, error))
+                        status = None
+                    metrics.observe(labels, time.time() - start, get_result(status))
+                    if status is not None:
+                        metrics.add_bytes(labels, get_size(path))
+                    results.put((path, status))
+            finally:
+                if assoc is not None and assoc.is_established:
+                    if self.pool is not None:
+                        self.pool.put(self.key, assoc)
+                    else:
+                        assoc.release()
+                results.put(None)
+
+        threads = [threading.Thread(target=feed)]
+        threads += [threading.Thread(target=work) for ii in range(self.associations)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        finished = 0
+        try:
+            while finished < self.associations:
+                result = results.get()
+                if result is None:
+                    finished += 1
+                    continue
+                yield result
+        finally:
+            self.stopped.set()
@@ -25,9 +25,9 @@ SOFTWARE.
 
 from node_dcm.logman import bot
 import os
+import sys
 import time
 
-from pydicom import read_file
 from pydicom.dataset import (
     Dataset,
     FileDataset
@@ -63,7 +63,25 @@ from node_dcm.status import (
 
 
 from node_dcm.base import BaseSCU
-from node_dcm.utils import get_dicom_files
+from node_dcm.cache import (
+    get_cache,
+    get_file_stat
+)
+from node_dcm.journal import SendJournal
+from node_dcm.metrics import (
+    get_peer,
+    metrics
+)
+from node_dcm.reader import read_dataset
+from node_dcm.transfer import (
+    ParallelSender,
+    Throughput,
+    get_batches,
+    get_context_groups,
+    get_result,
+    scan_context
+)
+from node_dcm.utils import iter_dicom_files
 
 class Echo(BaseSCU):
 
@@ -131,20 +149,24 @@ class Echo(BaseSCU):
         if self.assoc.is_established:
 
             for ii in range(self.repeat):
+                labels = metrics.get_labels('C-ECHO', 'scu', self.ae.ae_title,
+                                            peer=get_peer(self.assoc))
+                start = time.time()
                 status = self.assoc.send_c_echo()
+                metrics.observe(labels, time.time() - start, get_result(status))
 
             if status is not None:
 
                 # Abort or release association
-                bot.debug("%s received status %s" %(self.ae.ae_title,
-                                                    status))
+                bot.debug("%s received status %s", self.ae.ae_title,
+                                                  status)
                 if self.abort:
-                    bot.debug("%s aborting association." %self.self.ae.ae_title)
+                    bot.debug("%s aborting association.", self.ae.ae_title)
                     self.assoc.abort()
 
                 else:
-                    bot.debug("%s releasing association." %self.ae.ae_title)
-                    self.assoc.release()
+                    bot.debug("%s returning association to the pool.", self.ae.ae_title)
+                    self.release_assoc()
 
 
     def on_c_echo(self,delay=None):
@@ -182,7 +204,8 @@ class Store(BaseSCU):
                        to_name="ANY-SCP", name='STORESCU', prefer_uncompr=True,
                        prefer_little=False, repeat=1, prefer_big=False, 
                        implicit=False, timeout=None, dimse_timeout=None,
-                       acse_timeout=60, pdu_max=16382, start=False):
+                       acse_timeout=60, pdu_max=16382, associations=1, batch_size=1000,
+                       cache_file=None, start=False):
 
         '''
         :param port: the port to use, default is 11112.
@@ -200,14 +223,17 @@ class Store(BaseSCU):
         :param dimse_timeout: timeout for the DIMSE messages (default None) 
         :param pdu_max: set max receive pdu to n bytes (4096..131072) default 16382
         :param start: if True, start the ae. (default False)
-        :param abort: if True, abort the association after releasing it (default False)
+        :param associations: the number of associations to send over at once (default 1)
+        :param batch_size: the number of files to scan for the presentation contexts to
+                           propose, before sending them (default 1000)
+        :param cache_file: sqlite file of the header cache, so that the headers of files
+                           sent before aren't read again (default NODEDCM_CACHE, or none)
         ''' 
         self.port = port
         self.repeat = repeat
-        self.abort = abort
-        self.update_peer(peer=peer,
-                         port=to_port,
-                         name=to_name)
+        self.associations = associations
+        self.batch_size = batch_size
+        self.cache = get_cache(cache_file)
      
         # Update preferences
         self.update_transfer_syntax(prefer_uncompr=prefer_uncompr,
@@ -229,41 +255,158 @@ class Store(BaseSCU):
         ae.acse_timeout = acse_timeout
         ae.dimse_timeout = dimse_timeout
         BaseSCU.__init__(self,ae=ae)
+        self.pdu_max = pdu_max
         self.status = self.success
 
+        # An ae for each set of presentation contexts needed to send files
+        self.timeouts = (timeout, acse_timeout, dimse_timeout)
+        self.aes = dict()
+
+        # The peer is optional here, it can be given to send
+        self.to_name = to_name
+        if to_port is not None:
+            self.to_port = to_port
+        if peer is not None:
+            self.update_peer(address=peer)
 
-    def send(self,dcm_files,to_address=None,to_port=None,to_name=None):
+
+    def send(self,dcm_files,to_address=None,to_port=None,to_name=None,
+             journal_file=None,mode=None):
         '''send will send one or more dicom files or folders of dicom files, to
         a peer. The peer can be instantiated with the instance and used, or redefined 
-        at any time with the send function.
+        at any time with the send function. Files are found as they are sent (they
+        are not collected first), in batches. The headers of a batch are scanned for
+        the presentation contexts it needs, and only those are proposed: an association
+        for each transfer syntax, with a context for each SOP class in it, split further
+        if there are more than 128 (see get_context_groups).
+        With a journal_file, the outcome of each instance is recorded as it is sent,
+        and an interrupted send can be continued (see node_dcm.journal.SendJournal).
+        :param journal_file: the journal to record outcomes to (default None)
+        :param mode: None to send all files, resume to skip instances that were
+                     sent, or retry to send only the instances that failed
+        :returns results: a list of (path, status) for each file, where status is
+                          the status of the C-STORE, or None if the file couldn't
+                          be read or sent (see node_dcm.transfer.get_result)
         '''
         self.release_assoc()
-        self.update_peer(address=to_address,
+        self.update_peer(address=to_address or self.to_address,
                          port=to_port,
                          name=to_name)
 
-        # Make the association -- #QUESTION - new association for each one?
-        self.make_assoc(address=peer,
-                        name=peer_name,
-                        pdu_max=pdu_max,
-                        port=to_port)
-
-        # Obtain valid dicom files
-        dcm_files = get_dicom_files(dcm_files,
-                                    check=True)
-
-        # Send each dataset
-        for dcm_file in dcm_files:
-            with open(dcm_file, 'rb') as filey:
-                dataset = read_file(filey, force=True)
-            
-            if not self.assoc.is_established:
-                self.make_assoc()
-
-            bot.info('Sending file: {0!s}'.format(dcm_file))
-            status = self.assoc.send_c_store(dataset)
+        journal = None
+        if journal_file is not None:
+            journal = SendJournal(journal_file, mode=mode)
+        elif mode is not None:
+            bot.error("A journal_file is needed to %s a send." %(mode))
+            sys.exit(1)
 
-        self.assoc.release()
+        results = []
+        skipped = 0
+        throughput = Throughput()
+        try:
+            for batch in get_batches(iter_dicom_files(dcm_files), self.batch_size):
+
+                contexts = dict()
+                stats = dict()
+                for dcm_file in batch:
+
+                    # A file sent before (unchanged) is skipped without reading it
+                    if journal is not None:
+                        stats[dcm_file] = get_file_stat(dcm_file)
+                        if journal.was_sent(dcm_file, stats[dcm_file]):
+                            skipped += 1
+                            continue
+                    try:
+                        contexts[dcm_file] = scan_context(dcm_file, cache=self.cache)
+                    except Exception as error:
+                        bot.error('Cannot read file %s: %s', dcm_file, error)
+                        results.append((dcm_file, None))
+                        continue
+
+                    uid = contexts[dcm_file][2]
+                    if journal is not None and not journal.should_send(uid):
+                        del contexts[dcm_file]
+                        skipped += 1
+
+                for sop_classes, transfer_syntaxes, paths in get_context_groups(contexts):
+                    ae = self.get_ae(sop_classes, transfer_syntaxes)
+                    for dcm_file, status in self.send_files(ae, paths, throughput):
+                        results.append((dcm_file, status))
+                        if journal is not None:
+                            journal.record(contexts[dcm_file][2], dcm_file, get_result(status),
+                                           stat=stats.get(dcm_file))
+        finally:
+            if journal is not None:
+                journal.close()
+            if self.cache is not None:
+                self.cache.commit()
+
+        bot.info("Sent %s to %s" %(throughput, self.get_peer()))
+        if skipped > 0:
+            bot.info("Skipped %s instances (%s) in %s" %(skipped, mode, journal_file))
+        failed = len([x for x in results if get_result(x[1]) == 'failed'])
+        if failed > 0:
+            bot.warning("%s of %s files could not be sent" %(failed, len(results)))
+        self.throughput = throughput
+        return results
+
+
+    def send_files(self, ae, dcm_files, throughput):
+        '''send_files sends a list of files from an ae over one or more associations
+        (see node_dcm.transfer.ParallelSender), yielding (path, status) for each as
+        it is sent. The associations are kept in the pool, for the next send. Only
+        the files that the peer stored (with or without a warning) are recorded
+        in the throughput.
+        :param ae: the ae, with the presentation contexts to send the files
+        :param dcm_files: the list of files to send
+        :param throughput: the Throughput to record the files sent in
+        '''
+        sender = ParallelSender(ae,
+                                self.to_address,
+                                self.to_port,
+                                self.to_name,
+                                associations=self.associations,
+                                pdu_max=self.pdu_max,
+                                pool=self.pool)
+
+        # Sizes are recorded as the files are read, for the throughput
+        sizes = dict()
+        def read_files():
+            for dcm_file in dcm_files:
+                try:
+                    sizes[dcm_file] = os.path.getsize(dcm_file)
+                    yield dcm_file, read_dataset(dcm_file), None
+                except Exception as error:
+                    yield dcm_file, None, error
+
+        for dcm_file, status in sender.send(read_files()):
+            size = sizes.pop(dcm_file, 0)
+            if get_result(status) == 'failed':
+                bot.error('Failed to send file: %s', dcm_file)
+            else:
+                bot.debug('Sent file: %s', dcm_file)
+                throughput.record(size)
+            yield dcm_file, status
+
+
+    def get_ae(self, sop_classes, transfer_syntaxes):
+        '''get_ae returns an ae that proposes (only) the SOP classes given, each
+        with the transfer syntaxes given, made once for each set.
+        '''
+        key = (tuple(sop_classes), tuple(transfer_syntaxes))
+        if key not in self.aes:
+            bot.debug("Proposing %s SOP classes with %s transfer syntaxes" %(len(sop_classes),
+                                                                           len(transfer_syntaxes)))
+            ae = AE(ae_title=self.ae.ae_title,
+                    port=self.port,
+                    scu_sop_class=list(sop_classes),
+                    scp_sop_class=[],
+                    transfer_syntax=list(transfer_syntaxes))
+            ae.maximum_pdu_size = self.pdu_max
+            ae.network_timeout, ae.acse_timeout, ae.dimse_timeout = self.timeouts
+            metrics.register(ae)
+            self.aes[key] = ae
+        return self.aes[key]
 
 
     def on_c_store(self, ds):
@@ -348,11 +491,13 @@ class Find(BaseSCU):
                                               query_model=model)
 
             time.sleep(1)
-            for value in response:
+            labels = metrics.get_labels('C-FIND', 'scu', self.ae.ae_title,
+                                        peer=get_peer(self.assoc))
+            for value in metrics.watch(labels, response, get_result):
                 pass
                 print(value)
 
-            self.assoc.release()
+            self.release_assoc()
 
         else:
             bot.error("Association not established with %s" %self.get_peer())
@@ -479,7 +624,7 @@ class Get(BaseSCU):
 
         #TODO: need to figure out where this will be stored?
         filename = '{0!s}.{1!s}'.format(mode_prefix, dataset.SOPInstanceUID)
-        bot.info('Storing DICOM file: {0!s}'.format(filename))
+        bot.info('Storing DICOM file: %s', filename)
 
         if os.path.exists(filename):
             bot.warning('DICOM file already exists, overwriting')
@@ -592,7 +737,7 @@ class Move(BaseSCU):
         :returns status: a valid return status, see StorageServiceClass for available    
         '''
         filename = 'CT.{0!s}'.format(dataset.SOPInstanceUID)
-        bot.info('Storing DICOM file: {0!s}'.format(filename))
+        bot.info('Storing DICOM file: %s', filename)
     
         if os.path.exists(filename):
             bot.warning('DICOM file already exists, overwriting')
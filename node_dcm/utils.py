@@ -30,6 +30,7 @@ import fnmatch
 import os
 import re
 import requests
+import threading
 
 import shutil
 import json
@@ -51,6 +52,18 @@ import zipfile
 # Python less than version 3 must import OSError
 if sys.version_info[0] < 3:
     from exceptions import OSError
+    import Queue as queue
+else:
+    import queue
+
+# scandir is in os from Python 3.5, before that it's an optional package
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 
 ######################################################################################
@@ -101,39 +114,138 @@ def run_command(cmd,error_message=None,sudopw=None,suppress=False):
 ############################################################################
 
 
-def recursive_find_dicoms(base):
+def recursive_find_dicoms(base,workers=1):
     '''recursive find dicoms will search for dicom files in all directory levels
-    below a base. It uses get_dcm_files to find the files in the bases.
+    below a base. It uses find_dicoms to find the files in the bases.
     '''
-    dicoms = []
-    for root, dirnames, filenames in os.walk(base):
-        for filename in fnmatch.filter(filenames, '*.dcm'):
-            dicoms.append(os.path.join(root, filename))
+    return list(find_dicoms(base,workers=workers))
+
 
-    return dicoms
+def scan_dicoms(base,pattern='*.dcm'):
+    '''scan_dicoms is a generator that yields the files matching pattern in all
+    directory levels below a base, as they are found. Directories are listed
+    with scandir (if available), which doesn't need to stat each entry.
+    '''
+    if scandir is None:
+        for root, dirnames, filenames in os.walk(base):
+            for filename in fnmatch.filter(filenames, pattern):
+                yield os.path.join(root, filename)
+        return
+
+    folders = [base]
+    while len(folders) > 0:
+        folder = folders.pop()
+        try:
+            entries = list(scandir(folder))
+        except OSError as error:
+            bot.warning("Cannot list %s: %s" %(folder, error))
+            continue
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+            elif fnmatch.fnmatch(entry.name, pattern):
+                yield entry.path
+
+
+def find_dicoms(base,pattern='*.dcm',workers=1):
+    '''find_dicoms is a generator that yields the dicom files below a base as
+    they are found. With more than one worker, the folders at the top level of
+    the base are each scanned by one of the worker threads, in parallel, which
+    helps most when listing a folder waits on the network (e.g., NFS).
+    :param base: the top level folder to search
+    :param pattern: the pattern of file names to yield (default *.dcm)
+    :param workers: the number of threads to scan with (default 1)
+    '''
+    if workers <= 1:
+        for dicom in scan_dicoms(base,pattern=pattern):
+            yield dicom
+        return
+
+    subtrees = queue.Queue()
+    for name in sorted(os.listdir(base)):
+        path = os.path.join(base, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            subtrees.put(path)
+        elif fnmatch.fnmatch(name, pattern):
+            yield path
+
+    found = queue.Queue(maxsize=10000)
+    stopped = threading.Event()
+
+    # A put gives up once the caller has stopped iterating (the queue may be full)
+    def put(item):
+        while not stopped.is_set():
+            try:
+                found.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def scan():
+        while not stopped.is_set():
+            try:
+                subtree = subtrees.get_nowait()
+            except queue.Empty:
+                break
+            for dicom in scan_dicoms(subtree,pattern=pattern):
+                if not put(dicom):
+                    return
+        put(None)
+
+    threads = [threading.Thread(target=scan) for ii in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    finished = 0
+    try:
+        while finished < len(threads):
+            dicom = found.get()
+            if dicom is None:
+                finished += 1
+                continue
+            yield dicom
+    finally:
+        stopped.set()
 
 
 def get_dicom_files(contenders,check=True):
     '''get_dcm_files will take a list of single dicom files or directories,
     and return a single list of complete paths to all files
     '''
+    dcm_files = list(iter_dicom_files(contenders))
+    bot.debug("Found %s dicom files" %(len(dcm_files)))
+
+    if check is True:
+        dcm_files = validate_dicoms(dcm_files)
+    return dcm_files
+
+
+def iter_dicom_files(contenders,check=False,workers=1):
+    '''iter_dicom_files is the streaming version of get_dicom_files: it yields
+    the paths of dicom files (single files, or found in directories) as they are
+    found, without collecting them first. Unless check is True, files are not
+    validated, and invalid files are found when they are read.
+    :param contenders: a dicom file or folder, or a list of them
+    :param check: validate each file before it's yielded (default False)
+    :param workers: the number of threads to scan each folder with (see find_dicoms)
+    '''
     if not isinstance(contenders,list):
         contenders = [contenders]
 
-    dcm_files = []
     for contender in contenders:
         if os.path.isdir(contender):
-            dicom_dir = recursive_find_dicoms(contender)
-            bot.debug("Found %s dicom files in %s" %(len(dicom_dir),
-                                                     os.path.basename(contender)))
-            dcm_files.extend(dicom_dir)
+            dcm_files = find_dicoms(contender,workers=workers)
+        elif contender.endswith('.dcm'):
+            dcm_files = [contender]
         else:
-            if contender.endswith('.dcm'):
-                bot.debug("Adding single file %s" %(contender))
-                dcm_files.append(contender)
+            continue
 
-    dcm_files = validate_dicoms(dcm_files)
-    return dcm_files
+        for dcm_file in dcm_files:
+            if check is False or len(validate_dicoms([dcm_file])) > 0:
+                yield dcm_file
 
 
 def write_file(filename,content,mode="w"):
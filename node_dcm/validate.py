@@ -22,9 +22,13 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
+from node_dcm.cache import get_file_stat
 from node_dcm.logman import bot
-from pydicom import read_file
+from node_dcm.reader import read_header
+from collections import namedtuple
+import multiprocessing
 import socket
+import struct
 import sys
 import os
 
@@ -40,26 +44,133 @@ def validate_port(port):
         sys.exit()
 
 
-def validate_dicoms(dcm_files):
-    '''validate dicoms will test opening one or more dicom files, and return a list
-    of valid files.
-    :param dcm_files: one or more dicom files to test'''
+# The result of validating a file: valid is True or False, and error says why not
+ValidationResult = namedtuple('ValidationResult', ['path', 'valid', 'error'])
+
+
+def check_preamble(dcm_file):
+    '''check_preamble is the quick validation of a dicom file: it must start with
+    the 128 byte preamble, followed by the DICM prefix and the file meta group
+    (0002). Only the first bytes of the file are read.
+    :param dcm_file: the path to the dicom file
+    '''
+    try:
+        with open(dcm_file, 'rb') as filey:
+            start = filey.read(134)
+    except (IOError, OSError) as error:
+        return ValidationResult(dcm_file, False, str(error))
+
+    if len(start) < 134:
+        return ValidationResult(dcm_file, False, 'File is too small')
+    if start[128:132] != b'DICM':
+        return ValidationResult(dcm_file, False, 'Missing DICM prefix')
+    if struct.unpack('<H', start[132:134])[0] != 0x0002:
+        return ValidationResult(dcm_file, False, 'Missing file meta information')
+    return ValidationResult(dcm_file, True, None)
+
+
+def parse_header(dcm_file):
+    '''parse_header is the deep validation of a dicom file: its header (up to
+    the pixel data) must be parsed without an error, and identify the instance
+    :param dcm_file: the path to the dicom file
+    '''
+    try:
+        dataset = read_header(dcm_file)
+    except Exception as error:
+        return ValidationResult(dcm_file, False, str(error))
+
+    for field in ['SOPClassUID', 'SOPInstanceUID']:
+        if field not in dataset:
+            return ValidationResult(dcm_file, False, 'Missing %s' %(field))
+    return ValidationResult(dcm_file, True, None)
+
+
+def validate_files(dcm_files,deep=False,workers=None,cache=None):
+    '''validate_files checks one or more dicom files, and returns a ValidationResult
+    for each, in the same order. Each file has the quick check (see check_preamble),
+    and if deep is True, the files that pass are also parsed (see parse_header),
+    over a pool of worker processes. With a cache (see node_dcm.cache), files that
+    are unchanged since they were checked are not checked again.
+    :param dcm_files: one or more dicom files to test
+    :param deep: parse the header of each file (default False)
+    :param workers: the number of processes to parse with (default one per cpu)
+    :param cache: a HeaderCache to look up and store the results (default None)
+    '''
     if not isinstance(dcm_files,list):
         dcm_files = [dcm_files]
 
-    valids = []
-
-    bot.debug("Checking %s dicom files for validation." %(len(dcm_files)))
+    level = 'deep' if deep else 'quick'
+    results = dict()
+    unchecked = []
     for dcm_file in dcm_files:
+        cached = None
+        if cache is not None:
+            cached = cache.get_validation(dcm_file, level)
+        if cached is None:
+            unchecked.append(dcm_file)
+        else:
+            results[dcm_file] = ValidationResult(dcm_file, cached[0], cached[1])
+
+    # Results are cached for the files as they were before they were checked
+    stats = dict()
+    if cache is not None:
+        stats = dict([(x, get_file_stat(x)) for x in unchecked])
+
+    checked = [check_preamble(x) for x in unchecked]
+    if deep is True:
+        checked = parse_headers(checked, workers=workers)
 
+    for result in checked:
+        results[result.path] = result
+        if cache is not None and stats[result.path] is not None:
+            cache.put(result.path, result.valid, result.error, level=level,
+                      stat=stats[result.path])
+    if cache is not None:
+        cache.commit()
+
+    return [results[x] for x in dcm_files]
+
+
+def parse_headers(results,workers=None):
+    '''parse_headers runs the deep check (see parse_header) for the files that
+    passed the quick check, over a pool of worker processes, and returns the
+    results updated.
+    :param results: the ValidationResult of the quick check for each file
+    :param workers: the number of processes to parse with (default one per cpu)
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    passed = [x.path for x in results if x.valid]
+    if workers <= 1 or len(passed) < workers * 2:
+        parsed = [parse_header(x) for x in passed]
+    else:
+        pool = multiprocessing.Pool(workers)
         try:
-            with open(dcm_file, 'rb') as filey:
-                dataset = read_file(filey, force=True)
-            valids.append(dcm_file)
-             
-        except IOError:
-            bot.error('Cannot read input file {0!s}'.format(dcm_file))
-            sys.exit(1)
-
-    bot.info("Found %s valid dicom files" %(len(valids)))
+            parsed = pool.map(parse_header, passed, chunksize=64)
+        finally:
+            pool.close()
+            pool.join()
+
+    parsed = dict([(x.path, x) for x in parsed])
+    return [parsed.get(x.path, x) for x in results]
+
+
+def validate_dicoms(dcm_files,deep=False,workers=None,cache=None):
+    '''validate dicoms will test one or more dicom files, and return a list
+    of valid files (see validate_files). Invalid files are logged, and skipped.
+    :param dcm_files: one or more dicom files to test'''
+    if not isinstance(dcm_files,list):
+        dcm_files = [dcm_files]
+
+    bot.debug("Checking %s dicom files for validation.", len(dcm_files))
+
+    valids = []
+    for result in validate_files(dcm_files,deep=deep,workers=workers,cache=cache):
+        if result.valid:
+            valids.append(result.path)
+        else:
+            bot.warning('Invalid dicom file %s: %s', result.path, result.error)
+
+    bot.debug("Found %s valid dicom files", len(valids))
     return valids
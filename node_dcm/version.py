@@ -34,7 +34,8 @@ LICENSE = "LICENSE"
 INSTALL_REQUIRES = (
 
     ('pynetdicom3', {'min_version': '0.1.0'}),
-    ('pydicom', {'min_version': "0.9.9"}),
+    ('pydicom', {'min_version': "1.0.0"}),
+    ('numpy', {'min_version': '1.13.0'}),
     ('requests', {'min_version': '2.12.4'}),
     ('retrying', {'min_version': '1.3.3'}),
     ('google-api-python-client', {'min_version': None}),
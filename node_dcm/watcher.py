@@ -0,0 +1,136 @@
+'''
+
+watcher.py: watch a dicom base for changed files, so that an index of the
+            base can be refreshed without walking the entire tree
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+from node_dcm.logman import bot
+import fnmatch
+import os
+import threading
+
+# inotify is optional, without it changes are found by comparing file stats
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+class ChangeWatcher:
+    '''A ChangeWatcher collects the dicom files under a base that were created,
+    modified, moved or deleted, using inotify if it's available. When changes
+    can't be known (no inotify, or the event queue overflowed) the caller must
+    fall back to comparing the stats of all files.
+    '''
+
+    def __init__(self, base, pattern='*.dcm'):
+        '''
+        :param base: the top level folder to watch
+        :param pattern: the pattern of file names to report (default *.dcm)
+        '''
+        self.base = base
+        self.pattern = pattern
+        self.watches = dict()
+        self.lock = threading.Lock()
+        self.inotify = None
+
+        if INotify is not None:
+            self.mask = (flags.CREATE | flags.CLOSE_WRITE | flags.DELETE |
+                         flags.MOVED_FROM | flags.MOVED_TO | flags.DELETE_SELF)
+            try:
+                self.inotify = INotify()
+                self.add_watches(base)
+                bot.debug("Watching %s directories in %s" %(len(self.watches), base))
+            except OSError as error:
+                bot.warning("Cannot watch %s (%s), changes will be found "
+                            "by file stats." %(base, error))
+                self.inotify = None
+
+
+    def add_watches(self, base):
+        '''add a watch for base and all directories below it, returning the
+        matching files that are already there.
+        '''
+        found = set()
+        for root, dirnames, filenames in os.walk(base):
+            wd = self.inotify.add_watch(root, self.mask)
+            self.watches[wd] = root
+            for filename in fnmatch.filter(filenames, self.pattern):
+                found.add(os.path.join(root, filename))
+        return found
+
+
+    def changes(self):
+        '''changes returns the set of paths changed since the last call, or None
+        if the changes are unknown, in which case all files must be checked. All
+        events that were read are handled either way, so that new directories
+        are watched. After an overflow (events were lost) the whole tree is
+        watched again, for directories created while events were lost.
+        '''
+        if self.inotify is None:
+            return None
+
+        changed = set()
+        unknown = False
+        overflow = False
+        with self.lock:
+            for event in self.inotify.read(timeout=0):
+
+                if event.mask & flags.Q_OVERFLOW:
+                    overflow = True
+                    continue
+
+                root = self.watches.get(event.wd)
+                if root is None:
+                    continue
+
+                if event.mask & flags.IGNORED:
+                    del self.watches[event.wd]
+                    continue
+
+                path = os.path.join(root, event.name)
+                if event.mask & flags.ISDIR:
+                    # Files moved in with a new directory don't have their own events
+                    if event.mask & (flags.CREATE | flags.MOVED_TO):
+                        changed.update(self.add_watches(path))
+
+                    # Files moved (or deleted) with a directory are found by the caller
+                    elif event.mask & flags.MOVED_FROM:
+                        unknown = True
+
+                elif fnmatch.fnmatch(event.name, self.pattern):
+                    changed.add(path)
+
+            if overflow:
+                bot.warning("Change events were lost, checking all files.")
+                self.add_watches(self.base)
+
+        if unknown or overflow:
+            return None
+        return changed
+
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None